@@ -0,0 +1,217 @@
+'''
+Stage by stage timings of the compiler and interpreter.
+
+    python bench/bench_pipeline.py [options]
+    python bench/bench_pipeline.py -o baseline.json
+    python bench/bench_pipeline.py --compare baseline.json
+
+Every program in the corpus (the samples/ programs plus generated inputs
+that stress one part of the pipeline each) goes through tokenize, parse,
+fold, codegen, optimize, assemble and execute, each timed on its own. The
+best of --repeat runs is reported per stage, as a table on stderr and as
+JSON on stdout or in --output. With --compare, stages that got slower
+than the baseline by more than --threshold are listed and the exit status
+is 1.
+
+The execute stage includes decoding the program, which happens on its
+first run. Timings are only comparable between runs on the same machine.
+'''
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'src', 'compiler'))
+sys.path.append(os.path.join(here, '..', 'src', 'interpreter'))
+
+from tokenizer import tokenize
+from parser import exprlist, TokenStream, Listing
+from fold import fold
+from compiler import optimize
+from bytecode import assemble, execute, Machine
+from rng import MersenneTwister
+from writer import Writer
+
+STAGES = ('tokenize', 'parse', 'fold', 'codegen', 'optimize', 'assemble', 'execute')
+SAMPLES = os.path.join(here, '..', 'samples')
+# answers for the samples that prompt
+INPUTS = {'echo_name': 'Adventurer\n'}
+
+def arithChain(n):
+    '''One expression of n dice rolls joined by every arithmetic operator.'''
+    ops = '+-*+'
+    return '(1d20' + ''.join('{}{}d6'.format(ops[i % 4], 1 + i % 3) for i in range(n)) + ')&1d0\n'
+
+def manyPrints(n):
+    '''n top level expressions that each print a constant character.'''
+    return ''.join('!1d0+{} '.format(65 + i % 26) for i in range(n)) + '\n'
+
+def nestedIf(depth):
+    '''Conditionals nested `depth` deep, which the parser handles recursively.'''
+    return '(' + '{1d2>1, ' * depth + '1d6' + ' | 1d0+1}' * depth + ')&1d0\n'
+
+def hugeRoll(n):
+    '''A handful of rolls of n dice, summed, kept and crit checked.'''
+    return '(+{0}d6)&1d0 ({0}d20kh3)&3d1 (+{0}d6>4)&1d4\n'.format(n)
+
+def memoryRange(n):
+    '''Stores, reads and copies a range of n dice slots.'''
+    return '{0}d6&{0}d0 @{0}d0&{0}d{0} (+@{0}d{0})&1d0\n'.format(n)
+
+GENERATED = [
+    ('arith_chain', arithChain, 2000),
+    ('prints', manyPrints, 5000),
+    ('nested_if', nestedIf, 150),
+    ('huge_roll', hugeRoll, 200000),
+    ('memory_range', memoryRange, 200000),
+]
+
+def corpus(scale=1.0):
+    '''[(name, source, stdin text)] for the samples and generated inputs.'''
+    programs = []
+    for filename in sorted(os.listdir(SAMPLES)):
+        if filename.endswith('.d20'):
+            name = filename[:-4]
+            with open(os.path.join(SAMPLES, filename)) as f:
+                programs.append(('sample:' + name, f.read(), INPUTS.get(name, '')))
+    for name, generate, size in GENERATED:
+        # nesting is bounded by Python's recursion limit, so it does not scale
+        n = size if name == 'nested_if' else max(1, int(size * scale))
+        programs.append(('{}:{}'.format(name, n), generate(n), ''))
+    return programs
+
+def runOnce(source, stdin):
+    '''Run the whole pipeline once, returning {stage: seconds}.'''
+    clock = time.perf_counter
+    times = {}
+
+    start = clock()
+    tokens = tokenize(source)
+    times['tokenize'] = clock() - start
+
+    start = clock()
+    tree = exprlist(TokenStream(tokens))
+    times['parse'] = clock() - start
+
+    start = clock()
+    tree = fold(tree)
+    times['fold'] = clock() - start
+
+    start = clock()
+    asm = Listing()
+    tree.gen(asm)
+    times['codegen'] = clock() - start
+
+    start = clock()
+    asm = optimize(asm)
+    times['optimize'] = clock() - start
+
+    start = clock()
+    program = assemble(asm)
+    times['assemble'] = clock() - start
+
+    vm = Machine(MersenneTwister(0), Writer(io.StringIO()))
+    saved = sys.stdin
+    sys.stdin = io.StringIO(stdin)
+    try:
+        start = clock()
+        execute(program, vm)
+        times['execute'] = clock() - start
+    finally:
+        sys.stdin = saved
+    return times, len(program)
+
+def measure(programs, repeat):
+    results = {}
+    for name, source, stdin in programs:
+        runs = []
+        for i in range(repeat):
+            times, instructions = runOnce(source, stdin)
+            runs.append(times)
+        results[name] = {
+            'source_bytes': len(source),
+            'instructions': instructions,
+            'stages': dict((stage, {
+                'best': min(run[stage] for run in runs),
+                'median': statistics.median(run[stage] for run in runs),
+            }) for stage in STAGES),
+        }
+    return results
+
+def compare(results, baseline, threshold):
+    '''[(program, stage, baseline seconds, current seconds)] that got slower.'''
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get('programs', {}).get(name)
+        if old is None:
+            continue
+        for stage in STAGES:
+            before = old['stages'].get(stage, {}).get('best')
+            after = result['stages'][stage]['best']
+            # sub-10µs stages are all timer noise
+            if before and after > 1e-5 and after > before * (1 + threshold):
+                regressions.append((name, stage, before, after))
+    return regressions
+
+def table(results, out):
+    width = max(len(name) for name in results)
+    out.write('{:<{}} '.format('program', width) +
+              ' '.join('{:>10}'.format(stage) for stage in STAGES) + '\n')
+    for name, result in results.items():
+        out.write('{:<{}} '.format(name, width) +
+                  ' '.join('{:>8.3f}ms'.format(result['stages'][stage]['best'] * 1e3)
+                           for stage in STAGES) + '\n')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time each stage of the D20 pipeline.')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-s', '--scale', type=float, default=1.0,
+                        help='multiply the size of the generated inputs')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run programs whose name contains this')
+    parser.add_argument('-o', '--output', help='write the JSON results here')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='flag stages slower than this earlier --output')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed slowdown before a stage is flagged (default 10%%)')
+    args = parser.parse_args(argv)
+
+    programs = [p for p in corpus(args.scale) if args.filter in p[0]]
+    if not programs:
+        parser.error('no program matches "{}"'.format(args.filter))
+    results = measure(programs, args.repeat)
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'repeat': args.repeat,
+        'scale': args.scale,
+        'programs': results,
+    }
+    table(results, sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, stage, before, after in regressions:
+            sys.stderr.write('REGRESSION {} {}: {:.3f}ms -> {:.3f}ms ({:+.0%})\n'.format(
+                name, stage, before * 1e3, after * 1e3, after / before - 1))
+        if regressions:
+            return 1
+        sys.stderr.write('no regressions against {}\n'.format(args.compare))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
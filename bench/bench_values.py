@@ -0,0 +1,63 @@
+'''
+Allocation and GC pressure of the interpreter's hot loop.
+
+    python bench/bench_values.py [repeat]
+
+Runs a comparison- and arithmetic-heavy program and reports wall time,
+peak traced memory, net allocated blocks and the number of garbage
+collections triggered while it ran.
+'''
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'src', 'compiler'))
+sys.path.append(os.path.join(here, '..', 'src', 'interpreter'))
+
+from compiler import compile
+from bytecode import execute
+
+SOURCE = '''
+1d20&1d1 1d20&1d2
+({@1d1>(@1d2), @1d1-@1d2 | @1d2-@1d1})&1d3
+[@1d1 @1d2 @1d3]kh1&1d4
+(+3d6*2+1d4-1d4/2%5)&1d5
+'''
+
+def collections():
+    return sum(stat['collections'] for stat in gc.get_stats())
+
+def measure(program, repeat):
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    collected = collections()
+    start = time.perf_counter()
+    for i in range(repeat):
+        execute(program)
+    elapsed = time.perf_counter() - start
+
+    # tracing slows execution down a lot, so peak memory gets its own run
+    tracemalloc.start()
+    execute(program)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'seconds': elapsed,
+        'instructions_per_second': len(program) * repeat / elapsed,
+        'peak_traced_bytes': peak,
+        'allocated_blocks_delta': sys.getallocatedblocks() - blocks,
+        'gc_collections': collections() - collected,
+    }
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    program = compile(SOURCE * 50, cache=False)
+    for key, value in measure(program, repeat).items():
+        print('{:<26} {:,.0f}'.format(key, value) if key != 'seconds'
+              else '{:<26} {:.3f}'.format(key, value))
+
+if __name__ == '__main__':
+    main()
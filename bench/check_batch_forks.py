@@ -0,0 +1,84 @@
+'''
+Check that batch.simulate gets through the instructions that split a group
+of trials and re-run in each part.
+
+    python bench/check_batch_forks.py [trials]
+
+Each program below has a roll whose dice count, a keep quantity or a
+memory reference that differs between trials. Its result, stored in the
+slot given, is sampled with simulate and with the sequential VM, and the
+two samples are compared with a two sample chi-square test at the 0.1%
+level. A case that takes longer than TIMEOUT seconds counts as failed.
+The exit status is 1 if any of them fails.
+'''
+import os
+import sys
+import threading
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(here)
+
+from check_lazy_dice import compile, critical, execute, Machine, MersenneTwister
+from batch import simulate
+
+CASES = [
+    ('((1d4)d6)&1d0', 0),                   # dice count
+    ('(10d6kh(1d3))&1d0', 0),               # keep quantity
+    ('3d6&3d1 (+@1d(1d3))&1d5', 5),         # memory reference
+    ('(2d(1d3)kl(1d2))&1d0', 0),            # more than one of them
+]
+
+TIMEOUT = 60
+
+def sequential(program, slot, trials):
+    rng = MersenneTwister(1)
+    counts = {}
+    for i in range(trials):
+        value = execute(program, Machine(rng)).heap.lookup(slot)
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+def batched(program, slot, trials):
+    '''Counts from simulate, or None if it does not finish in time.'''
+    out = []
+    worker = threading.Thread(target=lambda: out.append(simulate(program, trials, seed=1)),
+                              daemon=True)
+    worker.start()
+    worker.join(TIMEOUT)
+    if not out:
+        return None
+    counts = {}
+    for value in out[0].slot(slot):
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+def twosample(first, second):
+    '''Statistic and degrees of freedom for two samples of the same size.'''
+    statistic = 0.0
+    bins = 0
+    for value in set(first) | set(second):
+        a, b = first.get(value, 0), second.get(value, 0)
+        statistic += (a - b) ** 2 / (a + b)
+        bins += 1
+    return statistic, bins - 1
+
+def main():
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    failed = 0
+    print('{:<26} {:>5} {:>10} {:>10}  {}'.format('program', 'df', 'chi2', 'critical', 'result'))
+    for source, slot in CASES:
+        program = compile(source, cache=False)
+        counts = batched(program, slot, trials)
+        if counts is None:
+            failed += 1
+            print('{:<26} {:>5} {:>10} {:>10}  {}'.format(source, '', '', '', 'TIMEOUT'))
+            continue
+        statistic, df = twosample(counts, sequential(program, slot, trials))
+        ok = df <= 0 or statistic <= critical(df)
+        failed += not ok
+        print('{:<26} {:>5} {:>10.2f} {:>10.2f}  {}'.format(
+            source, df, statistic, critical(df) if df > 0 else 0.0, 'ok' if ok else 'FAIL'))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+'''
+Statistical check and timing of undrawn (lazy) dice rolls.
+
+    python bench/check_lazy_dice.py [trials]
+
+Rolls of LAZY_THRESHOLD or more dice are summed, kept with kh1/kl1 and
+crit counted by sampling the result directly instead of drawing every
+die. For each expression below, the VM's results over many runs are
+compared with the exact distribution using a chi-square goodness of fit
+test at the 0.1% level. Sums and crit counts come from distribution.py;
+for kh1/kl1 its closed form P(max <= k) = (k/M)^N is evaluated in floating
+point instead, since exact fractions for 10000 dice of 100000 faces run to
+tens of thousands of digits. The exit status is 1 if any of them fails. The timings show that a billion dice cost about
+what one does.
+'''
+import math
+import os
+import re
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'src', 'compiler'))
+sys.path.append(os.path.join(here, '..', 'src', 'interpreter'))
+
+from compiler import compile
+from distribution import analyze
+from bytecode import execute, Machine
+from rng import MersenneTwister
+
+CASES = [
+    '+144d2',
+    '+200d6',
+    '+1000d3',
+    '150d1000kh1',
+    '400d2000kl1',
+    '130d400kh1',
+    '10000d100000kh1',
+    '+300d6>4',
+    '+300d10<3',
+    '+200d8=8',
+]
+
+TIMED = ['1d6', '1000000000d6kh1', '1000000000d6kl1', '+1000000000d6', '+1000000000d20>15']
+
+# standard normal quantile for a one sided 0.1% test
+Z = 3.0902
+
+def critical(df):
+    '''Chi-square critical value, by the Wilson-Hilferty approximation.'''
+    k = 2.0 / (9.0 * df)
+    return df * (1.0 - k + Z * math.sqrt(k)) ** 3
+
+def exact(source):
+    match = re.fullmatch(r'(\d+)d(\d+)k([hl])1', source)
+    if match is None:
+        return analyze(source).pmf
+    n, sides, end = int(match.group(1)), int(match.group(2)), match.group(3)
+    below = lambda k: (k / sides) ** n
+    pmf = dict((k, below(k) - below(k - 1)) for k in range(1, sides + 1))
+    if end == 'l':
+        pmf = dict((sides + 1 - k, p) for k, p in pmf.items())
+    return pmf
+
+def sample(source, trials, seed):
+    program = compile('({})&1d0'.format(source), cache=False)
+    rng = MersenneTwister(seed)
+    counts = {}
+    for i in range(trials):
+        vm = execute(program, Machine(rng))
+        value = vm.heap.lookup(0)
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+def chisquare(counts, pmf, trials):
+    '''Statistic and degrees of freedom, pooling bins expected below 5.'''
+    statistic = 0.0
+    bins = 0
+    observed = expected = 0.0
+    for value in sorted(set(pmf) | set(counts)):
+        observed += counts.get(value, 0)
+        expected += float(pmf.get(value, 0)) * trials
+        if expected >= 5:
+            statistic += (observed - expected) ** 2 / expected
+            bins += 1
+            observed = expected = 0.0
+    if expected or observed:
+        # what is left over joins the last full bin
+        if not bins:
+            return 0.0, 0
+        statistic += (observed - expected) ** 2 / max(expected, 1e-12)
+    return statistic, bins - 1
+
+def timing(source, repeat=2000):
+    program = compile('({})&1d0'.format(source), cache=False)
+    vm = Machine(MersenneTwister(0))
+    start = time.perf_counter()
+    for i in range(repeat):
+        vm.pc = 0
+        execute(program, vm)
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    failed = 0
+    print('{:<14} {:>5} {:>10} {:>10}  {}'.format('expression', 'df', 'chi2', 'critical', 'result'))
+    for seed, source in enumerate(CASES):
+        pmf = exact(source)
+        statistic, df = chisquare(sample(source, trials, seed), pmf, trials)
+        ok = df <= 0 or statistic <= critical(df)
+        failed += not ok
+        print('{:<14} {:>5} {:>10.2f} {:>10.2f}  {}'.format(
+            source, df, statistic, critical(df) if df > 0 else 0.0, 'ok' if ok else 'FAIL'))
+    print()
+    for source in TIMED:
+        print('{:<20} {:8.2f} us/run'.format(source, timing(source) * 1e6))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+'''
+Statistical check and timing of the r and ro reroll modifiers.
+
+    python bench/check_rerolls.py [trials]
+
+Each expression below is run many times and its results compared with
+the exact distribution from distribution.py, using the same chi-square
+test as check_lazy_dice.py. The exit status is 1 if any of them fails.
+The timings are for rerolls of a million dice, which are drawn and
+merged in bulk rather than one die at a time.
+'''
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(here)
+
+from check_lazy_dice import analyze, compile, critical, chisquare, sample, Machine, MersenneTwister, execute
+
+CASES = [
+    '+5d20r<10',
+    '+4d6ro<3',
+    '+200d6r=1',
+    '+3d300r>250',
+    '+6d6ro>4',
+    '+8d10r=(10)',
+    '+4d6ro=6>4',
+    '+2d1000r<999',
+    '+300d6ro<2',
+]
+
+TIMED = ['1000000d6r<2', '1000000d6ro<2', '1000000d20r=20', '1000000d1000r>10']
+
+def timing(source, repeat=5):
+    program = compile('({})&1d0'.format(source), cache=False)
+    vm = Machine(MersenneTwister(0))
+    start = time.perf_counter()
+    for i in range(repeat):
+        vm.pc = 0
+        execute(program, vm)
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    failed = 0
+    print('{:<14} {:>5} {:>10} {:>10}  {}'.format('expression', 'df', 'chi2', 'critical', 'result'))
+    for seed, source in enumerate(CASES):
+        pmf = analyze(source).pmf
+        statistic, df = chisquare(sample(source, trials, seed), pmf, trials)
+        ok = df <= 0 or statistic <= critical(df)
+        failed += not ok
+        print('{:<14} {:>5} {:>10.2f} {:>10.2f}  {}'.format(
+            source, df, statistic, critical(df) if df > 0 else 0.0, 'ok' if ok else 'FAIL'))
+    print()
+    for source in TIMED:
+        print('{:<20} {:8.2f} ms/run'.format(source, timing(source) * 1e3))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import struct
+import tempfile
+
+import bytecode
+import interpeter
+from bytecode import dumps, loads, AssemblyException, OPCODE_SIGNATURE
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'd20')
+DEFAULT_MAXSIZE = 64 * 1024 * 1024
+SUFFIX = '.d20c'
+
+def compilerVersion():
+    '''
+    Digest of the compiler's own source, of the assembler's and of the
+    interpreter's, whose keep and discard rules fold.py uses to compute
+    constants. Editing the tokenizer, parser, code generator, those rules
+    or the binary encoding therefore invalidates every cached program the
+    same way a change to the opcode table does.
+    '''
+    digest = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    sources = [os.path.join(here, name) for name in sorted(os.listdir(here)) if name.endswith('.py')]
+    sources.append(os.path.abspath(bytecode.__file__))
+    sources.append(os.path.abspath(interpeter.__file__))
+    for path in sources:
+        with open(path, 'rb') as f:
+            digest.update(os.path.basename(path).encode())
+            digest.update(f.read())
+    return digest.hexdigest()
+
+class ProgramCache:
+    '''
+    Directory of assembled programs keyed by a hash of their source, in the
+    spirit of __pycache__. Entries are written atomically and the least
+    recently used ones are evicted once the directory grows past maxsize.
+    '''
+    version = None
+
+    def __init__(self, directory=None, maxsize=DEFAULT_MAXSIZE):
+        if directory is None:
+            directory = os.environ.get('D20_CACHE_DIR', DEFAULT_DIRECTORY)
+        self.directory = directory
+        self.maxsize = maxsize
+        if ProgramCache.version is None:
+            ProgramCache.version = '%s:%08x' % (compilerVersion(), OPCODE_SIGNATURE)
+
+    def key(self, source):
+        digest = hashlib.sha256(ProgramCache.version.encode())
+        digest.update(source.encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            program = loads(data)
+        except FileNotFoundError:
+            return None
+        except (AssemblyException, struct.error, ValueError, TypeError, IndexError, OSError):
+            # stale or truncated entry - drop it and recompile
+            self.remove(path)
+            return None
+        try:
+            # mtime doubles as the last access time for LRU eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return program
+
+    def put(self, key, program):
+        '''
+        Store a program. The cache is only ever an optimization, so a
+        directory that cannot be created or written just goes unused.
+        '''
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(dumps(program))
+            os.replace(tmp, self.path(key))
+        except OSError:
+            self.remove(tmp)
+            return
+        except BaseException:
+            self.remove(tmp)
+            raise
+        try:
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxsize:
+                break
+            self.remove(path)
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(SUFFIX):
+                    self.remove(entry.path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
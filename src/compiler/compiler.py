@@ -1,33 +1,165 @@
+import json
+import os
+import sys
+
 from tokenizer import tokenize
-from parser import exprlist
+from parser import exprlist, TokenStream, Listing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'interpreter'))
+from bytecode import assemble
+from cache import ProgramCache
+from fold import fold
+
+def compile(code, cache=True):
+    '''
+    Compile source text to an assembled program. `cache` may be True for the
+    default on-disk cache (D20_CACHE_DIR, ~/.cache/d20 by default), a
+    ProgramCache instance, or False to always compile from scratch.
+    '''
+    if cache is True:
+        cache = ProgramCache()
+    if cache:
+        key = cache.key(code)
+        program = cache.get(key)
+        if program is not None:
+            return program
 
-def compile(code):
     tokens = tokenize(code)
-    tree = exprlist(tokens)
-    asm = []
+    tree = fold(exprlist(TokenStream(tokens)))
+    asm = Listing()
     tree.gen(asm)
     asm = optimize(asm)
-    return assemble(trimmed)
-
-def optimize(instructions):
-    optimized = [instructions[0]]
-    for i in range(1, len(instructions)):
-        ''' 
-        Since the dice roll doesn't have knowledge of what the left and right
-        hand operands are, it always attempts to sum them to ensure it's using 
-        a single number for the dice roll. 
-        For any standard dice roll XdY, the code generated will be:
-            LOAD Y
-            SUM
-            LOAD X
-            SUM
-            ROLL
-        We can remove the SUM instructions proceeding a LOAD in this case.
-        '''
-        if instructions[i-1].startswith('LOAD') and instructions[i] == 'SUM':
-            continue
-        optimized.append(instructions[i])
-    return optimized
-
-def assemble(instructions):
-    pass
\ No newline at end of file
+    program = assemble(asm)
+
+    if cache:
+        cache.put(key, program)
+    return program
+
+def printable(arg):
+    '''A constant PRINT can do at compile time: a valid, encodable code point.'''
+    if not constants(arg):
+        return False
+    code = int(arg)
+    return 0 <= code <= 0x10FFFF and not 0xD800 <= code <= 0xDFFF
+
+def constants(*args):
+    '''True if every operand is a plain integer literal.'''
+    for arg in args:
+        if not arg.lstrip('-').isdigit():
+            return False
+    return True
+
+'''
+Peephole rules: (pattern, rewrite). A pattern is a run of consecutive
+mnemonics; labels are never part of a pattern, so nothing is fused across
+a jump target. rewrite receives the operand text of each matched
+instruction and returns the replacement, or None to leave the run alone.
+
+Since the dice roll doesn't have knowledge of what the left and right hand
+operands are, it always sums them to ensure it's using a single number for
+the dice roll. For any standard dice roll XdY the code generated is
+    PUSH Y
+    SUM
+    PUSH X
+    SUM
+    ROLL
+The SUMs after each PUSH are dropped first, after which the roll, and the
+same shape in slot references, fuses into a single instruction.
+'''
+peepholes = [
+    (('PUSH', 'SUM'), lambda a: ['PUSH ' + a[0]]),
+    (('SUM', 'SUM'), lambda a: ['SUM']),
+    (('PUSH', 'PUSH', 'ROLL'),
+     lambda a: ['ROLLC {} {}'.format(a[1], a[0])] if constants(a[0], a[1]) else None),
+    # a reroll keeps a copy of the sides beneath its dice
+    (('PUSH', 'DUP', 'PUSH', 'ROLL'),
+     lambda a: ['PUSH ' + a[0], 'ROLLC {} {}'.format(a[2], a[0])]
+               if a[1] == '1' and constants(a[0], a[2]) else None),
+    (('PUSH', 'PUSH', 'PUSHV'),
+     lambda a: ['PUSHVC {} {}'.format(a[1], a[0])] if constants(a[0], a[1]) else None),
+    (('PUSH', 'PUSH', 'POPV'),
+     lambda a: ['POPVC {} {}'.format(a[1], a[0])] if constants(a[0], a[1]) else None),
+    (('PRINT', 'POP'), lambda a: ['PRINTPOP'] if not a[1] else None),
+    # !1d0+72 !1d0+105 ... becomes one write of the whole text
+    (('PUSH', 'PRINTPOP'),
+     lambda a: [prints(chr(int(a[0])), 0)] if printable(a[0]) else None),
+    # a constant list prints as its characters: peel them off one at a time
+    (('PUSH', 'MLIST', 'PRINTPOP'),
+     lambda a: ['MLIST {}'.format(int(a[1]) - 1), 'PRINTPOP', prints(chr(int(a[0])), -1)]
+               if printable(a[0]) and int(a[1]) > 0 else None),
+    (('MLIST', 'PRINTPOP'), lambda a: [prints('', 0)] if a[0] == '0' else None),
+    (('PRINTS', 'PRINTS'), lambda a: [joinPrints(a[0], a[1])]),
+]
+
+def prints(text, start):
+    '''
+    PRINTS writes text. start is the offset in text where the last whole
+    print expression begins, or -1 if all of text finishes a list that the
+    PRINTPOP before it started. The VM ignores it; batch mode uses it to
+    recover the value of the print expression, which the fused-away POP
+    used to leave behind.
+    '''
+    return 'PRINTS {} {}'.format(json.dumps(text), start)
+
+def joinPrints(first, second):
+    text, start = first.rsplit(' ', 1)
+    more, restart = second.rsplit(' ', 1)
+    text, more = json.loads(text), json.loads(more)
+    if int(restart) >= 0:
+        return prints(text + more, len(text) + int(restart))
+    return prints(text + more, int(start))
+
+def mergeSpans(spans):
+    '''Smallest span covering all of them, for instructions fused together.'''
+    spans = [span for span in spans if span is not None]
+    if not spans:
+        return None
+    start = min(span[:2] for span in spans)
+    end = max(span[2:] for span in spans)
+    return start + end
+
+def optimize(instructions, rules=peepholes):
+    '''
+    Apply the peephole rules until none of them match any more. A Listing
+    comes back as a Listing, with fused instructions mapped to the source
+    of everything they replaced.
+    '''
+    spans = getattr(instructions, 'spans', [None] * len(instructions))
+    # labels nothing jumps to would only split runs the rules could fuse
+    targets = set(instr.partition(' ')[2].strip() for instr in instructions)
+    kept = [(instr, span) for instr, span in zip(instructions, spans)
+            if not instr.startswith(':') or instr in targets]
+    changed = True
+    while changed:
+        changed = False
+        optimized = []
+        names = []
+        args = []
+        located = []
+        for instr, span in kept:
+            name, _, arg = instr.partition(' ')
+            optimized.append(instr)
+            names.append(name)
+            args.append(arg.strip())
+            located.append(span)
+            for pattern, rewrite in rules:
+                n = len(pattern)
+                if tuple(names[-n:]) != pattern:
+                    continue
+                replacement = rewrite(args[-n:])
+                if replacement is None:
+                    continue
+                span = mergeSpans(located[-n:])
+                del optimized[-n:], names[-n:], args[-n:], located[-n:]
+                for new in replacement:
+                    name, _, arg = new.partition(' ')
+                    optimized.append(new)
+                    names.append(name)
+                    args.append(arg)
+                    located.append(span)
+                changed = True
+                break
+        kept = list(zip(optimized, located))
+    if isinstance(instructions, Listing):
+        return Listing([instr for instr, span in kept], [span for instr, span in kept])
+    return [instr for instr, span in kept]
@@ -0,0 +1,409 @@
+from fractions import Fraction
+from math import comb
+
+from tokenizer import tokenize
+import parser
+
+'''
+Exact distribution of a dice expression, worked out from the parse tree
+instead of by running the program.
+
+Every intermediate value is a mixture: a list of (probability, Pool) pairs.
+A Pool is n independent dice sharing one face distribution, plus whatever
+keep/discard window and crit check the modifiers put on it. Plain numbers
+are pools of a single die, so arithmetic results, constants and dice rolls
+all share the one representation. Totals are computed by convolution for
+whole pools and by an order statistic recurrence over the faces for pools
+with a keep/discard window, or in closed form when the window keeps a
+single die.
+'''
+
+class AnalysisException(Exception):
+    pass
+
+class Pool:
+    def __init__(self, n, die):
+        self.n = n
+        # ((face, probability), ...) in ascending face order
+        self.die = die
+        self.skipLow = 0
+        self.skipHigh = 0
+        self.order = None
+        self.crit = None
+
+    def copy(self):
+        pool = Pool(self.n, self.die)
+        pool.skipLow = self.skipLow
+        pool.skipHigh = self.skipHigh
+        pool.order = self.order
+        pool.crit = self.crit
+        return pool
+
+    def kept(self):
+        return max(self.n - self.skipLow - self.skipHigh, 0)
+
+    def windowed(self):
+        return self.skipLow or self.skipHigh
+
+class HeteroList:
+    '''List of unrelated values, e.g. [1d6 1d20]; only its total is known.'''
+    def __init__(self, pmf):
+        self.pmf = pmf
+
+def scalar(pmf):
+    return [(Fraction(1), Pool(1, tuple(sorted(pmf.items()))))]
+
+def constant(value):
+    return scalar({value: Fraction(1)})
+
+def uniform(sides):
+    if sides == 0:
+        return ((0, Fraction(1)),)
+    p = Fraction(1, sides)
+    return tuple((face, p) for face in range(1, sides + 1))
+
+def convolve(a, b, op=lambda x, y: x + y):
+    out = {}
+    for x, px in a.items():
+        for y, py in b.items():
+            v = op(x, y)
+            out[v] = out.get(v, 0) + px * py
+    return out
+
+def power(pmf, n):
+    result = {0: Fraction(1)}
+    while n:
+        if n & 1:
+            result = convolve(result, pmf)
+        n >>= 1
+        if n:
+            pmf = convolve(pmf, pmf)
+    return result
+
+def mapping(pool):
+    if pool.crit is None:
+        return lambda face: face
+    op, target = pool.crit
+    if op == 'greater_than':
+        return lambda face: 1 if face > target else 0
+    if op == 'less_than':
+        return lambda face: 1 if face < target else 0
+    return lambda face: 1 if face == target else 0
+
+def orderStatistic(pool, rank):
+    '''
+    Distribution of the die at ascending `rank`, counted from 0, of the
+    pool. It is at most a face exactly when more than `rank` dice are, a
+    cumulative binomial summed over whichever tail is shorter, so kh1 and
+    kl1 take one term per face: P(max <= k) = F(k)^n and
+    P(min <= k) = 1 - (1 - F(k))^n.
+    '''
+    n = pool.n
+    f = mapping(pool)
+    upper = n - rank <= rank + 1
+    out = {}
+    below = previous = Fraction(0)
+    for face, p in pool.die:
+        below += p
+        above = 1 - below
+        if upper:
+            atMost = sum(comb(n, k) * below ** k * above ** (n - k) for k in range(rank + 1, n + 1))
+        else:
+            atMost = 1 - sum(comb(n, k) * below ** k * above ** (n - k) for k in range(rank + 1))
+        if atMost != previous:
+            out[f(face)] = out.get(f(face), 0) + atMost - previous
+        previous = atMost
+    return out
+
+def poolTotal(pool):
+    f = mapping(pool)
+    n = pool.n
+    if pool.kept() == 0:
+        return {0: Fraction(1)}
+    if not pool.windowed():
+        die = {}
+        for face, p in pool.die:
+            die[f(face)] = die.get(f(face), 0) + p
+        return power(die, n)
+    if pool.kept() == 1:
+        return orderStatistic(pool, pool.skipLow)
+
+    '''
+    Order statistics: hand out the n dice to the faces from lowest to
+    highest. Giving t more dice to a face puts them at ascending ranks
+    c..c+t-1, and only the ranks inside [skipLow, n - skipHigh) count
+    towards the total. A particular split (t1, t2, ...) has probability
+    n!/(t1! t2! ...) * p1^t1 * p2^t2 * ..., built up here one face at a
+    time as C(n - c, t) * p^t.
+    '''
+    lo, hi = pool.skipLow, n - pool.skipHigh
+    states = {(0, 0): Fraction(1)}
+    last = len(pool.die) - 1
+    for j, (face, p) in enumerate(pool.die):
+        w = f(face)
+        nxt = {}
+        for (c, s), prob in states.items():
+            counts = [n - c] if j == last else range(n - c + 1)
+            for t in counts:
+                overlap = max(0, min(c + t, hi) - max(c, lo))
+                weight = prob * comb(n - c, t) * p ** t
+                if weight:
+                    key = (c + t, s + overlap * w)
+                    nxt[key] = nxt.get(key, 0) + weight
+        states = nxt
+    out = {}
+    for (c, s), prob in states.items():
+        out[s] = out.get(s, 0) + prob
+    return out
+
+def total(value):
+    out = {}
+    for weight, pool in value:
+        pmf = pool.pmf if isinstance(pool, HeteroList) else poolTotal(pool)
+        for v, p in pmf.items():
+            out[v] = out.get(v, 0) + weight * p
+    return out
+
+def truth(value):
+    pmf = total(value)
+    false = pmf.get(0, Fraction(0))
+    return 1 - false, false
+
+def unsupported(what):
+    raise AnalysisException('{} cannot be analyzed: the result depends on '
+                            'memory or I/O'.format(what))
+
+def evaluate(node):
+    if isinstance(node, parser.expr):
+        return evaluate(node.expr)
+    if isinstance(node, parser.storeexpr):
+        if node.type != 'basic':
+            unsupported('Prompts and file access')
+        if node.store:
+            unsupported('Storing to dice slots')
+        return evaluate(node.value)
+    if isinstance(node, (parser.printexpr, parser.closeexpr)):
+        unsupported('Printing and file access')
+    if isinstance(node, parser.readref):
+        unsupported('Reading dice slots')
+    if isinstance(node, parser.ifexpr):
+        return evaluateIf(node)
+    if isinstance(node, parser.binop):
+        return evaluateBinop(node)
+    if isinstance(node, parser.prefix):
+        value = evaluate(node.value)
+        if node.op == 'add':
+            return scalar(total(value))
+        if node.op == 'invert':
+            true, false = truth(value)
+            return scalar({1: false, 0: true})
+        return value
+    if isinstance(node, parser.value):
+        return applyModifiers(evaluate(node.value), node.modifiers)
+    if isinstance(node, parser.diceroll):
+        return evaluateRoll(node)
+    if isinstance(node, parser.listgen):
+        return evaluateList(node)
+    if isinstance(node, parser.paren):
+        if node.type == 'numeric':
+            return constant(int(node.inner))
+        return evaluate(node.inner)
+    raise AnalysisException('Cannot analyze {}'.format(type(node).__name__))
+
+def evaluateIf(node):
+    remaining = Fraction(1)
+    out = []
+    for condition, expression in node.conditions:
+        true, false = truth(evaluate(condition))
+        if true:
+            out.extend((remaining * true * w, pool) for w, pool in evaluate(expression))
+        remaining *= false
+        if not remaining:
+            return out
+    otherwise = evaluate(node.elseclause) if node.elseclause else constant(0)
+    out.extend((remaining * w, pool) for w, pool in otherwise)
+    return out
+
+def divide(x, y):
+    if y == 0:
+        raise AnalysisException('Expression can divide by zero')
+    return x // y
+
+def modulo(x, y):
+    if y == 0:
+        raise AnalysisException('Expression can divide by zero')
+    return x % y
+
+operators = {
+    'add': lambda x, y: x + y,
+    'subtract': lambda x, y: x - y,
+    'multiply': lambda x, y: x * y,
+    'divide': divide,
+    'modulo': modulo,
+    'logical_and': lambda x, y: 1 if x and y else 0,
+    'logical_or': lambda x, y: 1 if x or y else 0,
+}
+
+def evaluateBinop(node):
+    if not node.ops:
+        # a lone operand passes through untouched, lists included
+        return evaluate(node.operands[0])
+    # left to right, like the generated code
+    result = total(evaluate(node.operands[0]))
+    for op, operand in zip(node.ops, node.operands[1:]):
+        result = convolve(result, total(evaluate(operand)), operators[op])
+    return scalar(result)
+
+def evaluateRoll(node):
+    counts = total(evaluate(node.count))
+    sides = total(evaluate(node.sides))
+    out = []
+    for n, pn in sorted(counts.items()):
+        for s, ps in sorted(sides.items()):
+            if n < 0 or s < 0:
+                raise AnalysisException('Expression can roll a negative number of dice or sides')
+            out.append((pn * ps, Pool(n, uniform(s))))
+    return out
+
+def evaluateList(node):
+    pmf = {0: Fraction(1)}
+    for expression in node.value.expressions:
+        pmf = convolve(pmf, total(evaluate(expression)))
+    return [(Fraction(1), HeteroList(pmf))]
+
+def applyModifiers(value, mods):
+    if not (mods.sort or mods.sortd or mods.keepdiscard or mods.r or mods.ro or mods.critcheck):
+        return value
+    for weight, pool in value:
+        if isinstance(pool, HeteroList):
+            raise AnalysisException('Modifiers on a list of unrelated values cannot be analyzed')
+
+    # same order the code generator applies them in
+    value = [(w, pool.copy()) for w, pool in value]
+    if mods.sort or mods.sortd:
+        for w, pool in value:
+            pool.order = 'asc' if mods.sort else 'desc'
+    for kd in mods.keepdiscard:
+        value = split(value, kd.quantity, lambda pool, k, op=kd.op: keepdiscard(pool, op, k))
+    if mods.r or mods.ro:
+        op, target = mods.reroll()
+        once = bool(mods.ro)
+        value = split(value, target, lambda pool, t: reroll(pool, op, t, once))
+    if mods.critcheck:
+        op = mods.critcheck.op
+        value = split(value, mods.critcheck.value, lambda pool, t: setcrit(pool, op, t))
+    return value
+
+def split(value, quantity, apply):
+    '''Apply a modifier whose argument may itself be random.'''
+    out = []
+    for k, pk in sorted(total(evaluate(quantity)).items()):
+        for w, pool in value:
+            pool = pool.copy()
+            apply(pool, k)
+            out.append((w * pk, pool))
+    return out
+
+def setcrit(pool, op, target):
+    pool.crit = (op, target)
+
+rerollChecks = {
+    'GT': lambda face, target: face > target,
+    'LT': lambda face, target: face < target,
+    'EQ': lambda face, target: face == target,
+}
+
+def reroll(pool, op, target, once):
+    '''
+    Rerolling changes each die's face distribution and nothing else, as
+    long as the dice are still independent, i.e. none have been kept or
+    discarded by value yet.
+    '''
+    if pool.windowed():
+        raise AnalysisException('Rerolls after a keep or discard by value cannot be analyzed')
+    check = rerollChecks[op]
+    matched = sum((p for face, p in pool.die if check(face, target)), Fraction(0))
+    if not matched:
+        return
+    if once:
+        # a die that matched shows a fresh roll instead
+        pool.die = tuple((face, p * (not check(face, target)) + matched * p)
+                         for face, p in pool.die)
+    elif matched == 1:
+        raise AnalysisException('Every face of the die would be rerolled')
+    else:
+        # until it stops matching: the faces that do not, renormalized
+        pool.die = tuple((face, p / (1 - matched))
+                         for face, p in pool.die if not check(face, target))
+    pool.order = None
+
+positional = {
+    # after an ascending sort the front of the pool is its low end
+    ('asc', 'KF'): 'KL', ('asc', 'KR'): 'KH', ('asc', 'DF'): 'DL', ('asc', 'DR'): 'DH',
+    ('desc', 'KF'): 'KH', ('desc', 'KR'): 'KL', ('desc', 'DF'): 'DH', ('desc', 'DR'): 'DL',
+}
+
+def keepdiscard(pool, op, k):
+    k = max(k, 0)
+    if op in ('KF', 'KR', 'DF', 'DR'):
+        if pool.order:
+            op = positional[(pool.order, op)]
+        elif pool.windowed():
+            raise AnalysisException('Positional keeps after a value keep cannot be analyzed')
+        else:
+            # unsorted dice are exchangeable, so any k of them will do
+            pool.n = min(k, pool.n) if op in ('KF', 'KR') else max(pool.n - k, 0)
+            return
+    kept = pool.kept()
+    if op == 'KH':
+        pool.skipLow += max(kept - k, 0)
+    elif op == 'KL':
+        pool.skipHigh += max(kept - k, 0)
+    elif op == 'DH':
+        pool.skipHigh += min(k, kept)
+    elif op == 'DL':
+        pool.skipLow += min(k, kept)
+
+class Distribution:
+    def __init__(self, pmf):
+        self.pmf = dict(sorted((v, p) for v, p in pmf.items() if p))
+
+    def probability(self, value):
+        return self.pmf.get(value, Fraction(0))
+
+    def cdf(self, value):
+        return sum((p for v, p in self.pmf.items() if v <= value), Fraction(0))
+
+    @property
+    def mean(self):
+        return sum(v * p for v, p in self.pmf.items())
+
+    @property
+    def variance(self):
+        mean = self.mean
+        return sum((v - mean) ** 2 * p for v, p in self.pmf.items())
+
+    def percentile(self, q):
+        '''Smallest value v with P(X <= v) >= q percent.'''
+        target = Fraction(q) / 100
+        cumulative = Fraction(0)
+        for v, p in self.pmf.items():
+            cumulative += p
+            if cumulative >= target:
+                return v
+        return v
+
+    def __repr__(self):
+        return '<Distribution mean={:.4f} variance={:.4f} over {} values>'.format(
+            float(self.mean), float(self.variance), len(self.pmf))
+
+def analyze(code):
+    '''
+    Exact distribution of the total of a single D20 expression, such as
+    '4d6dl1' or '2d20kh1+5'. Raises AnalysisException for anything that
+    reads or writes memory or does I/O, since those have no fixed answer.
+    '''
+    tree = parser.exprlist(parser.TokenStream(tokenize(code)))
+    if len(tree.expressions) != 1:
+        raise AnalysisException('Expected exactly one expression, got {}'.format(len(tree.expressions)))
+    return Distribution(total(evaluate(tree.expressions[0])))
@@ -0,0 +1,225 @@
+import parser
+from parser import literal
+from interpeter import keep, discard, ranked
+
+'''
+Constant folding over the parse tree, run before code generation.
+
+Rolls of zero or one sided dice, plain numbers and anything built only
+from those are replaced with literal nodes. Anything that draws from the
+RNG, touches memory or does I/O is left in place; only its constant
+children are folded. Operations that would fail at runtime (division by
+zero, negative dice counts) are left unfolded so they still fail there.
+'''
+
+# rolls with more dice than this stay as ROLL; a literal would be bigger
+FOLD_LIMIT = 64
+
+def constant(node):
+    return isinstance(node, literal)
+
+def total(value):
+    return value if type(value) is int else sum(value)
+
+def dice(value):
+    return (value,) if type(value) is int else value
+
+def divide(x, y):
+    return None if y == 0 else x // y
+
+def modulo(x, y):
+    return None if y == 0 else x % y
+
+operators = {
+    'add': lambda x, y: x + y,
+    'subtract': lambda x, y: x - y,
+    'multiply': lambda x, y: x * y,
+    'divide': divide,
+    'modulo': modulo,
+    'logical_and': lambda x, y: 1 if x and y else 0,
+    'logical_or': lambda x, y: 1 if x or y else 0,
+}
+
+selectors = {
+    'KH': lambda d, n: keep(d, ranked(d, n, True)),
+    'KL': lambda d, n: keep(d, ranked(d, n, False)),
+    'KF': lambda d, n: d[:max(n, 0)],
+    'KR': lambda d, n: d[max(len(d) - n, 0):] if n > 0 else [],
+    'DH': lambda d, n: discard(d, ranked(d, n, True)),
+    'DL': lambda d, n: discard(d, ranked(d, n, False)),
+    'DF': lambda d, n: d[max(n, 0):],
+    'DR': lambda d, n: d[:max(len(d) - n, 0)] if n > 0 else d,
+}
+
+crits = {
+    'greater_than': lambda d, t: 1 if d > t else 0,
+    'less_than': lambda d, t: 1 if d < t else 0,
+    'equals': lambda d, t: 1 if d == t else 0,
+}
+
+def fold(node):
+    '''Fold node's subtree in place and return the node to use instead.'''
+    if isinstance(node, parser.exprlist):
+        node.expressions = [fold(e) for e in node.expressions]
+        return node
+    if isinstance(node, parser.expr):
+        node.expr = fold(node.expr)
+        if constant(node.expr):
+            return literal(node.expr.value, node.expr.span or node.span)
+        return node
+    if isinstance(node, parser.storeexpr):
+        if node.value is not None:
+            node.value = fold(node.value)
+        if node.store:
+            foldRef(node.store.ref)
+        elif node.type == 'basic' and constant(node.value):
+            return node.value
+        return node
+    if isinstance(node, parser.printexpr):
+        node.value = fold(node.value)
+        if node.file:
+            foldRef(node.file.ref)
+        return node
+    if isinstance(node, parser.closeexpr):
+        foldRef(node.file.ref)
+        return node
+    if isinstance(node, (parser.readref, parser.storeref)):
+        foldRef(node.ref)
+        return node
+    if isinstance(node, parser.ifexpr):
+        return foldIf(node)
+    if isinstance(node, parser.binop):
+        return foldBinop(node)
+    if isinstance(node, parser.prefix):
+        return foldPrefix(node)
+    if isinstance(node, parser.value):
+        return foldValue(node)
+    if isinstance(node, parser.diceroll):
+        return foldRoll(node)
+    if isinstance(node, parser.listgen):
+        node.value = fold(node.value)
+        values = node.value.expressions
+        if all(constant(e) for e in values):
+            return literal(tuple(die for e in values for die in dice(e.value)))
+        return node
+    if isinstance(node, parser.paren):
+        if node.type == 'numeric':
+            return literal(int(node.inner))
+        node.inner = fold(node.inner)
+        return node.inner if constant(node.inner) else node
+    return node
+
+def foldRef(roll):
+    # slot references are never replaced, but their count and sides can be
+    roll.count = fold(roll.count)
+    roll.sides = fold(roll.sides)
+
+def foldIf(node):
+    conditions = []
+    for condition, expression in node.conditions:
+        condition = fold(condition)
+        expression = fold(expression)
+        if constant(condition):
+            if total(condition.value) == 0:
+                continue
+            if not conditions:
+                # first condition that can run is always true
+                return expression
+            # everything after an always-true condition is unreachable
+            node.conditions = conditions
+            node.elseclause = expression
+            return node
+        conditions.append((condition, expression))
+    node.conditions = conditions
+    if node.elseclause:
+        node.elseclause = fold(node.elseclause)
+    if not conditions:
+        return node.elseclause or literal(0)
+    return node
+
+def foldBinop(node):
+    node.operands = [fold(o) for o in node.operands]
+    if not node.ops:
+        return node.operands[0]
+    if all(constant(o) for o in node.operands):
+        result = total(node.operands[0].value)
+        for op, operand in zip(node.ops, node.operands[1:]):
+            result = operators[op](result, total(operand.value))
+            if result is None:
+                return node
+        return literal(result)
+    if isinstance(node, parser.addsub):
+        # a + 1 - 2 + b  ->  a + b + -1: constants after the first operand
+        # only ever shift the total, so they can be collected into one
+        operands, ops, offset, folded = [node.operands[0]], [], 0, 0
+        for op, operand in zip(node.ops, node.operands[1:]):
+            if constant(operand):
+                value = total(operand.value)
+                offset += value if op == 'add' else -value
+                folded += 1
+            else:
+                operands.append(operand)
+                ops.append(op)
+        if folded > 1:
+            node.operands = operands + [literal(offset)]
+            node.ops = ops + ['add']
+    return node
+
+def foldPrefix(node):
+    node.value = fold(node.value)
+    if not constant(node.value):
+        return node
+    value = node.value.value
+    if node.op == 'add':
+        return literal(total(value))
+    if node.op == 'invert':
+        return literal(0 if total(value) else 1)
+    return node.value
+
+def foldValue(node):
+    mods = node.modifiers
+    if mods.r or mods.ro:
+        # a reroll needs the roll's sides, so the roll itself has to stay
+        foldRef(node.value)
+        check = mods.r or mods.ro
+        check.value = fold(check.value)
+    else:
+        node.value = fold(node.value)
+    for kd in mods.keepdiscard:
+        kd.quantity = fold(kd.quantity)
+    if mods.critcheck:
+        mods.critcheck.value = fold(mods.critcheck.value)
+    if not constant(node.value):
+        return node
+    if mods.r or mods.ro:
+        return node
+    if not (mods.sort or mods.sortd or mods.keepdiscard or mods.critcheck):
+        return node.value
+    if not all(constant(kd.quantity) for kd in mods.keepdiscard):
+        return node
+    if mods.critcheck and not constant(mods.critcheck.value):
+        return node
+
+    # same order modifiers.gen applies them in
+    value = list(dice(node.value.value))
+    if mods.sort or mods.sortd:
+        value = sorted(value, reverse=mods.sortd)
+    for kd in mods.keepdiscard:
+        value = list(selectors[kd.op](value, total(kd.quantity.value)))
+    if mods.critcheck:
+        target = total(mods.critcheck.value.value)
+        compare = crits[mods.critcheck.op]
+        value = [compare(d, target) for d in value]
+    return literal(tuple(value))
+
+def foldRoll(node):
+    node.count = fold(node.count)
+    node.sides = fold(node.sides)
+    if not (constant(node.count) and constant(node.sides)):
+        return node
+    count = total(node.count.value)
+    sides = total(node.sides.value)
+    # zero and one sided dice never touch the RNG, see DiceEngine.roll
+    if sides in (0, 1) and 0 <= count <= FOLD_LIMIT:
+        return literal((sides,) * count)
+    return node
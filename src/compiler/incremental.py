@@ -0,0 +1,681 @@
+import bisect
+from array import array
+from itertools import accumulate
+from operator import attrgetter
+
+from compiler import optimize, peepholes
+from tokenizer import scan
+from parser import TokenStream, Listing, CompileException, expr
+from fold import fold
+from bytecode import assemble, opcodes, ConstantPool, Program, CONST, LABEL, PAIR
+
+'''
+Incremental compilation for editors and REPLs.
+
+Top level expressions compile independently: each becomes a fragment of
+optimized code with its own labels. An IncrementalCompiler keeps the
+fragment of every expression along with where it sits in the text, and
+an edit only rescans and reparses from the expression before the change
+up to the first old expression boundary past it that the new parse lands
+on exactly.
+
+    session = IncrementalCompiler(text)
+    session.edit(start, end, 'replacement')     # character offsets
+    program = session.program()
+
+Nothing past that is looked at again. Expressions are kept in blocks
+(see Units) and their positions are relative to the block, so an edit
+moves everything after it by changing one block's width. Fragments are
+assembled as they are compiled, into a constant pool the session
+shares, and the new instructions are spliced into the session's code in
+place, moving only the jumps that come after them. A program handed out
+is a copy of that code, and its source map is only put together if
+something reads it. The work per edit therefore follows the size of the
+edit and of the expressions it touches, plus a few copies of the code
+made at C speed, rather than the size of the file.
+
+Fragments meeting at a seam a peephole rule could fuse, such as two
+prints, are linked as one segment and peepholed across the seam, so the
+program runs just as the whole text compiled at once would, though its
+constant pool may be laid out differently.
+'''
+
+# mnemonic pairs a peephole rule could fuse, for spotting seams worth a look
+fusible = set((pattern[i], pattern[i + 1]) for pattern, rewrite in peepholes
+              for i in range(len(pattern) - 1))
+
+# operand kind of each opcode number
+kinds = [op.operand for op in opcodes]
+
+size = attrgetter('size')
+
+# units per block, see Units
+BLOCK = 64
+
+# constant pool entries tolerated before unused ones are dropped, see compact
+POOL = 256
+
+class Unit:
+    '''
+    One top level expression: its extent in the text and the line of its
+    first token, all counted from the start of its Block, the column of
+    that token, and its code. Labels in the code are numbered from :L0
+    and spans are relative to the first token, so neither needs touching
+    when text before the expression changes.
+
+    The first unit of a linked segment holds how many instructions the
+    segment assembled to and their spans relative to that unit; any other
+    unit of it has no instructions of its own and no map.
+    '''
+    __slots__ = ('start', 'end', 'line', 'column', 'code', 'spans', 'labels', 'size', 'map')
+
+    def __init__(self, start, end, line, column, code, spans, labels):
+        self.start = start
+        self.end = end
+        self.line = line
+        self.column = column
+        self.code = code
+        self.spans = spans
+        self.labels = labels
+        self.size = 0
+        self.map = None
+
+    def copy(self):
+        unit = Unit.__new__(Unit)
+        for name in Unit.__slots__:
+            setattr(unit, name, getattr(self, name))
+        return unit
+
+class Block:
+    '''
+    A run of units and the text they lie in: `width` characters holding
+    `lines` newlines and, in the linked code, `size` instructions. A block
+    a handed out program still reads from is frozen, and copied before it
+    changes.
+    '''
+    __slots__ = ('units', 'width', 'lines', 'size', 'frozen')
+
+    def __init__(self, units, width, lines, size):
+        self.units = units
+        self.width = width
+        self.lines = lines
+        self.size = size
+        self.frozen = False
+
+    def copy(self):
+        return Block([unit.copy() for unit in self.units], self.width, self.lines, self.size)
+
+class Units:
+    '''
+    The units of a session in text order, in blocks of around BLOCK.
+    Blocks cover the text end to end, each starting where the one before
+    it ends, so where a block starts is just the sum of the widths before
+    it. Those sums are kept per block rather than per unit, and only
+    worked out again after a block changed.
+    '''
+    def __init__(self, text):
+        self.blocks = [Block([], len(text), text.count('\n'), 0)]
+        self.sums = None
+
+    def prefix(self):
+        '''Units before, offset of and first line of every block, and the totals.'''
+        if self.sums is None:
+            blocks = self.blocks
+            self.sums = (list(accumulate(map(len, map(attrgetter('units'), blocks)), initial=0)),
+                         list(accumulate(map(attrgetter('width'), blocks), initial=0)),
+                         list(accumulate(map(attrgetter('lines'), blocks), initial=1)))
+        return self.sums
+
+    def __len__(self):
+        return self.prefix()[0][-1]
+
+    def find(self, i):
+        '''Block holding unit i and where in it the unit is.'''
+        counts = self.prefix()[0]
+        k = min(bisect.bisect_right(counts, i), len(self.blocks)) - 1
+        return k, i - counts[k]
+
+    def block(self, pos):
+        '''Block whose text holds offset pos, the last one for the end of the text.'''
+        bases = self.prefix()[1]
+        return min(bisect.bisect_right(bases, pos), len(self.blocks)) - 1
+
+    def unit(self, i):
+        k, j = self.find(i)
+        return self.blocks[k].units[j]
+
+    def get(self, i):
+        '''Unit i with its start, end and line in the whole text.'''
+        k, j = self.find(i)
+        counts, bases, lines = self.prefix()
+        unit = self.blocks[k].units[j]
+        return unit, bases[k] + unit.start, bases[k] + unit.end, lines[k] + unit.line
+
+    def start(self, i):
+        return self.get(i)[1]
+
+    def firstStart(self, pos, right=False):
+        '''Index of the first unit starting at or, if right, after pos.'''
+        k = self.block(pos)
+        counts, bases, lines = self.prefix()
+        find = bisect.bisect_right if right else bisect.bisect_left
+        return counts[k] + find([u.start for u in self.blocks[k].units], pos - bases[k])
+
+    def firstEnd(self, pos):
+        '''Index of the first unit ending at or after pos.'''
+        k = self.block(pos)
+        counts, bases, lines = self.prefix()
+        # the last unit of the block before may end right where this one starts
+        if k and pos == bases[k] and bases[k - 1] + self.blocks[k - 1].units[-1].end >= pos:
+            return counts[k] - 1
+        return counts[k] + bisect.bisect_left([u.end for u in self.blocks[k].units], pos - bases[k])
+
+    def instructions(self, i):
+        '''How many linked instructions come before unit i.'''
+        if i >= len(self):
+            return sum(map(size, self.blocks))
+        k, j = self.find(i)
+        return sum(map(size, self.blocks[:k])) + sum(map(size, self.blocks[k].units[:j]))
+
+    def thaw(self, k):
+        block = self.blocks[k]
+        if block.frozen:
+            block = self.blocks[k] = block.copy()
+        return block
+
+    def freeze(self):
+        '''The blocks as they are now and their first lines, left as they are from here on.'''
+        for block in self.blocks:
+            block.frozen = True
+        return list(self.blocks), self.prefix()[2][:-1]
+
+    def link(self, i, size, spans):
+        '''Record what unit i linked to, see Unit.'''
+        k, j = self.find(i)
+        block = self.thaw(k)
+        unit = block.units[j]
+        block.size += size - unit.size
+        unit.size, unit.map = size, spans
+
+    def merge(self, ka, kb):
+        '''Make blocks ka..kb one block, returning it.'''
+        counts, bases, lines = self.prefix()
+        units = []
+        for k in range(ka, kb + 1):
+            across, down = bases[k] - bases[ka], lines[k] - lines[ka]
+            for unit in self.blocks[k].units:
+                unit = unit.copy()
+                unit.start += across
+                unit.end += across
+                unit.line += down
+                units.append(unit)
+        parts = self.blocks[ka:kb + 1]
+        block = Block(units, sum(b.width for b in parts), sum(b.lines for b in parts),
+                      sum(b.size for b in parts))
+        self.blocks[ka:kb + 1] = [block]
+        self.sums = None
+        return block
+
+    def split(self, k, text):
+        '''Break up block k if it grew too big, or hand its text on if it has no units left.'''
+        block = self.blocks[k]
+        units = block.units
+        if not units:
+            if len(self.blocks) == 1:
+                return
+            del self.blocks[k]
+            if k:
+                before = self.thaw(k - 1)
+                before.width += block.width
+                before.lines += block.lines
+            else:
+                after = self.thaw(0)
+                for unit in after.units:
+                    unit.start += block.width
+                    unit.end += block.width
+                    unit.line += block.lines
+                after.width += block.width
+                after.lines += block.lines
+            self.sums = None
+            return
+        if len(units) <= 2 * BLOCK:
+            return
+        base = self.prefix()[1][k]
+        pieces = []
+        at = above = 0
+        for m in range(0, len(units), BLOCK):
+            chunk = units[m:m + BLOCK]
+            if m + BLOCK < len(units):
+                end = units[m + BLOCK].start
+                lines = text.count('\n', base + at, base + end)
+            else:
+                end, lines = block.width, block.lines - above
+            for unit in chunk:
+                unit.start -= at
+                unit.end -= at
+                unit.line -= above
+            pieces.append(Block(chunk, end - at, lines, sum(u.size for u in chunk)))
+            at, above = end, above + lines
+        self.blocks[k:k + 1] = pieces
+        self.sums = None
+
+    def replace(self, i, j, fresh, text):
+        '''
+        Put fresh units, positioned in the whole text, in place of units
+        i..j-1, returning how many linked instructions those had.
+        '''
+        counts, bases, lines = self.prefix()
+        ka = self.find(i)[0] if i < counts[-1] else len(self.blocks) - 1
+        kb = self.find(j - 1)[0] if j > i else ka
+        if fresh:
+            ka = min(ka, self.block(fresh[0].start))
+            kb = max(kb, self.block(fresh[-1].end - 1))
+        # rather than leave a block with hardly any units in it
+        if kb + 1 < len(self.blocks) and counts[kb + 1] - counts[ka] - (j - i) + len(fresh) < BLOCK // 2:
+            kb += 1
+        offset, base, top = counts[ka], bases[ka], lines[ka]
+        block = self.merge(ka, kb)
+        for unit in fresh:
+            unit.start -= base
+            unit.end -= base
+            unit.line -= top
+        removed = sum(unit.size for unit in block.units[i - offset:j - offset])
+        block.units[i - offset:j - offset] = fresh
+        block.size -= removed
+        self.split(ka, text)
+        return removed
+
+    def shift(self, start, end, newEnd, lineShift, oldLine, columnShift):
+        '''
+        Move the units for text[start:end] having been replaced by text
+        ending at newEnd, with lineShift more newlines than it had. Units
+        after the edit on oldLine, the line it ended on, also move across
+        by columnShift.
+        '''
+        ka = self.block(start)
+        kb = self.block(end - 1) if end > start else ka
+        block = self.merge(ka, kb) if kb > ka else self.thaw(ka)
+        counts, bases, lines = self.prefix()
+        base, top = bases[ka], lines[ka]
+        start, end, newEnd = start - base, end - base, newEnd - base
+        delta = newEnd - end
+        # text inserted at a boundary goes after an end but before a start
+        for unit in block.units:
+            if unit.end <= start:
+                continue
+            if unit.start >= end:
+                if top + unit.line == oldLine:
+                    unit.column += columnShift
+                unit.line += lineShift
+                unit.start += delta
+            unit.end = unit.end + delta if unit.end > end else newEnd
+        block.width += delta
+        block.lines += lineShift
+        if columnShift:
+            for k in range(ka + 1, len(self.blocks)):
+                if lines[k] != oldLine:
+                    break
+                after = self.thaw(k)
+                for unit in after.units:
+                    if unit.line:
+                        break
+                    unit.column += columnShift
+                if after.lines:
+                    break
+        self.sums = None
+
+class Chunks(TokenStream):
+    '''Token stream that asks `more` for another batch whenever it runs dry.'''
+    def __init__(self, more):
+        super().__init__([])
+        self.more = more
+
+    def fill(self):
+        while self.pos >= len(self.tokens):
+            batch = self.more()
+            if batch is None:
+                return False
+            self.tokens.extend(batch)
+        return True
+
+    def peek(self, throws=True):
+        self.fill()
+        return super().peek(throws)
+
+    def advance(self, throws=True):
+        self.fill()
+        return super().advance(throws)
+
+    def __len__(self):
+        self.fill()
+        return super().__len__()
+
+class Rescan:
+    '''
+    Feeds Chunks from the text one old expression at a time, noting when a
+    batch ends exactly where an old expression starts.
+    '''
+    def __init__(self, text, units, state, next):
+        self.text = text
+        self.units = units
+        self.state = state
+        self.next = next
+        self.aligned = False
+
+    def __call__(self):
+        pos, line, lineStart = self.state
+        if pos >= len(self.text):
+            return None
+        b = self.next
+        stop = self.units.start(b) if b < len(self.units) else len(self.text)
+        tokens, self.state = scan(self.text, pos, stop, line, lineStart)
+        self.aligned = b < len(self.units) and self.state[0] == stop
+        self.next = b + 1
+        return tokens
+
+class SessionProgram(Program):
+    '''
+    A program as a session stood when it was asked for. Its source map is
+    put together from the blocks it was given the first time it is read.
+    '''
+    def __init__(self, code, consts, blocks, lines):
+        super().__init__(code, consts)
+        self.blocks = blocks
+        self.lines = lines
+
+    @property
+    def sourcemap(self):
+        if self.blocks is not None:
+            spans = []
+            for block, line in zip(self.blocks, self.lines):
+                for unit in block.units:
+                    if unit.map is not None:
+                        spans.extend(absolute(span, line + unit.line, unit.column) for span in unit.map)
+            self.spans = spans if any(spans) else None
+            self.blocks = None
+        return self.spans
+
+    @sourcemap.setter
+    def sourcemap(self, spans):
+        self.spans = spans
+        self.blocks = None
+
+def relative(span, line, column):
+    if span is None:
+        return None
+    l1, c1, l2, c2 = span
+    return (l1 - line, c1 - column + 1 if l1 == line else c1,
+            l2 - line, c2 - column + 1 if l2 == line else c2)
+
+def absolute(span, line, column):
+    if span is None:
+        return None
+    l1, c1, l2, c2 = span
+    return (l1 + line, c1 + column - 1 if not l1 else c1,
+            l2 + line, c2 + column - 1 if not l2 else c2)
+
+def relabel(instr, base):
+    if instr.startswith(':L'):
+        return ':L%d' % (int(instr[2:]) + base)
+    name, _, arg = instr.partition(' ')
+    if arg.startswith(':L'):
+        return '%s :L%d' % (name, int(arg[2:]) + base)
+    return instr
+
+def fragment(node):
+    '''Generate and optimize one top level expression, labels from :L0.'''
+    asm = Listing()
+    fold(node).gen(asm)
+    asm.append('POP')
+    asm = optimize(asm)
+    names = {}
+    for instr in asm:
+        if instr.startswith(':'):
+            names[instr] = ':L%d' % len(names)
+    code = []
+    for instr in asm:
+        if instr.startswith(':'):
+            instr = names[instr]
+        else:
+            name, _, arg = instr.partition(' ')
+            if arg.strip() in names:
+                instr = name + ' ' + names[arg.strip()]
+        code.append(instr)
+    return code, asm.spans, len(names)
+
+class IncrementalCompiler:
+    def __init__(self, text=''):
+        self.text = text
+        self.units = Units(text)
+        self.pool = ConstantPool()
+        self.code = array('i')
+        # indices of the instructions in self.code that jump, in order
+        self.jumps = []
+        self.poolSize = POOL
+        # region of the text not yet reparsed, after a failed reparse
+        self.dirty = (0, len(text))
+        self.cached = None
+        self.error = None
+        try:
+            self.reparse()
+        except CompileException:
+            # kept in self.error, and the text stays dirty for the next edit
+            pass
+
+    def locate(self, offset):
+        '''Line and column of a character offset in the current text.'''
+        k = self.units.block(offset)
+        counts, bases, lines = self.units.prefix()
+        line = lines[k] + self.text.count('\n', bases[k], offset)
+        return line, offset - self.text.rfind('\n', 0, offset)
+
+    def offset(self, line, column):
+        '''Character offset of a (line, column), both counted from 1.'''
+        counts, bases, lines = self.units.prefix()
+        k = max(min(bisect.bisect_right(lines, line), len(lines) - 1) - 1, 0)
+        pos = self.text.rfind('\n', 0, bases[k]) + 1
+        for i in range(line - lines[k]):
+            pos = self.text.index('\n', pos) + 1
+        return pos + column - 1
+
+    def edit(self, start, end, replacement):
+        '''
+        Replace text[start:end] and recompile what changed. A compile error
+        propagates, and the damaged region is remembered and reparsed
+        together with the next edit.
+        '''
+        text = self.text
+        if not 0 <= start <= end <= len(text):
+            raise IndexError('Edit {}..{} is outside the text'.format(start, end))
+        oldLine, oldColumn = self.locate(end)
+        startLine, startColumn = self.locate(start)
+        newLine = startLine + replacement.count('\n')
+        if '\n' in replacement:
+            newColumn = len(replacement) - replacement.rindex('\n')
+        else:
+            newColumn = startColumn + len(replacement)
+        newEnd = start + len(replacement)
+        delta = newEnd - end
+
+        # where a start or an (exclusive) end lands after the edit; text
+        # inserted at a boundary goes after an end but before a start
+        def moveStart(pos):
+            return pos if pos < start else pos + delta if pos >= end else newEnd
+
+        def moveEnd(pos):
+            return pos if pos <= start else pos + delta if pos > end else newEnd
+
+        # expressions starting inside the replaced text are gone for good
+        units = self.units
+        first, last = units.firstStart(start), units.firstStart(end)
+        if first < last:
+            self.splice(first, last, [])
+        units.shift(start, end, newEnd, newLine - oldLine, oldLine, newColumn - oldColumn)
+        if self.dirty is None:
+            self.dirty = (start, newEnd)
+        else:
+            lo, hi = self.dirty
+            self.dirty = (min(moveStart(lo), start), max(moveEnd(hi), newEnd))
+        self.text = text[:start] + replacement + text[end:]
+        self.cached = None
+        self.reparse()
+
+    def reparse(self):
+        lo, hi = self.dirty
+        units = self.units
+        # the expression before the change may now run on into it, and one
+        # starting right at the change may now be part of a comment
+        first = max(units.firstEnd(lo) - 1, 0)
+        if first < len(units) and units.start(first) < lo:
+            unit, start, end, line = units.get(first)
+            state = (start, line, start - unit.column + 1)
+        else:
+            first = 0
+            state = (0, 1, 0)
+        # old expressions from here on start after every change
+        reusable = max(units.firstStart(hi), first)
+        rescan = Rescan(self.text, units, state, reusable)
+        stream = Chunks(rescan)
+        fresh = []
+        try:
+            # until the parse lands exactly on an old expression start
+            while not (stream.pos == len(stream.tokens) and rescan.aligned) and len(stream):
+                head = stream.peek()
+                node = expr(stream)
+                last = stream.last
+                code, spans, labels = fragment(node)
+                fresh.append(Unit(head.match.start(), last.match.end(), head.line, head.column,
+                                  code, [relative(span, head.line, head.column) for span in spans],
+                                  labels))
+        except CompileException as e:
+            self.error = e
+            raise
+        self.splice(first, rescan.next - 1 if rescan.aligned else len(units), fresh)
+        self.dirty = None
+        self.error = None
+
+    def joined(self, k):
+        '''Whether units k-1 and k meet at a seam a peephole rule could fuse.'''
+        units = self.units
+        if not 0 < k < len(units):
+            return False
+        return (units.unit(k - 1).code[-1].partition(' ')[0],
+                units.unit(k).code[0].partition(' ')[0]) in fusible
+
+    def splice(self, i, j, fresh):
+        '''Put fresh units in place of units i..j-1 and relink what that touches.'''
+        # segments running into the old units are relinked whole, as are
+        # any the fresh ones now join up with
+        s, e = i, j
+        while self.joined(s):
+            s -= 1
+        while self.joined(e):
+            e += 1
+        removed = self.units.replace(i, j, fresh, self.text)
+        e += len(fresh) - (j - i)
+        while self.joined(s):
+            s -= 1
+        while self.joined(e):
+            e += 1
+        self.link(s, e, removed)
+        self.cached = None
+
+    def segment(self, p, q):
+        '''Assemble units p..q-1 together, with spans relative to unit p.'''
+        units = self.units
+        out = Listing()
+        base = 0
+        for k in range(p, q):
+            unit, start, end, line = units.get(k)
+            if k == p:
+                top, left = line, unit.column
+            seam = len(out)
+            for instr, span in zip(unit.code, unit.spans):
+                out.append(relabel(instr, base) if unit.labels else instr)
+                out.spans[-1] = absolute(span, line, unit.column)
+            base += unit.labels
+            if seam and seam < len(out):
+                fuse(out, seam)
+        piece = assemble(out, self.pool)
+        if piece.sourcemap is None:
+            return piece, [None] * len(piece)
+        return piece, [relative(span, top, left) for span in piece.sourcemap]
+
+    def link(self, s, e, removed):
+        '''
+        Link units s..e-1, which start and end on segment boundaries, and
+        splice their code in place of what they had before, `removed`
+        instructions from units no longer there included.
+        '''
+        units = self.units
+        a = units.instructions(s)
+        b = units.instructions(e) + removed
+        words = array('i')
+        jumps = []
+        p = s
+        while p < e:
+            q = p + 1
+            while q < e and self.joined(q):
+                q += 1
+            piece, spans = self.segment(p, q)
+            at = a + len(words) // 2
+            code = piece.code
+            for index in range(len(piece)):
+                if kinds[code[2 * index]] == LABEL:
+                    code[2 * index + 1] += at
+                    jumps.append(at + index)
+            words.extend(code)
+            units.link(p, len(piece), spans)
+            for k in range(p + 1, q):
+                units.link(k, 0, None)
+            p = q
+        code = self.code
+        code[2 * a:2 * b] = words
+        # jumps past the splice move with their targets
+        delta = len(words) // 2 - (b - a)
+        lo = bisect.bisect_left(self.jumps, a)
+        later = self.jumps[bisect.bisect_left(self.jumps, b):]
+        if delta:
+            operand = 2 * delta + 1
+            for index in later:
+                code[2 * index + operand] += delta
+            later = list(map(delta.__add__, later))
+        self.jumps[lo:] = jumps + later
+        if len(self.pool.consts) > 2 * self.poolSize:
+            self.compact()
+
+    def compact(self):
+        '''Start the constant pool over with just what the code still uses.'''
+        consts, pool, code = self.pool.consts, ConstantPool(), self.code
+        for i in range(0, len(code), 2):
+            kind = kinds[code[i]]
+            if kind == CONST:
+                code[i + 1] = pool.add(consts[code[i + 1]])
+            elif kind == PAIR:
+                code[i + 1] = pool.addPair(consts[code[i + 1]], consts[code[i + 1] + 1])
+        self.pool = pool
+        self.poolSize = max(len(pool.consts), POOL)
+
+    def program(self):
+        '''The assembled program, or the last compile error if there is one.'''
+        if self.error is not None:
+            raise self.error
+        if self.cached is None:
+            blocks, lines = self.units.freeze()
+            self.cached = SessionProgram(array('i', self.code), list(self.pool.consts),
+                                         blocks, lines)
+        return self.cached
+
+def fuse(out, seam):
+    '''Peephole the few instructions either side of a seam between fragments.'''
+    if (out[seam - 1].partition(' ')[0], out[seam].partition(' ')[0]) not in fusible:
+        return
+    lo = seam
+    while lo > max(seam - 3, 0) and not out[lo - 1].startswith(':'):
+        lo -= 1
+    hi = seam
+    while hi < min(seam + 3, len(out)) and not out[hi].startswith(':'):
+        hi += 1
+    window = optimize(Listing(out[lo:hi], out.spans[lo:hi]))
+    out[lo:hi] = window
+    out.spans[lo:hi] = window.spans
@@ -7,24 +7,70 @@ class CompileException(Exception):
         msg = "Error line {} column {}: {}".format(token.line, token.column, message)
         super().__init__(msg)
 
-lastToken = None
-def peek(tokens, throws=True):
-    if len(tokens):
-        return tokens[0]
-    elif throws:
-        raise CompileException(lastToken, 'Unexpected EOF')
-    else:
-        return None
-
-def pop(tokens, throws=True):
-    global lastToken
-    if len(tokens):
-        lastToken = tokens[0]
-        return tokens.pop(0)
-    elif throws:
-        raise CompileException(lastToken, 'Unexpected EOF')
+class TokenStream:
+    '''
+    Cursor over a token list. Consuming a token only moves the cursor, so a
+    production costs the same no matter how much input is left behind it.
+    '''
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.last = None
+
+    def peek(self, throws=True):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        elif throws:
+            raise CompileException(self.last, 'Unexpected EOF')
+        else:
+            return None
+
+    def advance(self, throws=True):
+        if self.pos < len(self.tokens):
+            self.last = self.tokens[self.pos]
+            self.pos += 1
+            return self.last
+        elif throws:
+            raise CompileException(self.last, 'Unexpected EOF')
+        else:
+            return None
+
+    def mark(self):
+        return self.pos
+
+    def rewind(self, mark):
+        self.pos = mark
+        self.last = self.tokens[mark - 1] if mark > 0 else None
+
+    def __len__(self):
+        return len(self.tokens) - self.pos
+
+class Listing(list):
+    '''
+    Instruction list for gen() that remembers, for every instruction, the
+    source span (line, column, end line, end column) of the innermost
+    expression being generated when it was appended. gen() also accepts a
+    plain list, which simply has no source map.
+    '''
+    def __init__(self, instructions=(), spans=None):
+        super().__init__(instructions)
+        self.spans = list(spans) if spans is not None else [None] * len(self)
+        self.span = None
+
+    def append(self, instr):
+        super().append(instr)
+        self.spans.append(self.span)
+
+    def within(self, span, gen):
+        outer, self.span = self.span, span
+        gen(self)
+        self.span = outer
+
+def located(span, gen, pgm):
+    if span is not None and isinstance(pgm, Listing):
+        pgm.within(span, gen)
     else:
-        return None
+        gen(pgm)
 
 nextLabel = 0
 def genLabel():
@@ -38,7 +84,7 @@ class exprlist:
         self.expressions = []
         self.toplevel = not terminators
         while len(tokens) > 0:
-            if peek(tokens).label in terminators: break
+            if tokens.peek().label in terminators: break
             self.expressions.append(expr(tokens))
 
     def gen(self, pgm):
@@ -62,7 +108,7 @@ class expr:
         global diceEncountered
         diceEncountered = False
 
-        tok = peek(tokens)
+        tok = tokens.peek()
         if tok.label in ('file_write', 'print'):
             self.expr = printexpr(tokens)
         elif tok.label == 'file_close':
@@ -72,14 +118,17 @@ class expr:
         else:
             self.expr = storeexpr(tokens)
 
+        last = tokens.last
+        self.span = (tok.line, tok.column, last.line, last.column + last.length - 1)
+
         #if not diceEncountered:
         #    raise CompileException(tok, 'Expression does not contain a dice roll.')
     def gen(self, pgm):
-        self.expr.gen(pgm)
+        located(self.span, self.expr.gen, pgm)
 
 class ifexpr:
     def __init__(self, tokens):
-        tok = pop(tokens)
+        tok = tokens.advance()
         if tok.label != 'o_bracket':
             raise CompileException(tok, 'Conditional block must start with \'{\'')
 
@@ -89,7 +138,7 @@ class ifexpr:
             # parse expression (either conditional field or else clause)
             ifcond = expr(tokens)
             thendo = None
-            tok = pop(tokens)
+            tok = tokens.advance()
             if tok.label == 'comma':
                 # normal conditional clause - parse the "do" portion of the condition
                 thendo = expr(tokens)
@@ -102,7 +151,7 @@ class ifexpr:
                 # error
                 raise CompileException(tok, 'Expected a comma or closing bracket', tok)
             # handle separator
-            tok = pop(tokens)
+            tok = tokens.advance()
             if tok.label == 'v_bar':
                 # another condition/else clause
                 continue
@@ -129,14 +178,14 @@ class ifexpr:
         else:
             # Add a dummy else clause loading 0 onto the stack
             # necessary so the ifexpr will always yield a value
-            pgm.append('LOAD 0')
+            pgm.append('PUSH 0')
         pgm.append(endLabel)
 
 class storeexpr:
     def __init__(self, tokens):
-        tok = peek(tokens)
+        tok = tokens.peek()
         if tok.label in ['file_open_r', 'file_open_w', 'file_read', 'prompt']:
-            self.type = pop(tokens).label
+            self.type = tokens.advance().label
         else:
             self.type = 'basic'
 
@@ -147,7 +196,7 @@ class storeexpr:
         else:
             self.value = mathexpr(tokens)
 
-        tok = peek(tokens, False)
+        tok = tokens.peek(False)
         if tok and tok.label == 'store':
             self.store = storeref(tokens)
         else:
@@ -155,7 +204,7 @@ class storeexpr:
 
     def gen(self, pgm):
         if self.type == 'prompt':
-            pgm.append('READ')
+            pgm.append('INPUT')
         elif self.type == 'file_read':
             self.value.gen(pgm)
             pgm.append('FREAD')
@@ -173,7 +222,7 @@ class storeexpr:
 
 class closeexpr:
     def __init__(self, tokens):
-        tok = pop(tokens)
+        tok = tokens.advance()
         if tok.label != 'file_close':
             raise CompileException(tok, 'Close expression expected', tok)
         self.file = readref(tokens)
@@ -184,7 +233,7 @@ class closeexpr:
 
 class printexpr:
     def __init__(self, tokens):
-        tok = pop(tokens)
+        tok = tokens.advance()
         if tok.label not in ['print', 'file_write']:
             raise CompileException(tok, 'Expected print or file write', tok)
         
@@ -203,70 +252,77 @@ class printexpr:
             self.value.gen(pgm)
             pgm.append('PRINT')
 
-class mathexpr:
-    def __init__(self, tokens):
-        self.left = addsub(tokens)
-        tok = peek(tokens, False)
-        if tok and tok.label in ('logical_and', 'logical_or'):
-            self.op = pop(tokens).label
-            self.right = mathexpr(tokens)
-        else:
-            self.op = None
-            self.right = None
+class binop:
+    '''
+    Flat, left-associative chain of operators sharing one precedence level:
+    operands[0] ops[0] operands[1] ops[1] ... operands[n].
+    Operands are generated right to left so the left operand is on top of
+    the stack when each operator executes.
+    '''
+    mapping = {}
+
+    def __init__(self, operands, ops):
+        self.operands = operands
+        self.ops = ops
 
     def gen(self, pgm):
-        if not self.op:
-            self.left.gen(pgm)
-        else:
-            mapping = {'local_and': 'AND', 'logical_or': 'OR'}
-            self.right.gen(pgm)
-            self.left.gen(pgm)
-            pgm.append(mapping[self.op])
+        for i in range(len(self.operands) - 1, 0, -1):
+            self.operands[i].gen(pgm)
+        self.operands[0].gen(pgm)
+        for op in self.ops:
+            pgm.append(self.mapping[op])
 
-class addsub:
-    def __init__(self, tokens):
-        self.left = muldiv(tokens)
-        tok = peek(tokens, False)
-        if tok and tok.label in ('add', 'subtract'):
-            self.op = pop(tokens).label
-            self.right = addsub(tokens)
-        else:
-            self.op = None
-            self.right = None
+class addsub(binop):
+    mapping = {'add': 'ADD', 'subtract': 'SUB'}
 
-    def gen(self, pgm):
-        if not self.op:
-            self.left.gen(pgm)
-        else:
-            mapping = {'add': 'ADD', 'subtract': 'SUB'}
-            self.right.gen(pgm)
-            self.left.gen(pgm)
-            pgm.append(mapping[self.op])
+class muldiv(binop):
+    mapping = {'multiply': 'MUL', 'divide': 'DIV', 'modulo': 'MOD'}
+
+class mathexpr(binop):
+    mapping = {'logical_and': 'AND', 'logical_or': 'OR'}
 
-class muldiv:
     def __init__(self, tokens):
-        self.left = prefix(tokens)
-        tok = peek(tokens, False)
-        if tok and tok.label in ('multiply', 'divide', 'modulo'):
-            self.op = pop(tokens).label
-            self.right = muldiv(tokens)
+        '''
+        Precedence climbing without recursion: read the whole
+        prefix (op prefix)* chain in one loop, then fold it level by level
+        from the tightest operators outward. Each level groups runs of its
+        own operators into one flat node, so a chain of any length costs
+        linear time and a fixed number of Python frames.
+        '''
+        operands = [prefix(tokens)]
+        ops = []
+        tok = tokens.peek(False)
+        while tok and tok.label in binaryops:
+            ops.append(tokens.advance().label)
+            operands.append(prefix(tokens))
+            tok = tokens.peek(False)
+
+        for cls in precedence[:0:-1]:
+            operands, ops = groupops(cls, operands, ops)
+        super().__init__(operands, ops)
+
+def groupops(cls, operands, ops):
+    grouped, remaining = [], []
+    run, runops = [operands[0]], []
+    for op, operand in zip(ops, operands[1:]):
+        if op in cls.mapping:
+            run.append(operand)
+            runops.append(op)
         else:
-            self.op = None
-            self.right = None
+            grouped.append(cls(run, runops) if runops else run[0])
+            remaining.append(op)
+            run, runops = [operand], []
+    grouped.append(cls(run, runops) if runops else run[0])
+    return grouped, remaining
 
-    def gen(self, pgm):
-        if not self.op:
-            self.left.gen(pgm)
-        else:
-            mapping = {'multiply': 'MUL', 'divide': 'DIV', 'modulo': 'MOD'}
-            self.right.gen(pgm)
-            self.left.gen(pgm)
-            pgm.append(mapping[self.op])
+# loosest binding level first
+precedence = [mathexpr, addsub, muldiv]
+binaryops = dict((op, cls) for cls in precedence for op in cls.mapping)
 
 class prefix:
     def __init__(self, tokens):
-        if peek(tokens).label in ('invert', 'add'):
-            self.op = pop(tokens).label
+        if tokens.peek().label in ('invert', 'add'):
+            self.op = tokens.advance().label
         else:
             self.op = None
         self.value = value(tokens)
@@ -280,15 +336,16 @@ class prefix:
 
 class value:
     def __init__(self, tokens):
-        if peek(tokens).label == 'load':
+        first = tokens.peek()
+        if tokens.peek().label == 'load':
             self.type = 'load'
             self.value = readref(tokens)
-        elif peek(tokens).label == 'o_square':
+        elif tokens.peek().label == 'o_square':
             self.type = 'list'
             self.value = listgen(tokens)
         else:
             self.value = paren(tokens)
-            tok = peek(tokens, False)
+            tok = tokens.peek(False)
             self.type = 'basic'
             if tok and tok.label == 'roll':
                 self.type = 'roll'
@@ -300,10 +357,19 @@ class value:
         # to the corresponding label after testing it against the repeater
         # provided its a r<critcheck> or ro<critcheck>
         self.modifiers = modifiers(tokens)
+        if (self.modifiers.r or self.modifiers.ro) and self.type != 'roll':
+            raise CompileException(first, 'Only dice rolls can be rerolled')
 
     def gen(self, pgm):
         repeatLabel = genLabel()
-        self.value.gen(pgm)
+        if self.modifiers.r or self.modifiers.ro:
+            # a reroll needs the number of sides, left beneath the dice
+            self.value.genSides(pgm)
+            pgm.append('DUP 1')
+            self.value.genCount(pgm)
+            pgm.append('ROLL')
+        else:
+            self.value.gen(pgm)
         self.modifiers.gen(pgm, repeatLabel)
 
 class modifiers:
@@ -318,9 +384,9 @@ class modifiers:
         self.r = None
         self.critcheck = None
         self.keepdiscard = []
-        token = peek(tokens, False)
+        token = tokens.peek(False)
         while token and token.label in keys:
-            mod = pop(tokens).label
+            mod = tokens.advance().label
             if mod == 'sort':
                 if self.sort or self.sortd:
                     raise CompileException(token, 'Only 1 sort allowed per expression')
@@ -332,22 +398,19 @@ class modifiers:
             elif mod == 'repeat':
                 if self.r or self.ro:
                     raise CompileException(token, 'Only 1 repeat allowed per expression')
-                if peek(tokens).value in '><=':
-                    self.r = critcheck(tokens)
-                else:
-                    self.r = paren(tokens)
+                self.r = rerollcheck(tokens)
             elif mod == 'repeat_once':
                 if self.r or self.ro:
                     raise CompileException(token, 'Only 1 repeat allowed per expression')
-                self.ro = critcheck(tokens)
+                self.ro = rerollcheck(tokens)
             elif mod in ['less_than', 'greater_than', 'equals']:
                 # critcheck
                 if self.critcheck:
                     raise CompileException(token, 'Only 1 crit check allowed per expression')
                 self.critcheck = critcheck(tokens, token=token)
             else:
-                self.keepdiscard.append(keepdiscard(tokens))
-            token = peek(tokens, False)
+                self.keepdiscard.append(keepdiscard(tokens, token=token))
+            token = tokens.peek(False)
 
     def gen(self, pgm, repeatLabel):
         '''
@@ -365,17 +428,30 @@ class modifiers:
         for kd in self.keepdiscard:
             kd.gen(pgm)
         
-        if self.r:
-            pass
-        if self.ro:
-            pass
-        
+        if self.r or self.ro:
+            op, target = self.reroll()
+            target.gen(pgm)
+            pgm.append(('RO' if self.ro else 'RR') + op)
+
         if self.critcheck:
             self.critcheck.gen(pgm)
 
+    def reroll(self):
+        '''Comparison and target of the r or ro modifier.'''
+        check = self.r or self.ro
+        return rerollOps[check.op], check.value
+
+rerollOps = {'greater_than': 'GT', 'less_than': 'LT', 'equals': 'EQ'}
+
+def rerollcheck(tokens):
+    tok = tokens.peek()
+    if tok.label not in rerollOps:
+        raise CompileException(tok, 'Expected >N, <N or =N after a reroll; repeat counts are not supported', tok)
+    return critcheck(tokens)
+
 class keepdiscard:
-    def __init__(self, tokens):
-        tok = pop(tokens)
+    def __init__(self, tokens, token=None):
+        tok = token or tokens.advance()
         if tok.value not in ('kh', 'kl', 'kf', 'kr', 'dh', 'dl', 'df', 'dr'):
             raise CompileException(tok, 'Expected a keep/discard modifier', tok)
         self.op = tok.value.upper()
@@ -387,7 +463,7 @@ class keepdiscard:
 
 class critcheck:
     def __init__(self, tokens, token=None):
-        if not token: token = pop(tokens)
+        if not token: token = tokens.advance()
         self.op = token.label
         if self.op not in ['greater_than', 'less_than', 'equals']:
             raise CompileException(token, 'Expected crit check', token)
@@ -404,12 +480,12 @@ class critcheck:
 
 class listgen:
     def __init__(self, tokens):
-        if peek(tokens).label != 'o_square':
-            raise CompileException(peek(tokens), 'Expected list generator', peek(tokens))
-        pop(tokens)
+        if tokens.peek().label != 'o_square':
+            raise CompileException(tokens.peek(), 'Expected list generator', tokens.peek())
+        tokens.advance()
         self.value = exprlist(tokens, terminators=['c_square'])
-        if pop(tokens).label != 'c_square':
-            raise CompileException(peek(tokens), 'Expected closing square bracket', peek(tokens))
+        if tokens.advance().label != 'c_square':
+            raise CompileException(tokens.peek(), 'Expected closing square bracket', tokens.peek())
 
     def gen(self, pgm):
         self.value.gen(pgm)
@@ -417,7 +493,7 @@ class listgen:
 
 class storeref:
     def __init__(self, tokens):
-        tok = pop(tokens)
+        tok = tokens.advance()
         if tok.label != 'store':
             raise CompileException(tok, 'Expected write storage reference', tok)
         self.ref = diceroll(tokens)
@@ -429,7 +505,7 @@ class storeref:
 
 class readref:
     def __init__(self, tokens):
-        tok = pop(tokens)
+        tok = tokens.advance()
         if tok.label != 'load':
             raise CompileException(tok, 'Expected read storage reference', tok)
         self.ref = diceroll(tokens)
@@ -446,7 +522,7 @@ class diceroll:
         else:
             self.count = paren(tokens)
             
-        tok = pop(tokens)
+        tok = tokens.advance()
         if tok.label != 'roll':
             raise CompileException(tok, 'Expected dice roll', tok)
         self.sides = paren(tokens)
@@ -466,7 +542,7 @@ class diceroll:
 
 class paren:
     def __init__(self, tokens):
-        tok = pop(tokens)
+        tok = tokens.advance()
         if tok.label == 'number':
             self.type = 'numeric'
             self.inner = tok.value
@@ -476,7 +552,7 @@ class paren:
             raise CompileException(tok, "Expected a number or open parenthesis", tok)
         self.type = 'expression'
         self.inner = expr(tokens)
-        tok = pop(tokens)
+        tok = tokens.advance()
         if tok.label != 'c_paren':
             raise CompileException(tok, "Expected a closing parenthesis", tok)
 
@@ -485,3 +561,24 @@ class paren:
             pgm.append('PUSH {}'.format(self.inner))
         else:
             self.inner.gen(pgm)
+
+class literal:
+    '''
+    Constant produced by the folding pass: an int, or a tuple of dice for a
+    list. Never made by the parser itself.
+    '''
+    def __init__(self, value, span=None):
+        self.value = value
+        # kept from the expression it replaced, for the source map
+        self.span = span
+
+    def gen(self, pgm):
+        located(self.span, self.genValue, pgm)
+
+    def genValue(self, pgm):
+        if type(self.value) is int:
+            pgm.append('PUSH {}'.format(self.value))
+        else:
+            for die in self.value:
+                pgm.append('PUSH {}'.format(die))
+            pgm.append('MLIST {}'.format(len(self.value)))
@@ -0,0 +1,173 @@
+'''
+Run compiled programs on a process pool.
+
+    python runner.py [options] file.d20 [file.d20 ...]
+
+Each file is compiled once in the parent and run in a worker. With
+--trials N a single file is instead run N times, split into shards of
+--shard trials each. Shard i draws from the generator for path (i,) of
+the master seed (see rng.py), so results depend only on the seed and
+the shard size, never on the number of workers or on scheduling.
+'''
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import sys
+import time
+
+from compiler import compile
+from bytecode import dumps, loads, execute, Machine
+from rng import generators, entropy
+from values import RuntimeException
+
+# set in each worker by the pool initializer, so the program crosses the
+# process boundary once instead of with every task
+shipped = None
+
+class Result:
+    def __init__(self, name, index, output, slots, error):
+        self.name = name
+        self.index = index
+        self.output = output
+        self.slots = slots
+        self.error = error
+
+    def __repr__(self):
+        return '<Result {} #{}{}>'.format(self.name, self.index,
+                                           ' error' if self.error else '')
+
+def runOne(program, rng, name, index):
+    out = io.StringIO()
+    error = None
+    vm = Machine(rng)
+    try:
+        with contextlib.redirect_stdout(out):
+            execute(program, vm)
+    except (RuntimeException, EOFError) as e:
+        error = str(e)
+    return Result(name, index, out.getvalue(), vm.heap.todict(), error)
+
+def shardRNG(generator, seed, shard):
+    return generators[generator](seed, path=(shard,))
+
+def initWorker(data):
+    global shipped
+    shipped = loads(data)
+
+def runShard(task):
+    shard, start, count, generator, seed, name = task
+    rng = shardRNG(generator, seed, shard)
+    return [runOne(shipped, rng, name, i) for i in range(start, start + count)]
+
+def runFile(task):
+    index, name, data, generator, seed = task
+    return runOne(loads(data), shardRNG(generator, seed, index), name, index)
+
+def defaultWorkers():
+    return os.cpu_count() or 1
+
+def runTrials(program, trials, workers=None, shard=1000, ordered=True,
+              seed=None, generator='mt', name='<program>'):
+    '''
+    Run one compiled program `trials` times. Yields Results, in trial order
+    if `ordered`, otherwise shard by shard as they finish.
+    '''
+    if seed is None:
+        seed = entropy()
+    tasks = [(i, start, min(shard, trials - start), generator, seed, name)
+             for i, start in enumerate(range(0, trials, shard))]
+    with multiprocessing.Pool(workers or defaultWorkers(), initWorker,
+                              (dumps(program),)) as pool:
+        mapper = pool.imap if ordered else pool.imap_unordered
+        for results in mapper(runShard, tasks):
+            yield from results
+
+def runFiles(paths, workers=None, ordered=True, seed=None, generator='mt', cache=True):
+    '''
+    Compile every file and run each once in the pool. Compile errors are
+    raised here, before anything runs.
+    '''
+    if seed is None:
+        seed = entropy()
+    tasks = []
+    for index, path in enumerate(paths):
+        with open(path) as f:
+            tasks.append((index, path, dumps(compile(f.read(), cache)), generator, seed))
+    with multiprocessing.Pool(workers or defaultWorkers()) as pool:
+        mapper = pool.imap if ordered else pool.imap_unordered
+        yield from mapper(runFile, tasks)
+
+def scaling(program, trials, counts=None, shard=1000, seed=0, generator='mt'):
+    '''Throughput of runTrials for each worker count, as a list of dicts.'''
+    if counts is None:
+        counts = []
+        n = 1
+        while n < defaultWorkers():
+            counts.append(n)
+            n *= 2
+        counts.append(defaultWorkers())
+    report = []
+    for workers in counts:
+        start = time.perf_counter()
+        for result in runTrials(program, trials, workers, shard, False, seed, generator):
+            pass
+        elapsed = time.perf_counter() - start
+        report.append({
+            'workers': workers,
+            'seconds': elapsed,
+            'trials_per_second': trials / elapsed,
+            'speedup': report[0]['seconds'] / elapsed if report else 1.0,
+        })
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run D20 programs in parallel.')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('-n', '--trials', type=int, default=None,
+                        help='run a single file this many times')
+    parser.add_argument('--shard', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--generator', choices=sorted(generators), default='mt')
+    parser.add_argument('--unordered', action='store_true',
+                        help='print results as they complete')
+    parser.add_argument('--scale', action='store_true',
+                        help='report throughput for 1, 2, 4 ... workers')
+    args = parser.parse_args(argv)
+
+    seed = entropy() if args.seed is None else args.seed
+    if args.trials is not None or args.scale:
+        if len(args.files) != 1:
+            parser.error('--trials and --scale take exactly one file')
+        with open(args.files[0]) as f:
+            program = compile(f.read())
+        trials = args.trials or 10000
+        if args.scale:
+            counts = [args.workers] if args.workers else None
+            for row in scaling(program, trials, counts, args.shard, seed, args.generator):
+                print('{workers:>4} workers  {seconds:8.3f}s  {trials_per_second:12,.0f} trials/s'
+                      '  x{speedup:.2f}'.format(**row))
+            return 0
+        results = runTrials(program, trials, args.workers, args.shard,
+                            not args.unordered, seed, args.generator, args.files[0])
+    else:
+        results = runFiles(args.files, args.workers, not args.unordered, seed, args.generator)
+
+    failed = 0
+    start = time.perf_counter()
+    count = 0
+    for result in results:
+        count += 1
+        sys.stdout.write(result.output)
+        if result.error:
+            failed += 1
+            sys.stderr.write('{} #{}: {}\n'.format(result.name, result.index, result.error))
+    elapsed = time.perf_counter() - start
+    sys.stderr.write('{} runs in {:.3f}s ({:,.0f}/s), seed {}\n'.format(
+        count, elapsed, count / elapsed if elapsed else 0, seed))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+import argparse
+import sys
+
+from tokenizer import scan
+from parser import CompileException, Listing, expr
+from incremental import Chunks, fragment
+from bytecode import assemble, execute, Machine
+from values import RuntimeException
+
+'''
+Streaming compile and run, for piped or unbounded input.
+
+    python streaming.py [file]          # source from stdin without a file
+
+Source is read a line at a time and tokenized as it arrives. Each top
+level expression is parsed, compiled and run as soon as it is complete,
+against one machine whose dice slots, generator and open files persist
+from one expression to the next. Nothing but the expression being parsed
+is held in memory, so a script can be arbitrarily long, or never end.
+
+An expression is complete once the token after it has been read (or the
+input has ended), since until then it might still continue: "1d6" at the
+end of one line and "+2" at the start of the next are one expression.
+
+An expression that fails to compile or run is reported on stderr with its
+line, and the stream carries on: after a compile error, from the line
+following the error; after a runtime error, with the next expression, on
+the same machine with its stack cleared. The exit status is 1 if anything
+failed.
+'''
+
+def sourceLines(f):
+    '''Lines of a file or pipe, read only as they are wanted.'''
+    return iter(f.readline, '')
+
+def tokenLines(lines):
+    '''The tokens of each line in turn. Tokens never span lines.'''
+    for number, line in enumerate(lines, 1):
+        yield scan(line, line=number)[0]
+
+def expressions(lines, report=None):
+    '''
+    Parse and yield each top level expression as soon as it is complete.
+    Compile errors are raised, or passed to `report` if it is given.
+    '''
+    batches = tokenLines(lines)
+    stream = Chunks(lambda: next(batches, None))
+    while len(stream):
+        try:
+            node = expr(stream)
+        except CompileException as e:
+            if report is None:
+                raise
+            report(str(e))
+            # tokens arrive a line at a time, so this skips the rest of the line
+            stream.pos = len(stream.tokens)
+        else:
+            yield node
+        # drop the tokens already parsed, so memory stays bounded
+        del stream.tokens[:stream.pos]
+        stream.pos = 0
+
+def programs(lines, report=None):
+    '''(line, assembled program) for each top level expression.'''
+    for node in expressions(lines, report):
+        code, spans, labels = fragment(node)
+        yield node.span[0], assemble(Listing(code, spans))
+
+def run(lines, vm=None, report=None):
+    '''
+    Compile and run a stream of source lines expression by expression. With
+    `report`, each error is passed to it as a message and the stream goes
+    on; without, the first error is raised.
+    '''
+    if vm is None:
+        vm = Machine()
+    try:
+        for line, pgm in programs(lines, report):
+            vm.pc = 0
+            try:
+                execute(pgm, vm, close=False)
+            except (RuntimeException, EOFError) as e:
+                if report is None:
+                    raise
+                report('Error line {}: {}'.format(line, e))
+                del vm.stack[:]
+    finally:
+        vm.files.closeAll()
+    return vm
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compile and run D20 source as it is read.')
+    parser.add_argument('file', nargs='?', help='source file, stdin if omitted')
+    args = parser.parse_args(argv)
+    errors = []
+    def report(message):
+        errors.append(message)
+        sys.stdout.flush()
+        sys.stderr.write(message + '\n')
+    if args.file is None:
+        run(sourceLines(sys.stdin), report=report)
+    else:
+        with open(args.file) as f:
+            run(sourceLines(f), report=report)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
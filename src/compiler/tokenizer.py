@@ -42,6 +42,9 @@ class TokenFactory:
     def getMatch(self, inp):
         raise NotImplemented()
 
+    def getPattern(self):
+        raise NotImplemented()
+
     def getToken(self, match, line, col):
         return Token(match, self.ID, self.name, line, col)
 
@@ -58,16 +61,23 @@ class SingleTokenFactory(TokenFactory):
         if inp.startswith(self.chars):
             return DummyMatch(self.chars, len(self.chars))
         return None
+
+    def getPattern(self):
+        return re.escape(self.chars)
     
 
 class ReTokenFactory(TokenFactory):
     def __init__(self, name, regexp):
         super().__init__(name)
+        self.regexp = regexp
         self.pattern = re.compile(regexp)
 
     def getMatch(self, inp):
         return self.pattern.match(inp)
 
+    def getPattern(self):
+        return self.regexp
+
 
 tokens = [ReTokenFactory('comment',r'//.*'),
           SingleTokenFactory('file_open_r', '^'),
@@ -128,42 +138,54 @@ def getfactory(string):
             return factory
     return None
 
+def buildScanner(factories):
+    '''
+    Combine every factory into one precompiled alternation. Alternatives are
+    tried left to right, so the order of `tokens` still decides priority
+    ('?|' before '?', 'ro' before 'r', 'sd' before 's'). Each factory gets a
+    named group 'tN' where N is its index in the list; anything that is not
+    whitespace and where no factory matches is swallowed by the 'unknown'
+    group up to the next position where a token or whitespace begins.
+    '''
+    named = '|'.join('(?P<t%d>%s)' % (i, f.getPattern())
+                     for i, f in enumerate(factories))
+    anonymous = '|'.join('(?:%s)' % f.getPattern() for f in factories)
+    return re.compile(r'(?P<nl>\n)|(?P<ws>[\t \r]+)|%s|(?P<unknown>(?:(?!%s)[^\t \n\r])+)'
+                      % (named, anonymous))
+
+scanner = buildScanner(tokens)
+groupfactory = dict(('t%d' % i, f) for i, f in enumerate(tokens))
+
 def tokenize(string):
+    return scan(string)[0]
+
+def scan(string, pos=0, stop=None, line=1, lineStart=0):
+    '''
+    Tokenize string[pos:], stopping at the first token that starts at or
+    after `stop`. Line numbers carry on from `line`, whose first character
+    is at `lineStart`. Returns the tokens and the (pos, line, lineStart) to
+    resume from, so text can be scanned a piece at a time.
+    '''
     output = []
     unknownId = tokendict['unknown']
+    match = scanner.match
 
-    line, column = 1, 0
-    lastLength = 1
-    
-    while len(string) > 0:
-        char = string[0]
-        column += lastLength
-        if char == '\n':
+    end = len(string)
+    if stop is None or stop > end:
+        stop = end
+
+    while pos < stop:
+        m = match(string, pos)
+        kind = m.lastgroup
+        if kind == 'nl':
             line += 1
-            column = 0
-            
-        if char in '\t \n\r':
-            lastLength = 1
-            string = string[1:]
-            continue
-        
-        factory = getfactory(string)
-        if factory:
-            match = factory.getMatch(string)
-            string = string[match.end():]
-            token = factory.getToken(match, line, column)
-            if token.label != 'comment':
-                output.append(token)
-            lastLength = match.end() 
-        else:
-            # no match, it's an unknown
-            idx = 1
-            while idx < len(string) and not getfactory(string[idx:]) and string[idx] not in '\n\t \r':
-                idx += 1
-
-            match = DummyMatch(string[:idx], idx)
-            output.append(Token(match, unknownId, 'unknown', line, column))
-            string = string[idx:]
-            lastLength = idx
+            lineStart = m.end()
+        elif kind == 'unknown':
+            output.append(Token(m, unknownId, 'unknown', line, pos - lineStart + 1))
+        elif kind != 'ws':
+            factory = groupfactory[kind]
+            if factory.name != 'comment':
+                output.append(factory.getToken(m, line, pos - lineStart + 1))
+        pos = m.end()
             
-    return output
+    return output, (pos, line, lineStart)
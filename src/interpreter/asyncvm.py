@@ -0,0 +1,150 @@
+import asyncio
+import sys
+import weakref
+
+from bytecode import decode, Machine
+from values import String, toText
+from interpeter import openread, openwrite, fileread, fileprint, fileclose
+
+'''
+Async execution. executeAsync runs a program as a coroutine so that many
+sessions can share one event loop: INPUT awaits the machine's input
+stream instead of blocking, and the loop yields to other tasks every
+`slice` instructions. Prints only write; the output is drained once
+HIGH_WATER characters are waiting, before every INPUT so prompts show,
+and when the program ends.
+
+Async handlers are ordinary `async def` handlers. Calling one returns a
+coroutine rather than None or a jump target, which is the dispatch loop's
+cue to await it, so synchronous instructions cost nothing extra.
+
+Streams follow asyncio's StreamReader/StreamWriter: input needs
+`async readline()` (bytes or str), output needs `write(str)` and
+`async drain()`. File instructions run on the loop's default executor,
+so a slow disk does not stall other sessions.
+'''
+
+# instructions between yields to the event loop
+SLICE = 1000
+# characters printed before the output is drained
+HIGH_WATER = 1 << 16
+
+class ConsoleInput:
+    '''Reads stdin on the default executor so the loop keeps running.'''
+    async def readline(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, sys.stdin.readline)
+
+class ConsoleOutput:
+    def write(self, text):
+        sys.stdout.write(text)
+
+    async def drain(self):
+        sys.stdout.flush()
+
+class TextOutput:
+    '''Collects output in memory, e.g. for tests or for sending on later.'''
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    async def drain(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+class AsyncMachine(Machine):
+    __slots__ = ('input', 'unflushed')
+
+    def __init__(self, rng=None, input=None, output=None):
+        super().__init__(rng, output if output is not None else ConsoleOutput())
+        self.input = input if input is not None else ConsoleInput()
+        self.unflushed = 0
+
+async def drain(vm):
+    vm.unflushed = 0
+    await vm.output.drain()
+
+def written(vm, text):
+    '''Write text, handing back a drain to await once enough is waiting.'''
+    vm.output.write(text)
+    vm.unflushed += len(text)
+    if vm.unflushed >= HIGH_WATER:
+        return drain(vm)
+
+async def getinp(vm, arg):
+    if vm.unflushed:
+        await drain(vm)
+    line = await vm.input.readline()
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    if not line:
+        raise EOFError('EOF when reading a line')
+    vm.stack.append(String(line[:-1] if line.endswith('\n') else line))
+
+def prnt(vm, arg):
+    return written(vm, toText(vm.stack[-1]))
+
+def printpop(vm, arg):
+    return written(vm, toText(vm.stack.pop()))
+
+def printtext(vm, arg):
+    return written(vm, arg[0])
+
+def offload(fn):
+    async def handler(vm, arg):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, fn, vm, arg)
+    return handler
+
+asyncHandlers = {
+    'INPUT': getinp,
+    'PRINT': prnt,
+    'PRINTPOP': printpop,
+    'PRINTS': printtext,
+    'OPENR': offload(openread),
+    'OPENW': offload(openwrite),
+    'FREAD': offload(fileread),
+    'FPRINT': offload(fileprint),
+    'CLOSE': offload(fileclose),
+}
+
+tables = weakref.WeakKeyDictionary()
+
+async def executeAsync(pgm, vm=None, slice=SLICE):
+    if vm is None:
+        vm = AsyncMachine()
+    table = tables.get(pgm)
+    if table is None:
+        table = tables[pgm] = decode(pgm, asyncHandlers)
+    end = len(table)
+    pc = vm.pc
+    budget = slice
+    try:
+        while pc < end:
+            fn, arg = table[pc]
+            jump = fn(vm, arg)
+            if jump is None:
+                pc += 1
+            elif type(jump) is int:
+                pc = jump
+            else:
+                jump = await jump
+                pc = pc + 1 if jump is None else jump
+            budget -= 1
+            if not budget:
+                budget = slice
+                await asyncio.sleep(0)
+    except BaseException:
+        vm.files.closeAll()
+        raise
+    finally:
+        vm.pc = pc
+    if vm.unflushed:
+        await drain(vm)
+    if pc >= end:
+        vm.files.closeAll()
+    return vm
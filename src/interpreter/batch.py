@@ -0,0 +1,712 @@
+import gc
+from operator import add, sub, mul
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from bytecode import opcodes
+from dice import truncated
+from rng import makeRNG
+from values import RuntimeException, toChar
+import interpeter
+
+'''
+Batched Monte Carlo execution: one program, N independent trials, every
+instruction dispatched once for a whole group of trials.
+
+Stack entries and dice slots hold one of
+    int     the same value in every trial (constants stay this way)
+    Vector  one number per trial
+    Matrix  one row of dice per trial, every row the same length
+Trials that need different control flow - a JMPZ that is true for some and
+false for others, a roll whose dice count differs, a memory reference at
+different slots - are partitioned into groups that carry on separately, so
+each group always agrees on the program counter. Groups are run lowest
+program counter first, and groups that arrive at the same instruction with
+stacks of the same shape (at the end of a conditional, typically) are
+joined back into one, so a chain of random conditionals does not multiply
+the number of groups. Groups split by an instruction that then runs again
+in each of them (a roll, a keep or a memory reference) are only joined
+once they have got past it, or they would just split there again.
+'''
+
+class Vector:
+    __slots__ = ('v',)
+
+    def __init__(self, v):
+        self.v = v
+
+class Matrix:
+    __slots__ = ('rows', 'width')
+
+    def __init__(self, rows, width):
+        self.rows = rows
+        self.width = width
+
+class Fork(Exception):
+    '''Raised by a handler, before it changes anything, to split the group.'''
+    def __init__(self, keys, targets=None):
+        self.keys = keys
+        self.targets = targets
+
+class ListBackend:
+    '''Plain Python lists; vectors are lists, matrices are lists of rows.'''
+    def __init__(self, seed, generator='mt'):
+        self.rng = makeRNG(generator, seed)
+
+    def broadcast(self, value, n):
+        return [value] * n
+
+    def binary(self, op, a, b):
+        return [op(x, y) for x, y in zip(a, b)]
+
+    def nonzero(self, a):
+        return [1 if x else 0 for x in a]
+
+    def rowsum(self, rows):
+        return [sum(row) for row in rows]
+
+    def unique(self, a):
+        first = a[0]
+        for x in a:
+            if x != first:
+                return None
+        return first
+
+    def groups(self, keys):
+        out = {}
+        for i, k in enumerate(keys):
+            out.setdefault(k, []).append(i)
+        return out.items()
+
+    def take(self, a, positions):
+        return [a[i] for i in positions]
+
+    def concat(self, parts):
+        out = []
+        for part in parts:
+            out.extend(part)
+        return out
+
+    def roll(self, n, count, sides):
+        if type(sides) is int:
+            flat = self.rng.integers(n * count, sides)
+            return [flat[i*count:(i+1)*count] for i in range(n)]
+        return [self.rng.integers(count, s) for s in sides]
+
+    def columns(self, cols, n):
+        # cols: list of vectors, ints or matrices (spliced in)
+        rows = [[] for i in range(n)]
+        for col in cols:
+            if type(col) is int:
+                for row in rows:
+                    row.append(col)
+            elif type(col) is Vector:
+                for row, x in zip(rows, col.v):
+                    row.append(x)
+            else:
+                for row, r in zip(rows, col.rows):
+                    row.extend(r)
+        return rows
+
+    def column(self, rows, j):
+        return [row[j] for row in rows]
+
+    def rowmap(self, fn, rows):
+        return [fn(row) for row in rows]
+
+    def crit(self, op, rows, target):
+        if type(target) is int:
+            targets = [target] * len(rows)
+        else:
+            targets = target
+        if op == 'gt':
+            return [[1 if d > t else 0 for d in row] for row, t in zip(rows, targets)]
+        if op == 'lt':
+            return [[1 if d < t else 0 for d in row] for row, t in zip(rows, targets)]
+        return [[1 if d == t else 0 for d in row] for row, t in zip(rows, targets)]
+
+    def reroll(self, op, rows, sides, target, once):
+        reroll = self.rng.dice.reroll
+        out = []
+        for row in rows:
+            row = reroll(row, sides, op, target, once)
+            if row is None:
+                return None
+            out.append(list(row))
+        return out
+
+    def tolist(self, a):
+        return list(a)
+
+    def randbits(self, n):
+        getrandbits = self.rng.getrandbits
+        return [getrandbits(31) for i in range(n)]
+
+    def seed(self, value):
+        self.rng.seed(value)
+
+class NumpyBackend:
+    '''Vectors are int64 arrays, matrices are (trials, dice) int64 arrays.'''
+    def __init__(self, seed):
+        self.gen = numpy.random.default_rng(seed)
+
+    def broadcast(self, value, n):
+        return numpy.full(n, value, dtype=numpy.int64)
+
+    def binary(self, op, a, b):
+        if op is add:
+            return a + b
+        if op is sub:
+            return a - b
+        if op is mul:
+            return a * b
+        return numpy.frompyfunc(op, 2, 1)(a, b).astype(numpy.int64)
+
+    def nonzero(self, a):
+        return (a != 0).astype(numpy.int64)
+
+    def rowsum(self, rows):
+        return rows.sum(axis=1)
+
+    def unique(self, a):
+        first = a[0]
+        if (a == first).all():
+            return int(first)
+        return None
+
+    def groups(self, keys):
+        keys = numpy.asarray(keys)
+        return [(int(k), numpy.nonzero(keys == k)[0]) for k in numpy.unique(keys)]
+
+    def take(self, a, positions):
+        return a[positions]
+
+    def concat(self, parts):
+        return numpy.concatenate(parts)
+
+    def roll(self, n, count, sides):
+        if type(sides) is int:
+            if sides == 0:
+                return numpy.zeros((n, count), dtype=numpy.int64)
+            return self.gen.integers(1, sides + 1, size=(n, count), dtype=numpy.int64)
+        high = numpy.maximum(sides, 1)[:, None] + 1
+        rolled = self.gen.integers(1, high, size=(n, count), dtype=numpy.int64)
+        return rolled * (sides > 0)[:, None]
+
+    def columns(self, cols, n):
+        parts = []
+        for col in cols:
+            if type(col) is int:
+                parts.append(numpy.full((n, 1), col, dtype=numpy.int64))
+            elif type(col) is Vector:
+                parts.append(col.v[:, None])
+            else:
+                parts.append(col.rows)
+        if not parts:
+            return numpy.zeros((n, 0), dtype=numpy.int64)
+        return numpy.concatenate(parts, axis=1)
+
+    def column(self, rows, j):
+        return rows[:, j]
+
+    def rowmap(self, fn, rows):
+        return numpy.array([fn(list(row)) for row in rows.tolist()], dtype=numpy.int64)
+
+    def crit(self, op, rows, target):
+        if type(target) is not int:
+            target = target[:, None]
+        if op == 'gt':
+            return (rows > target).astype(numpy.int64)
+        if op == 'lt':
+            return (rows < target).astype(numpy.int64)
+        return (rows == target).astype(numpy.int64)
+
+    def reroll(self, op, rows, sides, target, once):
+        matched = self.crit(op, rows, target).astype(bool)
+        if not matched.any():
+            return rows
+        n, count = rows.shape
+        if once:
+            new = self.roll(n, count, sides)
+        else:
+            die = truncated(sides, op, target)
+            if die is None:
+                return None
+            faces, fn = die
+            new = self.roll(n, count, faces)
+            if fn is not None:
+                new = fn(new)
+        return numpy.where(matched, new, rows)
+
+    def tolist(self, a):
+        return a.tolist()
+
+    def randbits(self, n):
+        return self.gen.integers(0, 2**31, size=n, dtype=numpy.int64)
+
+    def seed(self, value):
+        self.gen = numpy.random.default_rng(value)
+
+class Trials:
+    '''A group of trials that share a program counter.'''
+    def __init__(self, backend, index, pc, stack, memory, last):
+        self.B = backend
+        self.index = index
+        self.n = len(index)
+        self.pc = pc
+        self.stack = stack
+        self.memory = memory
+        self.last = last
+        self.outputs = None
+        # pc of the instruction this group was split by and has to re-run
+        self.held = None
+
+    def vector(self, value):
+        '''Per-trial numbers for any value (sums matrices).'''
+        if type(value) is int:
+            return self.B.broadcast(value, self.n)
+        if type(value) is Vector:
+            return value.v
+        return self.B.rowsum(value.rows)
+
+    def number(self, value):
+        if type(value) is int:
+            return value
+        if type(value) is Vector:
+            return value
+        return Vector(self.B.rowsum(value.rows))
+
+    def uniform(self, depth):
+        '''Value at stack[-depth] if it is the same in every trial, else fork on it.'''
+        value = self.stack[-depth]
+        if type(value) is int:
+            return value
+        keys = self.vector(value)
+        u = self.B.unique(keys)
+        if u is None:
+            raise Fork(keys)
+        return u
+
+    def matrix(self, value):
+        if type(value) is Matrix:
+            return value
+        return Matrix(self.B.columns([value], self.n), 1)
+
+    def take(self, value, positions):
+        if type(value) is int:
+            return value
+        if type(value) is Vector:
+            return Vector(self.B.take(value.v, positions))
+        return Matrix(self.B.take(value.rows, positions), value.width)
+
+    def split(self, fork):
+        out = []
+        for key, positions in self.B.groups(fork.keys):
+            pc = self.pc if fork.targets is None else fork.targets[key]
+            t = Trials(self.B, self.B.take(self.index, positions), pc,
+                       [self.take(v, positions) for v in self.stack],
+                       dict((slot, self.take(v, positions)) for slot, v in self.memory.items()),
+                       None if self.last is None else self.take(self.last, positions))
+            t.outputs = self.outputs
+            if fork.targets is None:
+                t.held = self.pc
+            out.append(t)
+        return out
+
+    def shape(self):
+        return tuple(v.width if type(v) is Matrix else None for v in self.stack)
+
+def join(groups):
+    '''One group of all the given ones, which share a pc and a stack shape.'''
+    if len(groups) == 1:
+        return groups[0]
+    B = groups[0].B
+
+    def merge(values, numbers=False):
+        if all(type(v) is int for v in values) and len(set(values)) == 1:
+            return values[0]
+        if not numbers and type(values[0]) is Matrix:
+            return Matrix(B.concat([v.rows for v in values]), values[0].width)
+        return Vector(B.concat([g.vector(v) for g, v in zip(groups, values)]))
+
+    stack = [merge(values) for values in zip(*[g.stack for g in groups])]
+    slots = set()
+    for g in groups:
+        slots.update(g.memory)
+    memory = dict((slot, merge([g.memory.get(slot, 0) for g in groups])) for slot in slots)
+    last = None
+    if any(g.last is not None for g in groups):
+        # only ever totalled, so lists of different lengths join as numbers
+        last = merge([0 if g.last is None else g.last for g in groups], numbers=True)
+    t = Trials(B, B.concat([g.index for g in groups]), groups[0].pc, stack, memory, last)
+    t.outputs = groups[0].outputs
+    return t
+
+def gather(groups):
+    '''Join the groups whose stacks have the same shape.'''
+    shapes = {}
+    for g in groups:
+        shapes.setdefault(g.shape(), []).append(g)
+    return [join(same) for same in shapes.values()]
+
+def arith(op):
+    def handler(t, arg):
+        stack = t.stack
+        left = t.number(stack.pop())
+        right = t.number(stack.pop())
+        if type(left) is int and type(right) is int:
+            stack.append(op(left, right))
+        else:
+            stack.append(Vector(t.B.binary(op, t.vector(left), t.vector(right))))
+    return handler
+
+def checked(op):
+    def fn(x, y):
+        if y == 0:
+            raise RuntimeException('Division by zero')
+        return op(x, y)
+    return fn
+
+def logical(test):
+    return arith(lambda x, y: 1 if test(x, y) else 0)
+
+def pushnum(t, num):
+    t.stack.append(num)
+
+def pop(t, num):
+    for i in range(max(num, 1)):
+        t.last = t.stack.pop()
+
+def dup(t, num):
+    for i in range(num):
+        t.stack.append(t.stack[-1])
+
+def nop(t, arg):
+    pass
+
+def goto(t, addr):
+    return addr
+
+def truth(t, value):
+    value = t.number(value)
+    if type(value) is int:
+        return value != 0
+    keys = t.B.nonzero(value.v)
+    u = t.B.unique(keys)
+    if u is None:
+        return keys
+    return u == 1
+
+def jumpzero(t, addr):
+    test = truth(t, t.stack[-1])
+    if test is True:
+        return None
+    if test is False:
+        return addr
+    raise Fork(test, {1: t.pc + 1, 0: addr})
+
+def gotoif(t, addr):
+    test = truth(t, t.stack[-1])
+    if test is True or test is False:
+        t.stack.pop()
+        return addr if test else None
+    # the forked groups re-run this instruction and pop it themselves
+    raise Fork(test)
+
+def total(t, arg):
+    t.stack.append(t.number(t.stack.pop()))
+
+def roll(t, arg):
+    count = t.uniform(1)
+    stack = t.stack
+    sides = t.number(stack[-2])
+    lowest = sides if type(sides) is int else min(t.B.tolist(sides.v))
+    if count < 0 or lowest < 0:
+        raise RuntimeException('Cannot roll {}d{}'.format(count, lowest))
+    del stack[-2:]
+    if type(sides) is Vector:
+        sides = sides.v
+    stack.append(Matrix(t.B.roll(t.n, count, sides), count))
+
+def makelist(t, num):
+    stack = t.stack
+    cols = stack[len(stack) - num:] if num else []
+    del stack[len(stack) - num:]
+    width = sum(c.width if type(c) is Matrix else 1 for c in cols)
+    stack.append(Matrix(t.B.columns(cols, t.n), width))
+
+def loadslots(t, arg):
+    count = t.uniform(1)
+    start = t.uniform(2)
+    if start < 0 or count < 0:
+        raise RuntimeException('Invalid memory reference {}d{}'.format(count, start))
+    del t.stack[-2:]
+    memory = t.memory
+    cols = [memory.get(slot, 0) for slot in range(start, start + count)]
+    t.stack.append(Matrix(t.B.columns(cols, t.n), count))
+
+def storeslots(t, arg):
+    count = t.uniform(1)
+    start = t.uniform(2)
+    if start < 0 or count < 0:
+        raise RuntimeException('Invalid memory reference {}d{}'.format(count, start))
+    del t.stack[-2:]
+    value = t.stack[-1]
+    if type(value) is Matrix:
+        for j in range(min(count, value.width)):
+            t.memory[start + j] = Vector(t.B.column(value.rows, j))
+    elif count:
+        t.memory[start] = t.number(value)
+
+def pushvar(t, slot):
+    t.stack.append(t.memory.get(slot, 0))
+
+def popvar(t, slot):
+    t.memory[slot] = t.number(t.stack.pop())
+
+def savevar(t, slot):
+    t.memory[slot] = t.number(t.stack[-1])
+
+def rowop(select):
+    def handler(t, arg):
+        n = t.uniform(1)
+        t.stack.pop()
+        m = t.matrix(t.stack.pop())
+        rows = t.B.rowmap(lambda row: select(row, n), m.rows)
+        width = len(select(list(range(m.width)), n))
+        t.stack.append(Matrix(rows, width))
+    return handler
+
+def sortrows(reverse):
+    def handler(t, arg):
+        m = t.matrix(t.stack.pop())
+        t.stack.append(Matrix(t.B.rowmap(lambda row: sorted(row, reverse=reverse), m.rows), m.width))
+    return handler
+
+def crit(op):
+    def handler(t, arg):
+        target = t.number(t.stack.pop())
+        m = t.matrix(t.stack.pop())
+        if type(target) is Vector:
+            target = target.v
+        t.stack.append(Matrix(t.B.crit(op, m.rows, target), m.width))
+    return handler
+
+def reroll(op, once):
+    def handler(t, arg):
+        target = t.uniform(1)
+        # the copy of the roll's sides the compiler leaves beneath the dice
+        sides = t.uniform(3)
+        stack = t.stack
+        m = t.matrix(stack[-2])
+        rows = t.B.reroll(op, m.rows, sides, target, once)
+        if rows is None:
+            raise RuntimeException('Every face of a d{} would be rerolled'.format(sides))
+        del stack[-3:]
+        stack.append(Matrix(rows, m.width))
+    return handler
+
+def prnt(t, arg):
+    value = t.stack[-1]
+    outputs = t.outputs
+    index = t.B.tolist(t.index)
+    if type(value) is int:
+        text = toChar(value)
+        for trial in index:
+            outputs[trial].append(text)
+    elif type(value) is Vector:
+        for trial, x in zip(index, t.B.tolist(value.v)):
+            outputs[trial].append(toChar(x))
+    else:
+        for trial, row in zip(index, t.B.tolist(value.rows)):
+            outputs[trial].append(''.join(toChar(x) for x in row))
+
+def length(t, arg):
+    value = t.stack.pop()
+    t.stack.append(value.width if type(value) is Matrix else 1)
+
+def rand(t, arg):
+    t.stack.append(Vector(t.B.randbits(t.n)))
+
+def seed(t, arg):
+    value = t.uniform(1)
+    t.stack.pop()
+    t.B.seed(value)
+
+def constpair(handler):
+    '''Fused instruction: push both constants, then run the plain handler.'''
+    def fused(t, arg):
+        count, start = arg
+        t.stack.append(start)
+        t.stack.append(count)
+        return handler(t, None)
+    return fused
+
+def printtext(t, arg):
+    text, start = arg
+    outputs = t.outputs
+    for trial in t.B.tolist(t.index):
+        outputs[trial].append(text)
+    # the value of a constant print is the total of its character codes; see
+    # compiler.prints for start
+    codes = sum(map(ord, text[max(start, 0):]))
+    if start >= 0 or t.last is None:
+        t.last = codes
+    else:
+        last = t.number(t.last)
+        if type(last) is int:
+            t.last = last + codes
+        else:
+            t.last = Vector(t.B.binary(add, last.v, t.B.broadcast(codes, t.n)))
+
+def printpop(t, arg):
+    prnt(t, arg)
+    pop(t, 1)
+
+def unary(fn):
+    def handler(t, arg):
+        value = t.number(t.stack.pop())
+        if type(value) is int:
+            t.stack.append(fn(value))
+        else:
+            t.stack.append(Vector(t.B.binary(lambda x, y: fn(x), value.v, value.v)))
+    return handler
+
+def exponent(base, exp):
+    if exp < 0:
+        raise RuntimeException('Negative exponent')
+    return base ** exp
+
+handlers = {
+    'NOP': nop,
+    'ADD': arith(add), 'SUB': arith(sub), 'MUL': arith(mul),
+    'DIV': arith(checked(lambda x, y: x // y)), 'MOD': arith(checked(lambda x, y: x % y)),
+    'AND': logical(lambda x, y: x and y), 'OR': logical(lambda x, y: x or y),
+    'XOR': logical(lambda x, y: bool(x) != bool(y)),
+    'NOT': unary(lambda x: 0 if x else 1), 'INV': unary(lambda x: 0 if x else 1),
+    'LT': logical(lambda x, y: x < y), 'LTE': logical(lambda x, y: x <= y),
+    'GT': logical(lambda x, y: x > y), 'GTE': logical(lambda x, y: x >= y),
+    'EQ': logical(lambda x, y: x == y), 'NE': logical(lambda x, y: x != y),
+    'PUSH': pushnum, 'POP': pop, 'DUP': dup,
+    'PUSHVAR': pushvar, 'POPVAR': popvar, 'SAVEVAR': savevar,
+    'JMP': goto, 'JMPZ': jumpzero, 'GOTOIF': gotoif,
+    'SUM': total, 'FLOOR': total, 'CEIL': total,
+    'INC': unary(lambda x: x + 1), 'DEC': unary(lambda x: x - 1),
+    'POW': arith(exponent), 'LEN': length,
+    'RAND': rand, 'SEED': seed,
+    'ROLL': roll, 'MLIST': makelist,
+    'PUSHV': loadslots, 'POPV': storeslots,
+    'SORTA': sortrows(False), 'SORTD': sortrows(True),
+    'KH': rowop(lambda dice, n: interpeter.keep(dice, interpeter.ranked(dice, n, True))),
+    'KL': rowop(lambda dice, n: interpeter.keep(dice, interpeter.ranked(dice, n, False))),
+    'KF': rowop(lambda dice, n: list(dice[:max(n, 0)])),
+    'KR': rowop(lambda dice, n: list(dice[max(len(dice) - n, 0):]) if n > 0 else []),
+    'DH': rowop(lambda dice, n: interpeter.discard(dice, interpeter.ranked(dice, n, True))),
+    'DL': rowop(lambda dice, n: interpeter.discard(dice, interpeter.ranked(dice, n, False))),
+    'DF': rowop(lambda dice, n: list(dice[max(n, 0):])),
+    'DR': rowop(lambda dice, n: list(dice[:max(len(dice) - n, 0)]) if n > 0 else list(dice)),
+    'CCGT': crit('gt'), 'CCLT': crit('lt'), 'CCEQ': crit('eq'),
+    'RRGT': reroll('gt', False), 'RRLT': reroll('lt', False), 'RREQ': reroll('eq', False),
+    'ROGT': reroll('gt', True), 'ROLT': reroll('lt', True), 'ROEQ': reroll('eq', True),
+    'PRINT': prnt,
+    'ROLLC': constpair(roll), 'PUSHVC': constpair(loadslots), 'POPVC': constpair(storeslots),
+    'PRINTPOP': printpop, 'PRINTS': printtext,
+}
+
+def unsupported(op):
+    def handler(t, arg):
+        raise RuntimeException('Instruction {} is not supported in batch mode'.format(op.name))
+    return handler
+
+def decode(pgm):
+    table = []
+    for i in range(len(pgm)):
+        op = opcodes[pgm.code[2*i]]
+        table.append((handlers.get(op.name) or unsupported(op), pgm.operand(i)))
+    return table
+
+class BatchResult:
+    def __init__(self, trials, backend):
+        self.trials = trials
+        self.B = backend
+        self.values = [0] * trials
+        self.memory = {}
+        self.outputs = [[] for i in range(trials)]
+
+    def scatter(self, target, group, value):
+        numbers = group.B.tolist(group.vector(value))
+        for trial, x in zip(group.B.tolist(group.index), numbers):
+            target[trial] = x
+
+    def collect(self, group):
+        if group.last is not None:
+            self.scatter(self.values, group, group.last)
+        for slot, value in group.memory.items():
+            if slot not in self.memory:
+                self.memory[slot] = [0] * self.trials
+            self.scatter(self.memory[slot], group, value)
+
+    def slot(self, slot):
+        '''Final contents of a dice slot, one number per trial.'''
+        return self.memory.get(slot, [0] * self.trials)
+
+    def output(self, trial):
+        return ''.join(self.outputs[trial])
+
+def simulate(pgm, trials, seed=None, usenumpy=True, generator='mt'):
+    '''
+    Run a compiled program `trials` times at once. The result holds, per
+    trial, the total of the last top-level expression (values), the final
+    dice slots (slot) and everything printed (output). `generator` picks
+    the rng.py generator used when NumPy is not.
+    '''
+    if usenumpy and numpy is not None:
+        backend = NumpyBackend(seed)
+        index = numpy.arange(trials)
+    else:
+        backend = ListBackend(seed, generator)
+        index = list(range(trials))
+    table = decode(pgm)
+    end = len(table)
+    result = BatchResult(trials, backend)
+
+    # the list backend allocates a list per trial for every row of dice, and
+    # none of them can form a cycle, so collections would only cost time
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        pending = [Trials(backend, index, 0, [], {}, None)]
+        pending[0].outputs = result.outputs
+        while pending:
+            pc = min(g.pc for g in pending)
+            here = [g for g in pending if g.pc == pc and g.n]
+            groups = (gather([g for g in here if g.held != pc]) +
+                      [g for g in here if g.held == pc])
+            pending = [g for g in pending if g.pc != pc] + groups[1:]
+            if not groups:
+                continue
+            group = groups[0]
+            # run until another group is waiting at the instruction reached
+            stop = min([g.pc for g in pending if g.pc > pc] + [end])
+            try:
+                while pc < stop:
+                    fn, arg = table[pc]
+                    group.pc = pc
+                    jump = fn(group, arg)
+                    pc = pc + 1 if jump is None else jump
+            except Fork as fork:
+                pending.extend(group.split(fork))
+                continue
+            if pc >= end:
+                result.collect(group)
+            else:
+                group.pc = pc
+                group.held = None
+                pending.append(group)
+    finally:
+        if collecting:
+            gc.enable()
+    return result
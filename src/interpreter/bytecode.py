@@ -1,84 +1,488 @@
+import json
+import struct
+import sys
+import zlib
+from array import array
 
+from interpeter import *
+from memory import Stack, Heap
+from rng import MersenneTwister
+from writer import Writer
+from files import FileTable
+from values import RuntimeException
 
-OpCodes = [
-    'NOP',
-    'ADD',
-    'SUB',
-    'MUL',
-    'DIV',
-    'MOD',
-    'AND',
-    'OR',
-    'NOT',
-    'LIST',
-    'SUM',
-    'LOAD',
-]
+# operand kinds
+NOARG = 0     # no operand, encoded as 0
+CONST = 1     # index into the constant pool
+LABEL = 2     # absolute instruction index of a jump target
+IMMED = 3     # small integer stored inline
+PAIR = 4      # two consecutive entries in the constant pool, the second an integer
 
 class OpCode:
     nextId = 0
     
-    def __init__(self, name, fn, nargs=0):
+    def __init__(self, name, fn=None, nargs=0, operand=None):
         self.bin = OpCode.nextId
         OpCode.nextId += 1
         self.name = name
         self.nargs = nargs
         self.fn = fn
+        if operand is None:
+            operand = IMMED if nargs else NOARG
+        self.operand = operand
 
-    def exec(self, stack, heap, *args):
-        if args:
-            return self.fn(stack, heap, *args)
-        else:
-            return self.fn(stack, heap)
+    def exec(self, vm, arg=0):
+        return self.fn(vm, arg)
 
-opcodes = [OpCode('NOP'), OpCode('ADD',add),OpCode('SUB',sub),OpCode('MUL',mul),
+opcodes = [OpCode('NOP',nop), OpCode('ADD',add),OpCode('SUB',sub),OpCode('MUL',mul),
            OpCode('DIV',div),OpCode('AND',b_and),OpCode('OR',b_or),
            OpCode('XOR',b_xor),OpCode('NOT',b_not),OpCode('PUSHVAR',pushvar,1),
-           OpCode('POPVAR',popvar,1),OpCode('PUSHNUM',pushnum,1),
-           OpCode('PUSHSTR',pushstr,1),OpCode('DUP',dup,1),OpCode('POP',pop,1),
-           OpCode('MAKELST',makelist),OpCode('SEED',seed),OpCode('RAND',rand),
+           OpCode('POPVAR',popvar,1),OpCode('PUSH',pushnum,1,CONST),
+           OpCode('PUSHSTR',pushstr,1,CONST),OpCode('DUP',dup,1),OpCode('POP',pop,1),
+           OpCode('MLIST',makelist,1),OpCode('SEED',seed),OpCode('RAND',rand),
            OpCode('LEN',length),OpCode('LT',lt),OpCode('LTE',lte),
            OpCode('GT',gt),OpCode('GTE',gte),OpCode('EQ',eq),OpCode('NE',ne),
-           OpCode('GOTO',goto,1),OpCode('GOTOIF',gotoif,1),OpCode('PRINT',prnt),
+           OpCode('JMP',goto,1,LABEL),OpCode('GOTOIF',gotoif,1,LABEL),OpCode('PRINT',prnt),
            OpCode('GETV',getv),OpCode('SETV',setv),OpCode('SAVEVAR',savevar,1),
            OpCode('INPUT',getinp),OpCode('INC',increment),
            OpCode('FLOOR',do_floor),OpCode('CEIL',do_ceil),
-           OpCode('DEC',decrement),OpCode('TIME',gettime),OpCode('POW',power)]
+           OpCode('DEC',decrement),OpCode('TIME',gettime),OpCode('POW',power),
+           # instructions emitted by the compiler
+           OpCode('MOD',mod),OpCode('INV',b_not),OpCode('SUM',total),OpCode('ROLL',roll),
+           OpCode('JMPZ',jumpzero,1,LABEL),
+           OpCode('PUSHV',loadslots),OpCode('POPV',storeslots),
+           OpCode('SORTA',sortasc),OpCode('SORTD',sortdesc),
+           OpCode('KH',keephigh),OpCode('KL',keeplow),OpCode('KF',keepfront),OpCode('KR',keeprear),
+           OpCode('DH',discardhigh),OpCode('DL',discardlow),OpCode('DF',discardfront),OpCode('DR',discardrear),
+           OpCode('CCGT',critgt),OpCode('CCLT',critlt),OpCode('CCEQ',criteq),
+           OpCode('OPENR',openread),OpCode('OPENW',openwrite),OpCode('FREAD',fileread),
+           OpCode('FPRINT',fileprint),OpCode('CLOSE',fileclose),
+           # superinstructions fused by the peephole optimizer
+           OpCode('ROLLC',rollconst,2,PAIR),OpCode('PUSHVC',loadconst,2,PAIR),
+           OpCode('POPVC',storeconst,2,PAIR),OpCode('PRINTPOP',printpop),
+           OpCode('PRINTS',printtext,2,PAIR),
+           # rerolls: r (until the check fails) and ro (once)
+           OpCode('RRGT',rerollgt),OpCode('RRLT',rerolllt),OpCode('RREQ',rerolleq),
+           OpCode('ROGT',rerolloncegt),OpCode('ROLT',rerolloncelt),OpCode('ROEQ',rerollonceeq)]
+
+opcodeMap = dict((o.name, o) for o in opcodes)
+
+# changes whenever an opcode is added, removed, renamed or renumbered
+OPCODE_SIGNATURE = zlib.crc32(' '.join('%s/%d/%d' % (o.name, o.nargs, o.operand)
+                                       for o in opcodes).encode())
+
+# (values an instruction needs on the stack, change in stack depth), or a
+# function of the operand giving them for instructions that take a count
+stackEffects = {
+    'NOP': (0, 0), 'JMP': (0, 0), 'PRINTS': (0, 0),
+    'PUSHVAR': (0, 1), 'PUSH': (0, 1), 'PUSHSTR': (0, 1), 'RAND': (0, 1), 'INPUT': (0, 1),
+    'TIME': (0, 1), 'ROLLC': (0, 1), 'PUSHVC': (0, 1),
+    'NOT': (1, 0), 'INV': (1, 0), 'INC': (1, 0), 'DEC': (1, 0), 'SUM': (1, 0),
+    'FLOOR': (1, 0), 'CEIL': (1, 0), 'LEN': (1, 0), 'SORTA': (1, 0), 'SORTD': (1, 0),
+    'OPENR': (1, 0), 'OPENW': (1, 0), 'FREAD': (1, 0), 'CLOSE': (1, 0), 'PRINT': (1, 0),
+    'SAVEVAR': (1, 0), 'JMPZ': (1, 0), 'POPVC': (1, 0),
+    'POPVAR': (1, -1), 'SEED': (1, -1), 'GOTOIF': (1, -1), 'PRINTPOP': (1, -1),
+    'GETV': (2, 0), 'FPRINT': (2, -1), 'ROLL': (2, -1), 'PUSHV': (2, -1),
+    'SETV': (3, -2), 'POPV': (3, -2),
+    'DUP': lambda n: (1, n),
+    'POP': lambda n: (max(n, 1), -max(n, 1)),
+    'MLIST': lambda n: (n, 1 - n),
+}
+for name in ('ADD', 'SUB', 'MUL', 'DIV', 'MOD', 'POW', 'AND', 'OR', 'XOR',
+             'LT', 'LTE', 'GT', 'GTE', 'EQ', 'NE',
+             'KH', 'KL', 'KF', 'KR', 'DH', 'DL', 'DF', 'DR', 'CCGT', 'CCLT', 'CCEQ'):
+    stackEffects[name] = (2, -1)
+for name in ('RRGT', 'RRLT', 'RREQ', 'ROGT', 'ROLT', 'ROEQ'):
+    stackEffects[name] = (3, -2)
 
 def getInstruction(mnemonic):
-    for o in opcodes:
-        if o.name == mnemonic:
-            return o.bin
+    op = opcodeMap.get(mnemonic)
+    if op:
+        return op.bin
 
-def assemble(instructions):
-    instructions = instructions.split("\n")
-    pgm = []
-    
-    for instr in instructions:
+class AssemblyException(Exception):
+    pass
+
+class Program:
+    '''
+    An assembled program. `code` holds two int32 words per instruction,
+    the opcode number followed by its operand, so instruction i lives at
+    code[2*i] and code[2*i+1]. Operands of CONST instructions index
+    `consts`, LABEL operands are absolute instruction indices.
+
+    `sourcemap`, when the compiler provided one, gives the source span
+    (line, column, end line, end column) of each instruction, or None for
+    instructions that came from no particular expression.
+    '''
+    def __init__(self, code, consts, sourcemap=None):
+        self.code = code
+        self.consts = consts
+        self.sourcemap = sourcemap
+        # decoded dispatch table, built on first execution
+        self.table = None
+
+    def __len__(self):
+        return len(self.code) // 2
+
+    def operand(self, index):
+        arg = self.code[2*index + 1]
+        kind = opcodes[self.code[2*index]].operand
+        if kind == CONST:
+            return self.consts[arg]
+        if kind == PAIR:
+            return (self.consts[arg], self.consts[arg + 1])
+        return arg
+
+    def disassemble(self):
+        lines = []
+        for i in range(len(self)):
+            op = opcodes[self.code[2*i]]
+            if op.operand == NOARG:
+                lines.append('%d: %s' % (i, op.name))
+            else:
+                lines.append('%d: %s %r' % (i, op.name, self.operand(i)))
+        return '\n'.join(lines)
+
+def parseConstant(text):
+    if text.startswith('"'):
+        # quoted text keeps its spaces and digits, see PRINTS
+        return json.loads(text)
+    if text.isnumeric() or (text.startswith('-') and text[1:].isnumeric()):
+        return int(text)
+    return text
+
+class ConstantPool:
+    '''Constants interned by value, shared by everything assembled into it.'''
+    def __init__(self):
+        self.consts = []
+        self.index = {}
+
+    def add(self, value):
+        key = (type(value), value)
+        if key not in self.index:
+            self.index[key] = len(self.consts)
+            self.consts.append(value)
+        return self.index[key]
+
+    def addPair(self, first, second):
+        key = (tuple, (first, second))
+        if key not in self.index:
+            self.index[key] = len(self.consts)
+            self.consts.extend((first, second))
+        return self.index[key]
+
+def assemble(instructions, pool=None):
+    '''
+    Two pass assembler. The first pass assigns every label the index of
+    the instruction that follows it, the second encodes each instruction
+    as (opcode, operand) with labels resolved and literals interned in the
+    constant pool. A compiler Listing also carries its source spans over
+    into the program's source map. Passing a ConstantPool interns into it
+    instead of a fresh one, for code assembled piece by piece.
+    '''
+    if pool is None:
+        pool = ConstantPool()
+    spans = getattr(instructions, 'spans', None)
+    if isinstance(instructions, str):
+        instructions = instructions.split("\n")
+    if spans is None:
+        spans = [None] * len(instructions)
+
+    labels = {}
+    decoded = []
+    sourcemap = []
+    for instr, span in zip(instructions, spans):
         instr = instr.strip()
         if len(instr) == 0: continue
-        
+
+        if instr.startswith(':'):
+            labels[instr] = len(decoded)
+            continue
+
         if " " in instr:
-            instr, args = instr.split(" ")
-            instr = instr.strip()
+            instr, args = instr.split(" ", 1)
             args = args.strip()
-            if args.isnumeric() or (args.startswith('-') and args[1:].isnumeric()):
-                args = int(args)
-            pgm.append(getInstruction(instr))
-            pgm.append(args)
         else:
-            pgm.append(getInstruction(instr))
-    return pgm
-
-def execute(pgm):
-    address = 0
-    stack = Stack()
-    heap = Heap()
-    while address < len(pgm):
-        op = opcodes[pgm[address]]
-        args = [pgm[address+1+n] for n in range(0,op.nargs)]
-        res = op.exec(stack, heap, *args)
-        if res:
-            address += res.toNumber()
+            args = None
+        op = opcodeMap.get(instr)
+        if op is None:
+            raise AssemblyException('Unknown instruction "{}"'.format(instr))
+        decoded.append((op, args))
+        sourcemap.append(span)
+
+    code = array('i', bytes(8 * len(decoded)))
+    for i, (op, args) in enumerate(decoded):
+        code[2*i] = op.bin
+        if args is None:
+            continue
+        if op.operand == LABEL:
+            if args not in labels:
+                raise AssemblyException('Undefined label "{}"'.format(args))
+            code[2*i + 1] = labels[args]
+        elif op.operand == CONST:
+            code[2*i + 1] = pool.add(parseConstant(args))
+        elif op.operand == PAIR:
+            # the first may be quoted text, spaces and all, see PRINTS
+            parts = args.rsplit(None, 1)
+            if len(parts) != 2:
+                raise AssemblyException('"{}" takes two operands'.format(op.name))
+            first, second = [parseConstant(a) for a in parts]
+            if type(second) is not int or type(first) is not int and not parts[0].startswith('"'):
+                raise AssemblyException('"{}" takes two operands'.format(op.name))
+            code[2*i + 1] = pool.addPair(first, second)
+        elif op.operand == IMMED:
+            code[2*i + 1] = int(args)
         else:
-            address += 1 + len(args)
+            raise AssemblyException('"{}" takes no operand'.format(op.name))
+    if not any(sourcemap):
+        sourcemap = None
+    return Program(code, pool.consts, sourcemap)
+
+'''
+Binary program layout, all fields little-endian:
+    header      magic 'D20B', u16 format version, u16 reserved,
+                u32 opcode table signature, u32 instruction count,
+                u32 constant count
+    code        2 * instruction count int32 words
+    constants   per constant: u8 tag (0 = int, 1 = str), u32 payload
+                length, payload (two's complement int or utf-8 text)
+    source map  u32 entry count (0 or the instruction count), then four
+                int32 words per instruction: line, column, end line, end
+                column, all zero where an instruction has no source
+'''
+MAGIC = b'D20B'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<4sHHIII')
+CONSTHEADER = struct.Struct('<BI')
+CONST_INT = 0
+CONST_STR = 1
+MAPHEADER = struct.Struct('<I')
+NOSPAN = (0, 0, 0, 0)
+
+def dumps(program):
+    code = array('i', program.code)
+    if sys.byteorder == 'big':
+        code.byteswap()
+    out = [HEADER.pack(MAGIC, FORMAT_VERSION, 0, OPCODE_SIGNATURE,
+                       len(program), len(program.consts)),
+           code.tobytes()]
+    for const in program.consts:
+        if isinstance(const, int):
+            payload = const.to_bytes(const.bit_length() // 8 + 1, 'little', signed=True)
+            out.append(CONSTHEADER.pack(CONST_INT, len(payload)))
+        else:
+            payload = const.encode('utf-8')
+            out.append(CONSTHEADER.pack(CONST_STR, len(payload)))
+        out.append(payload)
+    if program.sourcemap is None:
+        out.append(MAPHEADER.pack(0))
+    else:
+        words = array('i')
+        for span in program.sourcemap:
+            words.extend(span or NOSPAN)
+        if sys.byteorder == 'big':
+            words.byteswap()
+        out.append(MAPHEADER.pack(len(program.sourcemap)))
+        out.append(words.tobytes())
+    return b''.join(out)
+
+def section(view, offset, size, name):
+    '''view[offset:offset + size], all of which has to be there.'''
+    if offset + size > len(view):
+        raise AssemblyException('Program is truncated in its {}'.format(name))
+    return view[offset:offset + size]
+
+def loads(data):
+    '''
+    Load a program from anything supporting the buffer protocol. The code
+    section is not copied: it is a memoryview cast straight onto `data`.
+    A section shorter than its header says raises AssemblyException.
+    '''
+    view = memoryview(data)
+    magic, version, _, signature, count, nconsts = HEADER.unpack_from(
+        section(view, 0, HEADER.size, 'header'))
+    if magic != MAGIC:
+        raise AssemblyException('Not a compiled D20 program')
+    if version != FORMAT_VERSION or signature != OPCODE_SIGNATURE:
+        raise AssemblyException('Program was compiled for a different interpreter')
+
+    offset = HEADER.size
+    end = offset + 8 * count
+    if sys.byteorder == 'big':
+        code = array('i', section(view, offset, 8 * count, 'code'))
+        code.byteswap()
+    else:
+        code = section(view, offset, 8 * count, 'code').cast('i')
+
+    consts = []
+    offset = end
+    for i in range(nconsts):
+        tag, length = CONSTHEADER.unpack_from(section(view, offset, CONSTHEADER.size, 'constants'))
+        offset += CONSTHEADER.size
+        payload = section(view, offset, length, 'constants')
+        if tag == CONST_INT:
+            consts.append(int.from_bytes(payload, 'little', signed=True))
+        else:
+            consts.append(str(payload, 'utf-8'))
+        offset += length
+
+    sourcemap = None
+    entries, = MAPHEADER.unpack_from(section(view, offset, MAPHEADER.size, 'source map'))
+    offset += MAPHEADER.size
+    if entries:
+        words = array('i')
+        words.frombytes(section(view, offset, 16 * entries, 'source map'))
+        if sys.byteorder == 'big':
+            words.byteswap()
+        sourcemap = [tuple(words[i:i + 4]) if words[i] else None
+                     for i in range(0, len(words), 4)]
+    return Program(code, consts, sourcemap)
+
+def save(program, path):
+    with open(path, 'wb') as f:
+        f.write(dumps(program))
+
+def load(path):
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+class Machine:
+    '''
+    Everything a running program can touch, program counter included, so
+    a machine stopped between instructions can be resumed later or saved
+    with snapshot.py.
+    '''
+    __slots__ = ('stack', 'heap', 'rng', 'pc', 'output', 'files')
+
+    def __init__(self, rng=None, output=None):
+        self.stack = Stack()
+        self.heap = Heap()
+        # each machine owns its generator; see rng.py for the choices
+        self.rng = rng if rng is not None else MersenneTwister()
+        self.pc = 0
+        self.output = output if output is not None else Writer()
+        self.files = FileTable()
+
+def unimplemented(op):
+    def handler(vm, arg):
+        raise RuntimeException('Instruction {} is not supported'.format(op.name))
+    return handler
+
+def shortfalls(pgm):
+    '''
+    {instruction index: values needed} for every instruction that can be
+    reached with fewer values on the stack than it takes, found by
+    following every path from the start with the least depth the stack
+    can have there. Compiled programs have none.
+    '''
+    code = pgm.code
+    n = len(code) // 2
+    depth = [None] * n
+    short = {}
+    work = [0] if n else []
+    if n:
+        depth[0] = 0
+    while work:
+        pc = work.pop()
+        op = opcodes[code[2*pc]]
+        arg = code[2*pc + 1]
+        effect = stackEffects.get(op.name, (0, 0))
+        need, net = effect(arg) if callable(effect) else effect
+        if depth[pc] < need:
+            short[pc] = need
+            continue
+        after = depth[pc] + net
+        if op.operand != LABEL:
+            targets = (pc + 1,)
+        elif op.name == 'JMP':
+            targets = (arg,)
+        else:
+            targets = (arg, pc + 1)
+        for target in targets:
+            if 0 <= target < n and (depth[target] is None or after < depth[target]):
+                depth[target] = after
+                work.append(target)
+    return short
+
+def checked(fn, need, index):
+    def handler(vm, arg):
+        if len(vm.stack) < need:
+            raise RuntimeException('Stack underflow at instruction {}'.format(index))
+        return fn(vm, arg)
+    return handler
+
+def decode(pgm, overrides=None):
+    '''
+    Turn a program into a flat list of (handler, operand) pairs so the
+    dispatch loop does no decoding of its own: constant pool references are
+    replaced by the constants and every opcode by its handler. `overrides`
+    maps mnemonics to handlers used in place of the usual ones.
+
+    Handlers assume the stack holds what they take. The few instructions
+    shortfalls() finds that might not get it are wrapped in a depth check,
+    so a malformed program stops with a stack underflow rather than an
+    IndexError, and everything else runs unchecked.
+    '''
+    code = pgm.code
+    consts = pgm.consts
+    overrides = overrides or {}
+    handlers = [overrides.get(op.name) or op.fn or unimplemented(op) for op in opcodes]
+    kinds = [op.operand for op in opcodes]
+    table = []
+    for i in range(0, len(code), 2):
+        opcode, arg = code[i], code[i + 1]
+        if kinds[opcode] == CONST:
+            arg = consts[arg]
+        elif kinds[opcode] == PAIR:
+            arg = (consts[arg], consts[arg + 1])
+        table.append((handlers[opcode], arg))
+    for index, need in shortfalls(pgm).items():
+        fn, arg = table[index]
+        table[index] = (checked(fn, need, index), arg)
+    return table
+
+def execute(pgm, vm=None, steps=None, close=True):
+    '''
+    Run from vm.pc until the program ends or, if `steps` is given, until
+    that many instructions have run. vm.pc is left at the next instruction,
+    so calling execute again with the same machine carries on from there.
+    Files still open when the program ends are closed unless `close` is
+    false, for callers that run several programs on one machine.
+    '''
+    if vm is None:
+        vm = Machine()
+    table = pgm.table
+    if table is None:
+        table = pgm.table = decode(pgm)
+    end = len(table)
+    pc = vm.pc
+    try:
+        if steps is None:
+            while pc < end:
+                fn, arg = table[pc]
+                jump = fn(vm, arg)
+                if jump is None:
+                    pc += 1
+                else:
+                    pc = jump
+        else:
+            while pc < end and steps > 0:
+                fn, arg = table[pc]
+                jump = fn(vm, arg)
+                if jump is None:
+                    pc += 1
+                else:
+                    pc = jump
+                steps -= 1
+    except BaseException:
+        vm.files.closeAll()
+        raise
+    finally:
+        vm.pc = pc
+        vm.output.flush()
+    if pc >= end and close:
+        vm.files.closeAll()
+    return vm
+
+def finished(pgm, vm):
+    return vm.pc >= len(pgm)
@@ -0,0 +1,314 @@
+from array import array
+from math import ceil, exp, floor, fabs, lgamma, log, log2, sqrt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+'''
+Bulk dice rolling. Rolls come back as compact arrays rather than lists of
+Python ints: array('B') when every face fits in a byte, array('q') when it
+fits in 64 bits, and a plain list only for absurdly large dice. NumPy is
+used for large rolls when it is installed; otherwise the pure Python path
+draws random bytes in bulk and maps them onto faces with bytes.translate,
+so rolls of up to 255 sides never touch an individual die in Python.
+
+Rolls too big to be worth drawing die by die can also be summarized
+without drawing them: highest, lowest, total and successes sample the
+max, min, sum or number of dice passing a crit check straight from its
+exact distribution, at a cost that does not grow with the number of dice.
+
+Rerolls are applied to a whole roll at once as well: replacements for
+every die are drawn in bulk and merged in where the crit check passed.
+'''
+
+# below this many dice a per-die loop is cheaper than any bulk setup
+BULK_THRESHOLD = 16
+NUMPY_THRESHOLD = 256
+
+BYTE_FACES = 255
+INT64_FACES = 2**63 - 1
+
+def typecode(sides):
+    if sides <= BYTE_FACES:
+        return 'B'
+    if sides <= INT64_FACES:
+        return 'q'
+    return None
+
+class DiceEngine:
+    def __init__(self, rng):
+        self.rng = rng
+        self.generator = None
+        self.tables = {}
+
+    def numpyGenerator(self):
+        # derived from the Python RNG so SEED makes numpy rolls repeatable too
+        if self.generator is None:
+            self.generator = numpy.random.default_rng(self.rng.getrandbits(128))
+        return self.generator
+
+    def roll(self, count, sides):
+        if sides == 0:
+            return array('B', bytes(count))
+        if sides == 1:
+            return array('B', b'\x01' * count)
+        code = typecode(sides)
+        if count < BULK_THRESHOLD or code is None:
+            randrange = self.rng.randrange
+            dice = [randrange(sides) + 1 for i in range(count)]
+            return array(code, dice) if code else dice
+        if numpy is not None and count >= NUMPY_THRESHOLD:
+            dtype = numpy.uint8 if code == 'B' else numpy.int64
+            rolled = self.numpyGenerator().integers(1, sides + 1, size=count, dtype=dtype)
+            return array(code, rolled.tobytes())
+        if code == 'B':
+            return self.rollBytes(count, sides)
+        return self.rollWords(count, sides)
+
+    def rollBytes(self, count, sides):
+        '''
+        Draw random bytes and translate them straight onto faces. Bytes at or
+        above the largest multiple of `sides` are deleted during the same
+        translate call, which keeps every face equally likely.
+        '''
+        if sides not in self.tables:
+            limit = 256 - 256 % sides
+            table = bytes(b % sides + 1 if b < limit else 0 for b in range(256))
+            self.tables[sides] = (table, bytes(range(limit, 256)), limit)
+        table, rejected, limit = self.tables[sides]
+        randbytes = self.rng.randbytes
+        out = b''
+        while len(out) < count:
+            need = count - len(out)
+            out += randbytes(need * 256 // limit + 8).translate(table, rejected)
+        return array('B', out[:count])
+
+    def binomial(self, n, p):
+        '''
+        Number of successes in n trials of probability p. Small means count
+        geometric gaps between successes; large ones use Hormann's BTRS
+        transformed rejection, as random.binomialvariate does from 3.12 on.
+        '''
+        if n <= 0 or p <= 0.0:
+            return 0
+        if p >= 1.0:
+            return n
+        if p > 0.5:
+            return n - self.binomial(n, 1.0 - p)
+        random = self.rng.random
+        if n * p < 10.0:
+            x = y = 0
+            c = log2(1.0 - p)
+            if not c:
+                return x
+            while True:
+                y += floor(log2(1.0 - random()) / c) + 1
+                if y > n:
+                    return x
+                x += 1
+
+        spq = sqrt(n * p * (1.0 - p))
+        b = 1.15 + 2.53 * spq
+        a = -0.0873 + 0.0248 * b + 0.01 * p
+        c = n * p + 0.5
+        vr = 0.92 - 4.2 / b
+        alpha = (2.83 + 5.1 / b) * spq
+        lpq = log(p / (1.0 - p))
+        m = floor((n + 1) * p)
+        h = lgamma(m + 1) + lgamma(n - m + 1)
+        while True:
+            u = random() - 0.5
+            us = 0.5 - fabs(u)
+            k = floor((2.0 * a / us + b) * u + c)
+            if k < 0 or k > n:
+                continue
+            v = random()
+            if us >= 0.07 and v <= vr:
+                return k
+            v = log(v * alpha / (a / (us * us) + b))
+            if v <= h - lgamma(k + 1) - lgamma(n - k + 1) + (k - m) * lpq:
+                return k
+
+    def faces(self, count, sides):
+        '''How many of count dice land on each face: a multinomial draw.'''
+        counts = []
+        left = count
+        for face in range(1, sides):
+            drawn = self.binomial(left, 1.0 / (sides - face + 1))
+            counts.append(drawn)
+            left -= drawn
+        counts.append(left)
+        return counts
+
+    def total(self, count, sides):
+        '''Sum of count dice, in sides binomial draws.'''
+        if sides <= 1:
+            return count * sides
+        return sum(face * n for face, n in enumerate(self.faces(count, sides), 1))
+
+    def highest(self, count, sides):
+        '''
+        Highest of count dice by inverting P(max <= k) = (k/sides)^count:
+        max <= k exactly when u <= (k/sides)^count for u uniform on (0, 1].
+        '''
+        if sides <= 1 or count <= 0:
+            return sides if count > 0 else 0
+        u = 1.0 - self.rng.random()
+        k = ceil(sides * exp(log(u) / count))
+        return min(max(k, 1), sides)
+
+    def lowest(self, count, sides):
+        '''Lowest of count dice; the mirror image of highest.'''
+        if sides <= 1 or count <= 0:
+            return sides if count > 0 else 0
+        return sides + 1 - self.highest(count, sides)
+
+    def successes(self, count, sides, op, target):
+        '''How many of count dice pass a crit check against target.'''
+        if sides == 0:
+            # every die shows 0
+            return count if critcheck(array('B', [0]), op, target)[0] else 0
+        if op == 'gt':
+            hits = sides - min(max(target, 0), sides)
+        elif op == 'lt':
+            hits = min(max(target - 1, 0), sides)
+        else:
+            hits = 1 if 1 <= target <= sides else 0
+        return self.binomial(count, hits / sides)
+
+    def reroll(self, dice, sides, op, target, once=False):
+        '''
+        Reroll every die that passes a crit check. With once, each of them is
+        rolled again and keeps whatever it shows. Otherwise it is rerolled
+        until it fails the check, which ends on a face drawn uniformly from
+        the faces that fail, so it is drawn from those directly. Either way
+        a whole set of replacements is drawn in bulk and merged in where the
+        check passed. None if every face passes and a die would never stop.
+        '''
+        matched = critcheck(dice, op, target)
+        if b'\x01' not in matched.tobytes():
+            return dice
+        if once:
+            new = self.roll(len(dice), sides)
+        else:
+            new = self.rollExcept(len(dice), sides, op, target)
+            if new is None:
+                return None
+        return where(matched, new, dice)
+
+    def rollExcept(self, count, sides, op, target):
+        '''count dice drawn uniformly from the faces that fail a crit check.'''
+        die = truncated(sides, op, target)
+        if die is None:
+            return None
+        faces, fn = die
+        dice = self.roll(count, faces)
+        return dice if fn is None else remap(dice, sides, fn)
+
+    def rollWords(self, count, sides):
+        limit = 2**64 - 2**64 % sides
+        getrandbits = self.rng.getrandbits
+        dice = array('q')
+        while len(dice) < count:
+            need = count - len(dice)
+            words = array('Q', getrandbits(64 * need).to_bytes(8 * need, 'little'))
+            dice.extend([w % sides + 1 for w in words if w < limit])
+        return dice
+
+def total(dice):
+    if numpy is not None and type(dice) is array and len(dice) >= NUMPY_THRESHOLD \
+            and dice.typecode == 'B':
+        return int(numpy.frombuffer(dice, dtype=numpy.uint8).sum(dtype=numpy.int64))
+    return sum(dice)
+
+def critcheck(dice, op, target):
+    '''
+    Compare every die against target, giving an array of 1s and 0s.
+    Byte arrays are compared with a translate table.
+    '''
+    if type(dice) is array and dice.typecode == 'B':
+        if op == 'gt':
+            table = bytes(1 if b > target else 0 for b in range(256))
+        elif op == 'lt':
+            table = bytes(1 if b < target else 0 for b in range(256))
+        else:
+            table = bytes(1 if b == target else 0 for b in range(256))
+        return array('B', dice.tobytes().translate(table))
+    if op == 'gt':
+        return array('B', [1 if d > target else 0 for d in dice])
+    if op == 'lt':
+        return array('B', [1 if d < target else 0 for d in dice])
+    return array('B', [1 if d == target else 0 for d in dice])
+
+def truncated(sides, op, target):
+    '''
+    The faces of a d<sides> that fail a crit check, as (faces, fn): fn maps
+    a d<faces> uniformly onto them, and is None when no mapping is needed.
+    It works on numpy arrays as well as single dice. None if every face
+    passes. Only asked about checks that some face passes.
+    '''
+    if sides == 0:
+        # the only face, 0, passed
+        return None
+    if op == 'gt':
+        high = min(target, sides)
+        return (high, None) if high >= 1 else None
+    if op == 'lt':
+        low = max(target, 1)
+        if low > sides:
+            return None
+        return sides - low + 1, lambda d: d + (low - 1)
+    if not 1 <= target <= sides:
+        return sides, None
+    if sides == 1:
+        return None
+    # faces 1..sides-1, with the target face skipped over
+    return sides - 1, lambda d: d + (d >= target)
+
+def vector(dice):
+    return numpy.frombuffer(dice, dtype=numpy.uint8 if dice.typecode == 'B' else numpy.int64)
+
+def remap(dice, sides, fn):
+    '''
+    fn applied to every die, for dice whose results are at most sides. fn
+    must work on a whole numpy array as well as on a single die.
+    '''
+    code = typecode(sides)
+    if code == 'B' and type(dice) is array and dice.typecode == 'B':
+        table = bytes(min(fn(b), BYTE_FACES) for b in range(256))
+        return array('B', dice.tobytes().translate(table))
+    if code and numpy is not None and type(dice) is array and len(dice) >= NUMPY_THRESHOLD:
+        dtype = numpy.uint8 if code == 'B' else numpy.int64
+        return array(code, fn(vector(dice).astype(numpy.int64)).astype(dtype).tobytes())
+    mapped = [fn(d) for d in dice]
+    return array(code, mapped) if code else mapped
+
+# 1 -> 0xff, to widen a crit check result into a byte mask
+WIDEN = bytes.maketrans(b'\x01', b'\xff')
+
+def where(mask, new, dice):
+    '''
+    Dice from new where mask is 1, from dice elsewhere. Byte arrays are
+    merged as single big integers, a whole list in a couple of operations.
+    '''
+    if type(dice) is array and type(new) is array:
+        if dice.typecode == 'B' and new.typecode == 'B':
+            size = len(dice)
+            m = int.from_bytes(mask.tobytes().translate(WIDEN), 'little')
+            d = int.from_bytes(dice.tobytes(), 'little')
+            r = int.from_bytes(new.tobytes(), 'little')
+            return array('B', (d ^ ((d ^ r) & m)).to_bytes(size, 'little'))
+        if numpy is not None and len(dice) >= NUMPY_THRESHOLD:
+            merged = numpy.where(vector(mask) != 0, vector(new), vector(dice))
+            dtype = numpy.uint8 if dice.typecode == 'B' else numpy.int64
+            return array(dice.typecode, merged.astype(dtype).tobytes())
+    merged = [r if m else d for m, r, d in zip(mask, new, dice)]
+    return array(dice.typecode, merged) if type(dice) is array else merged
+
+def text(dice, toChar):
+    if type(dice) is array and dice.typecode == 'B':
+        # code points below 256 are exactly latin-1
+        return dice.tobytes().decode('latin-1')
+    return ''.join(toChar(d) for d in dice)
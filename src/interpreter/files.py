@@ -0,0 +1,127 @@
+import mmap
+
+from values import RuntimeException, String, toList
+
+'''
+File handles for OPENR, OPENW, FREAD, FPRINT and CLOSE.
+
+Programs only ever see handle numbers, which they keep in dice slots like
+any other value; the machine's FileTable maps them to open files. Files
+opened for reading are memory mapped, so FREAD finds each record (one
+line) with a search over the mapping rather than through Python-level
+buffering; pipes and other unmappable files fall back to a buffered
+reader. Writes go through a large buffer. Every handle still open when
+the program ends is closed, in the order it was opened.
+'''
+
+BUFFER_SIZE = 1 << 20
+ENCODING = 'utf-8'
+# undecodable bytes survive a read/write round trip unchanged
+ERRORS = 'surrogateescape'
+
+def toName(value):
+    '''
+    File names are strings: either text from the prompt or a file, or dice
+    laid out the way strings are stored, a length followed by the codes.
+    '''
+    if type(value) is String:
+        return value.value
+    dice = list(toList(value))
+    if not dice or dice[0] < 0 or dice[0] > len(dice) - 1:
+        raise RuntimeException('File name must be a length followed by character codes')
+    try:
+        return ''.join(chr(d) for d in dice[1:dice[0] + 1])
+    except (ValueError, OverflowError):
+        raise RuntimeException('File name contains an invalid character code')
+
+def toHandle(value):
+    '''The handle is the first die of whatever the slot reference read.'''
+    dice = toList(value)
+    if not len(dice):
+        raise RuntimeException('Expected a file handle')
+    return dice[0]
+
+class ReadHandle:
+    def __init__(self, f):
+        self.file = f
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # empty files and pipes cannot be mapped
+            self.map = None
+        self.pos = 0
+
+    def readline(self):
+        if self.map is not None:
+            end = self.map.find(b'\n', self.pos)
+            if end < 0:
+                end = len(self.map)
+                record = self.map[self.pos:end]
+                self.pos = end
+            else:
+                record = self.map[self.pos:end]
+                self.pos = end + 1
+        else:
+            record = self.file.readline()
+            if record.endswith(b'\n'):
+                record = record[:-1]
+        if record.endswith(b'\r'):
+            record = record[:-1]
+        return record.decode(ENCODING, ERRORS)
+
+    def write(self, text):
+        raise RuntimeException('File was opened for reading')
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+class WriteHandle:
+    def __init__(self, f):
+        self.file = f
+
+    def readline(self):
+        raise RuntimeException('File was opened for writing')
+
+    def write(self, text):
+        self.file.write(text)
+
+    def close(self):
+        self.file.close()
+
+class FileTable:
+    def __init__(self):
+        self.handles = {}
+        self.next = 1
+
+    def open(self, name, mode):
+        try:
+            if mode == 'r':
+                handle = ReadHandle(open(name, 'rb', buffering=BUFFER_SIZE))
+            else:
+                handle = WriteHandle(open(name, 'w', encoding=ENCODING, errors=ERRORS,
+                                          buffering=BUFFER_SIZE, newline=''))
+        except OSError as e:
+            raise RuntimeException('Cannot open "{}": {}'.format(name, e.strerror))
+        number = self.next
+        self.next += 1
+        self.handles[number] = handle
+        return number
+
+    def get(self, number):
+        try:
+            return self.handles[number]
+        except (KeyError, TypeError):
+            raise RuntimeException('{} is not an open file handle'.format(number))
+
+    def close(self, number):
+        self.get(number).close()
+        del self.handles[number]
+
+    def closeAll(self):
+        # dicts keep insertion order, so files close in the order they opened
+        handles = list(self.handles.values())
+        self.handles.clear()
+        for handle in handles:
+            handle.close()
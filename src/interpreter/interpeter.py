@@ -1,183 +1,382 @@
-
-
-def add(stack, heap):
-    top = stack.pop()
-    stack.push(stack.pop().add(top))
-
-def sub(stack, heap):
-    top = stack.pop()
-    stack.push(stack.pop().sub(top))
-
-def mul(stack, heap):
-    top = stack.pop()
-    stack.push(stack.pop().mul(top))
-
-def div(stack, heap):
-    top = stack.pop()
-    stack.push(stack.pop().div(top))
-
-def b_and(stack, heap):
-    top = stack.pop()
-    stack.push(stack.pop().b_and(top))
-
-def b_or(stack, heap):
-    top = stack.pop()
-    stack.push(stack.pop().b_or(top))
-
-def b_xor(stack, heap):
-    top = stack.pop()
-    stack.push(stack.pop().b_xor(top))
-
-def b_not(stack, heap):
-    top = stack.pop()
-    stack.push(stack.pop().b_not(top))
-
-def pushvar(stack, heap, varname):
-    stack.push(heap.lookup(varname))
-
-def popvar(stack, heap, varname):
-    heap.put(varname, stack.pop())
-
-def pushnum(stack, heap, num):
-    stack.push(Number(num))
-
-def pushstr(stack, heap, string):
-    stack.push(String(string))
-
-def dup(stack, heap, num):
-    value = stack.peek()
+from time import time
+
+from dice import critcheck
+from files import toName, toHandle
+from values import List, String, Roll, RuntimeException, TRUE, FALSE, toNumber, toList, truthy, toText
+from values import LAZY_THRESHOLD
+
+'''
+Instruction handlers. Every handler is called as fn(vm, arg) where arg is
+the pre-decoded operand (0 for instructions without one). A handler that
+returns an integer jumps to that instruction index, otherwise execution
+continues with the next instruction.
+
+Binary operators find their left operand on top of the stack, since the
+compiler generates the right hand side first. Numbers travel as plain ints;
+see values.py. Randomness comes from vm.rng, see rng.py.
+'''
+
+def nop(vm, arg):
+    pass
+
+def binary(stack):
+    left = stack.pop()
+    right = stack.pop()
+    if type(left) is not int:
+        left = left.toNumber()
+    if type(right) is not int:
+        right = right.toNumber()
+    return left, right
+
+def add(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(left + right)
+
+def sub(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(left - right)
+
+def mul(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(left * right)
+
+def div(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    if right == 0:
+        raise RuntimeException('Division by zero')
+    stack.append(left // right)
+
+def mod(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    if right == 0:
+        raise RuntimeException('Division by zero')
+    stack.append(left % right)
+
+def b_and(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(TRUE if left and right else FALSE)
+
+def b_or(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(TRUE if left or right else FALSE)
+
+def b_xor(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(TRUE if bool(left) != bool(right) else FALSE)
+
+def b_not(vm, arg):
+    stack = vm.stack
+    stack.append(FALSE if truthy(stack.pop()) else TRUE)
+
+def pushvar(vm, slot):
+    vm.stack.append(vm.heap.lookup(slot))
+
+def popvar(vm, slot):
+    vm.heap.put(slot, toNumber(vm.stack.pop()))
+
+def pushnum(vm, num):
+    vm.stack.append(num)
+
+def pushstr(vm, string):
+    vm.stack.append(String(string))
+
+def dup(vm, num):
+    stack = vm.stack
+    value = stack[-1]
     for i in range(num):
-        stack.push(value)
+        stack.append(value)
 
-def pop(stack, heap, num):
-    if not num:
-        num = 1
-    for i in range(num):
+def pop(vm, num):
+    stack = vm.stack
+    if num > 1:
+        del stack[-num:]
+    else:
         stack.pop()
 
-def makelist(stack, heap):
+def makelist(vm, num):
+    '''
+    Build a list out of the top `num` values. The value pushed first becomes
+    the front of the list; lists and strings are spliced in.
+    '''
+    stack = vm.stack
     lst = []
-    num = stack.pop()
-    for i in range(num):
-        lst.push(stack.pop())
-    stack.push(List(lst))
-
-RNG = Random()
-
-def seed(stack, heap):
-    RNG.seed(stack.pop().toNumber())
-
-def rand(stack, heap):
-    stack.push(Number(RNG.random()))
-
-def lt(stack, heap):
-    top = stack.pop()
-    if stack.pop().lt(top):
-        stack.push(Number(1))
-    else:
-        stack.push(Number(0))
-
-def lte(stack, heap):
-    top = stack.pop()
-    bot = stack.pop()
-    if bot.lt(top) or bot.eq(top):
-        stack.push(Number(1))
-    else:
-        stack.push(Number(0))
-
-def gt(stack, heap):
-    top = stack.pop()
-    bot = stack.pop()
-    if bot.gt(top) or bot.eq(top):
-        stack.push(Number(1))
-    else:
-        stack.push(Number(0))
-
-def gte(stack, heap):
-    top = stack.pop()
-    bot = stack.pop()
-    if bot.gt(top) or bot.eq(top):
-        stack.push(Number(1))
-    else:
-        stack.push(Number(0))
-
-def eq(stack, heap):
-    top = stack.pop()
-    bot = stack.pop()
-    if bot.eq(top):
-        stack.push(Number(1))
-    else:
-        stack.push(Number(0))
-
-def ne(stack, heap):
-    top = stack.pop()
-    bot = stack.pop()
-    if bot.eq(top):
-        stack.push(Number(0))
-    else:
-        stack.push(Number(1))
-
-def lte(stack, heap):
+    if num:
+        for value in stack[-num:]:
+            if type(value) is int:
+                lst.append(value)
+            else:
+                lst.extend(value.toList())
+        del stack[-num:]
+    stack.append(List(lst))
+
+def seed(vm, arg):
+    vm.rng.seed(toNumber(vm.stack.pop()))
+
+def rand(vm, arg):
+    vm.stack.append(vm.rng.getrandbits(31))
+
+def rolldice(vm, count, sides):
+    if count < 0 or sides < 0:
+        raise RuntimeException('Cannot roll {}d{}'.format(count, sides))
+    if count >= LAZY_THRESHOLD:
+        return Roll(count, sides, vm.rng.dice)
+    return List(vm.rng.integers(count, sides))
+
+def roll(vm, arg):
+    stack = vm.stack
+    count = toNumber(stack.pop())
+    sides = toNumber(stack.pop())
+    stack.append(rolldice(vm, count, sides))
+
+def rollconst(vm, arg):
+    count, sides = arg
+    vm.stack.append(rolldice(vm, count, sides))
+
+def total(vm, arg):
+    stack = vm.stack
+    if type(stack[-1]) is not int:
+        stack.append(stack.pop().toNumber())
+
+def lt(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(TRUE if left < right else FALSE)
+
+def lte(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(TRUE if left <= right else FALSE)
+
+def gt(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(TRUE if left > right else FALSE)
+
+def gte(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(TRUE if left >= right else FALSE)
+
+def eq(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(TRUE if left == right else FALSE)
+
+def ne(vm, arg):
+    stack = vm.stack
+    left, right = binary(stack)
+    stack.append(TRUE if left != right else FALSE)
+
+def length(vm, arg):
+    stack = vm.stack
     top = stack.pop()
-    bot = stack.pop()
-    if bot.lt(top) or bot.eq(top):
-        stack.push(Number(1))
+    if type(top) is int:
+        stack.append(1)
     else:
-        stack.push(Number(0))
+        stack.append(top.size())
 
-def length(stack, heap):
-    top = stack.pop()
-    if isinstance(top, Number):
-        stack.push(Number(4))
-    else:
-        stack.push(Number(len(top.value)))
-
-def goto(stack, heap, addr):
+def goto(vm, addr):
     return addr
 
-def gotoif(stack, heap, addr):
-    top = stack.pop()
-    if top.truthy():
+def gotoif(vm, addr):
+    if truthy(vm.stack.pop()):
         return addr
 
-def prnt(stack, heap):
-    top = stack.pop()
-    print(top.print())
-
-def getv(stack, heap):
-    index = stack.pop()
-    obj = stack.peek()
-    stack.push(obj.getValue(index))
+def jumpzero(vm, addr):
+    top = vm.stack[-1]
+    if top == 0 if type(top) is int else not top.truthy():
+        return addr
 
-def setv(stack, heap):
-    value = stack.pop()
-    index = stack.pop()
-    obj = stack.peek()
+def prnt(vm, arg):
+    vm.output.write(toText(vm.stack[-1]))
+
+def printpop(vm, arg):
+    vm.output.write(toText(vm.stack.pop()))
+
+def printtext(vm, arg):
+    vm.output.write(arg[0])
+
+def getv(vm, arg):
+    stack = vm.stack
+    index = toNumber(stack.pop())
+    obj = stack[-1]
+    if type(obj) is int:
+        raise RuntimeException('Cannot index a number')
+    stack.append(obj.getValue(index))
+
+def setv(vm, arg):
+    stack = vm.stack
+    value = toNumber(stack.pop())
+    index = toNumber(stack.pop())
+    obj = stack[-1]
+    if type(obj) is not List:
+        raise RuntimeException('Only lists can be modified')
     obj.setValue(index, value)
 
-def savevar(stack, heap, name):
-    heap.put(name, stack.peek())
-
-def getinp(stack, heap):
-    stack.push(String(input()))
-
-def increment(stack, heap):
-    stack.push(stack.pop().add(Number(1)))
-
-def decrement(stack, heap):
-    stack.push(stack.pop().sub(Number(1)))
-
-def gettime(stack, heap):
-    stack.push(Number(int(time()*1000)))
-
-def power(stack, heap):
-    exp = stack.pop()
-    base = stack.pop()
-    stack.push(base.pow(exp))
-
-def do_floor(stack, heap):
-    stack.push(stack.pop().floor())
-
-def do_ceil(stack, heap):
-    stack.push(stack.pop().ceil())
-    
\ No newline at end of file
+def savevar(vm, slot):
+    vm.heap.put(slot, toNumber(vm.stack[-1]))
+
+def getinp(vm, arg):
+    # the prompt has to be on screen before we wait for the answer
+    vm.output.flush()
+    vm.stack.append(String(input()))
+
+def openread(vm, arg):
+    stack = vm.stack
+    stack.append(vm.files.open(toName(stack.pop()), 'r'))
+
+def openwrite(vm, arg):
+    stack = vm.stack
+    stack.append(vm.files.open(toName(stack.pop()), 'w'))
+
+def fileread(vm, arg):
+    stack = vm.stack
+    stack.append(String(vm.files.get(toHandle(stack.pop())).readline()))
+
+def fileprint(vm, arg):
+    stack = vm.stack
+    handle = vm.files.get(toHandle(stack.pop()))
+    handle.write(toText(stack[-1]))
+
+def fileclose(vm, arg):
+    vm.files.close(toHandle(vm.stack[-1]))
+
+def increment(vm, arg):
+    stack = vm.stack
+    stack.append(toNumber(stack.pop()) + 1)
+
+def decrement(vm, arg):
+    stack = vm.stack
+    stack.append(toNumber(stack.pop()) - 1)
+
+def gettime(vm, arg):
+    vm.stack.append(int(time()*1000))
+
+def power(vm, arg):
+    stack = vm.stack
+    base, exp = binary(stack)
+    if exp < 0:
+        raise RuntimeException('Negative exponent')
+    stack.append(base ** exp)
+
+def do_floor(vm, arg):
+    total(vm, arg)
+
+def do_ceil(vm, arg):
+    total(vm, arg)
+
+def loadslots(vm, arg):
+    stack = vm.stack
+    count = toNumber(stack.pop())
+    start = toNumber(stack.pop())
+    stack.append(List(vm.heap.read(start, count)))
+
+def storeslots(vm, arg):
+    stack = vm.stack
+    count = toNumber(stack.pop())
+    start = toNumber(stack.pop())
+    vm.heap.write(start, count, toList(stack[-1]))
+
+def loadconst(vm, arg):
+    count, start = arg
+    vm.stack.append(List(vm.heap.read(start, count)))
+
+def storeconst(vm, arg):
+    count, start = arg
+    vm.heap.write(start, count, toList(vm.stack[-1]))
+
+def sortasc(vm, arg):
+    stack = vm.stack
+    stack.append(List(sorted(toList(stack.pop()))))
+
+def sortdesc(vm, arg):
+    stack = vm.stack
+    stack.append(List(sorted(toList(stack.pop()), reverse=True)))
+
+def ranked(dice, n, highest):
+    '''Indices of the n highest (or lowest) dice, ties going to the earlier die'''
+    if n == 1 and len(dice):
+        # kh1/kl1 is by far the most common keep, and max/min run in C
+        return {dice.index(max(dice) if highest else min(dice))}
+    if highest:
+        order = sorted(range(len(dice)), key=lambda i: -dice[i])
+    else:
+        order = sorted(range(len(dice)), key=dice.__getitem__)
+    return set(order[:max(n, 0)])
+
+def keepdiscard(select, single=None):
+    '''
+    `single`, for kh and kl, picks the one die of an undrawn Roll that
+    n = 1 keeps, without drawing the rest.
+    '''
+    def handler(vm, arg):
+        stack = vm.stack
+        n = toNumber(stack.pop())
+        value = stack.pop()
+        if n == 1 and single is not None and type(value) is Roll and value.pending() \
+                and value.crit is None:
+            stack.append(List([single(value)]))
+            return
+        stack.append(List(select(toList(value), n)))
+    return handler
+
+def keep(dice, chosen):
+    return [d for i, d in enumerate(dice) if i in chosen]
+
+def discard(dice, chosen):
+    return [d for i, d in enumerate(dice) if i not in chosen]
+
+keephigh = keepdiscard(lambda dice, n: keep(dice, ranked(dice, n, True)), Roll.highest)
+keeplow = keepdiscard(lambda dice, n: keep(dice, ranked(dice, n, False)), Roll.lowest)
+keepfront = keepdiscard(lambda dice, n: dice[:max(n, 0)])
+keeprear = keepdiscard(lambda dice, n: dice[max(len(dice) - n, 0):] if n > 0 else [])
+discardhigh = keepdiscard(lambda dice, n: discard(dice, ranked(dice, n, True)))
+discardlow = keepdiscard(lambda dice, n: discard(dice, ranked(dice, n, False)))
+discardfront = keepdiscard(lambda dice, n: dice[max(n, 0):])
+discardrear = keepdiscard(lambda dice, n: dice[:max(len(dice) - n, 0)] if n > 0 else dice)
+
+def crit(op):
+    def handler(vm, arg):
+        stack = vm.stack
+        target = toNumber(stack.pop())
+        value = stack.pop()
+        if type(value) is Roll and value.pending() and value.crit is None:
+            stack.append(value.checked(op, target))
+            return
+        stack.append(List(critcheck(toList(value), op, target)))
+    return handler
+
+critgt = crit('gt')
+critlt = crit('lt')
+criteq = crit('eq')
+
+def reroll(op, once):
+    '''
+    r and ro. The compiler leaves a copy of the roll's sides beneath the
+    dice, since the dice alone do not say what they were rolled with.
+    '''
+    def handler(vm, arg):
+        stack = vm.stack
+        target = toNumber(stack.pop())
+        dice = toList(stack.pop())
+        sides = toNumber(stack.pop())
+        dice = vm.rng.dice.reroll(dice, sides, op, target, once)
+        if dice is None:
+            raise RuntimeException('Every face of a d{} would be rerolled'.format(sides))
+        stack.append(List(dice))
+    return handler
+
+rerollgt = reroll('gt', False)
+rerolllt = reroll('lt', False)
+rerolleq = reroll('eq', False)
+rerolloncegt = reroll('gt', True)
+rerolloncelt = reroll('lt', True)
+rerollonceeq = reroll('eq', True)
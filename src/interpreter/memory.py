@@ -0,0 +1,148 @@
+from array import array
+
+from values import RuntimeException
+
+class Stack(list):
+    '''
+    Handlers use the inherited list methods directly and never check the
+    depth; decode() checks it ahead of the instructions that could run
+    short, see bytecode.shortfalls.
+    '''
+    push = list.append
+
+    def peek(self):
+        try:
+            return self[-1]
+        except IndexError:
+            raise RuntimeException('Stack underflow')
+
+# slots per page; a page is only allocated once something is stored in it
+PAGE_SIZE = 4096
+
+def zeros(n):
+    return array('q', bytes(8 * n))
+
+class Heap:
+    '''
+    Dice slot memory. Every slot holds one die (an integer); slots that
+    were never written read as 0. Slots live in fixed-size pages of 64-bit
+    arrays, allocated on first write, so a program using slot 10**9 costs
+    one page rather than a billion entries. Range reads and writes copy
+    whole runs of a page with slice assignment. A page only falls back to
+    a Python list if a die too large for 64 bits is stored in it.
+
+    Each page also remembers the range of offsets ever written to it, so
+    todict only looks at that range rather than every slot of the page.
+    '''
+    def __init__(self):
+        self.pages = {}
+        self.extents = {}
+
+    def touch(self, index, start, end):
+        extent = self.extents.get(index)
+        if extent is None:
+            self.extents[index] = (start, end)
+        elif start < extent[0] or end > extent[1]:
+            self.extents[index] = (min(start, extent[0]), max(end, extent[1]))
+
+    def lookup(self, slot):
+        page = self.pages.get(slot // PAGE_SIZE)
+        if page is None:
+            return 0
+        return page[slot % PAGE_SIZE]
+
+    def put(self, slot, value):
+        index, offset = divmod(slot, PAGE_SIZE)
+        page = self.pages.get(index)
+        if page is None:
+            page = self.pages[index] = zeros(PAGE_SIZE)
+        try:
+            page[offset] = value
+        except OverflowError:
+            page = self.pages[index] = list(page)
+            page[offset] = value
+        self.touch(index, offset, offset + 1)
+
+    def read(self, start, count):
+        if start < 0 or count < 0:
+            raise RuntimeException('Invalid memory reference {}d{}'.format(count, start))
+        parts = []
+        compact = True
+        slot, end = start, start + count
+        while slot < end:
+            index, offset = divmod(slot, PAGE_SIZE)
+            n = min(PAGE_SIZE - offset, end - slot)
+            page = self.pages.get(index)
+            if page is None:
+                parts.append(zeros(n))
+            else:
+                parts.append(page[offset:offset + n])
+                compact = compact and type(page) is array
+            slot += n
+        if len(parts) == 1 and compact:
+            return parts[0]
+        if compact:
+            return array('q', b''.join(part.tobytes() for part in parts))
+        out = []
+        for part in parts:
+            out.extend(part)
+        return out
+
+    def write(self, start, count, values):
+        '''
+        Store values into slots start.. onwards. Only the first `count`
+        values are kept if there are more values than slots.
+        '''
+        if start < 0 or count < 0:
+            raise RuntimeException('Invalid memory reference {}d{}'.format(count, start))
+        total = min(count, len(values))
+        done = 0
+        while done < total:
+            index, offset = divmod(start + done, PAGE_SIZE)
+            n = min(PAGE_SIZE - offset, total - done)
+            page = self.pages.get(index)
+            if page is None:
+                page = self.pages[index] = zeros(PAGE_SIZE)
+            chunk = values[done:done + n]
+            if type(page) is array:
+                try:
+                    if type(chunk) is not array or chunk.typecode != 'q':
+                        chunk = array('q', chunk)
+                    page[offset:offset + n] = chunk
+                except OverflowError:
+                    page = self.pages[index] = list(page)
+            if type(page) is list:
+                page[offset:offset + n] = list(chunk)
+            self.touch(index, offset, offset + n)
+            done += n
+
+    def todict(self):
+        '''Every slot holding something other than 0, as {slot: die}.'''
+        out = {}
+        for index, page in sorted(self.pages.items()):
+            start, end = self.extents.get(index, (0, PAGE_SIZE))
+            base = index * PAGE_SIZE + start
+            for offset, die in enumerate(page[start:end]):
+                if die:
+                    out[base + offset] = die
+        return out
+
+    def getstate(self):
+        # pages as raw bytes where possible; see snapshot.py
+        return dict((index, page.tobytes() if type(page) is array else tuple(page))
+                    for index, page in self.pages.items())
+
+    def setstate(self, state):
+        self.pages = dict((index, array('q', page) if type(page) is bytes else list(page))
+                          for index, page in state.items())
+        # restored slots count as written: the nonzero range of a page
+        # stored as bytes, the whole of any other
+        self.extents = {}
+        for index, page in state.items():
+            if type(page) is bytes:
+                start = (len(page) - len(page.lstrip(b'\0'))) // 8
+                end = (len(page.rstrip(b'\0')) + 7) // 8
+                if start < end:
+                    self.extents[index] = (start, end)
+            else:
+                self.extents[index] = (0, PAGE_SIZE)
@@ -0,0 +1,154 @@
+import json
+from time import perf_counter_ns
+
+from bytecode import decode, opcodes, Machine
+
+'''
+Per-instruction profiling. Profiler.run executes a program the way
+execute() does, but times every handler call and counts it against the
+instruction that made it. Reports then group those counters by opcode or
+by source line, using the source map the compiler leaves on the program.
+execute() itself is untouched, so programs that are not being profiled
+pay nothing for this.
+
+    profiler = Profiler(pgm)
+    profiler.run(Machine())
+    print(profiler.report())
+    json.dump(profiler.toJSON(), f)
+    f.write(profiler.collapsed())    # for flamegraph.pl, speedscope etc.
+
+Times include the timer calls themselves, so they are best read relative
+to each other rather than as absolute costs.
+'''
+
+class Profiler:
+    def __init__(self, pgm):
+        self.pgm = pgm
+        self.counts = [0] * len(pgm)
+        self.times = [0] * len(pgm)
+
+    def run(self, vm=None, steps=None):
+        '''Same contract as execute(): runs from vm.pc and can be resumed.'''
+        if vm is None:
+            vm = Machine()
+        pgm = self.pgm
+        table = pgm.table
+        if table is None:
+            table = pgm.table = decode(pgm)
+        counts = self.counts
+        times = self.times
+        end = len(table)
+        pc = vm.pc
+        if steps is None:
+            steps = -1
+        try:
+            while pc < end and steps != 0:
+                fn, arg = table[pc]
+                start = perf_counter_ns()
+                jump = fn(vm, arg)
+                times[pc] += perf_counter_ns() - start
+                counts[pc] += 1
+                if jump is None:
+                    pc += 1
+                else:
+                    pc = jump
+                steps -= 1
+        except BaseException:
+            vm.files.closeAll()
+            raise
+        finally:
+            vm.pc = pc
+            vm.output.flush()
+        if pc >= end:
+            vm.files.closeAll()
+        return vm
+
+    def reset(self):
+        self.counts = [0] * len(self.pgm)
+        self.times = [0] * len(self.pgm)
+
+    def opcode(self, index):
+        return opcodes[self.pgm.code[2*index]].name
+
+    def line(self, index):
+        '''Source line of an instruction, or None if the map has no entry.'''
+        sourcemap = self.pgm.sourcemap
+        if sourcemap is None or sourcemap[index] is None:
+            return None
+        return sourcemap[index][0]
+
+    def group(self, key):
+        totals = {}
+        for i, count in enumerate(self.counts):
+            if not count:
+                continue
+            k = key(i)
+            entry = totals.get(k)
+            if entry is None:
+                entry = totals[k] = [0, 0]
+            entry[0] += count
+            entry[1] += self.times[i]
+        return totals
+
+    def byOpcode(self):
+        '''{mnemonic: (count, nanoseconds)}'''
+        return dict((k, tuple(v)) for k, v in self.group(self.opcode).items())
+
+    def byLine(self):
+        '''{source line or None: (count, nanoseconds)}'''
+        return dict((k, tuple(v)) for k, v in self.group(self.line).items())
+
+    def toJSON(self):
+        sourcemap = self.pgm.sourcemap
+        instructions = []
+        for i, count in enumerate(self.counts):
+            if not count:
+                continue
+            instructions.append({
+                'index': i,
+                'opcode': self.opcode(i),
+                'span': list(sourcemap[i]) if sourcemap and sourcemap[i] else None,
+                'count': count,
+                'ns': self.times[i],
+            })
+        return {
+            'total_ns': sum(self.times),
+            'instructions': instructions,
+            'opcodes': [{'opcode': k, 'count': c, 'ns': t}
+                        for k, (c, t) in sorted(self.byOpcode().items(),
+                                                key=lambda item: -item[1][1])],
+            'lines': [{'line': k, 'count': c, 'ns': t}
+                      for k, (c, t) in sorted(self.byLine().items(),
+                                              key=lambda item: -item[1][1])],
+        }
+
+    def collapsed(self, root='d20'):
+        '''
+        Collapsed stacks, one "root;line N;OPCODE nanoseconds" per line, the
+        input format of flamegraph.pl and most flame graph viewers.
+        '''
+        totals = self.group(lambda i: (self.line(i), self.opcode(i)))
+        lines = []
+        for (line, name), (count, ns) in sorted(totals.items(),
+                                                key=lambda item: (item[0][0] or 0, item[0][1])):
+            where = 'line {}'.format(line) if line is not None else 'no source'
+            lines.append('{};{};{} {}'.format(root, where, name, ns))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def report(self, limit=10):
+        total = sum(self.times) or 1
+        out = ['{:>12} {:>12} {:>6}  {}'.format('count', 'ns', '%', 'opcode')]
+        for name, (count, ns) in sorted(self.byOpcode().items(), key=lambda item: -item[1][1])[:limit]:
+            out.append('{:>12,} {:>12,} {:>6.1f}  {}'.format(count, ns, 100 * ns / total, name))
+        out.append('')
+        out.append('{:>12} {:>12} {:>6}  {}'.format('count', 'ns', '%', 'line'))
+        for line, (count, ns) in sorted(self.byLine().items(), key=lambda item: -item[1][1])[:limit]:
+            out.append('{:>12,} {:>12,} {:>6.1f}  {}'.format(count, ns, 100 * ns / total,
+                                                              '-' if line is None else line))
+        return '\n'.join(out)
+
+def profile(pgm, vm=None):
+    '''Run a program to completion under a fresh Profiler and return it.'''
+    profiler = Profiler(pgm)
+    profiler.run(vm)
+    return profiler
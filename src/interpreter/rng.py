@@ -0,0 +1,186 @@
+import os
+from hashlib import sha256, shake_128
+from operator import length_hint
+from random import Random
+from struct import Struct
+
+from dice import DiceEngine
+
+'''
+Random number generators. Each interpreter owns one, so concurrent runs
+never share state. Both generators are random.Random subclasses, so every
+method of Random works on them, and both add
+
+    integers(n, sides)  n dice as a compact array, see DiceEngine.roll
+    spawn(n)            n child generators with independent streams
+
+Children are keyed by their parent's seed plus a spawn path, so a worker
+seeded from spawn(n)[i] of a given master seed always sees the same
+numbers, and no two children share a stream.
+'''
+
+def deriveKey(seed, path):
+    return sha256(repr((seed, tuple(path))).encode()).digest()
+
+def entropy():
+    return int.from_bytes(os.urandom(16), 'little')
+
+class MersenneTwister(Random):
+    '''
+    Python's own generator. With no spawn path, MersenneTwister(s) draws
+    exactly the numbers Random(s) does.
+    '''
+    name = 'mt'
+
+    def __init__(self, seed=None, path=()):
+        self.path = tuple(path)
+        self.spawned = 0
+        self.dice = DiceEngine(self)
+        super().__init__(seed)
+
+    def seed(self, value=None, version=2):
+        if value is None:
+            value = entropy()
+        self.origin = value
+        if self.path:
+            value = int.from_bytes(deriveKey(value, self.path), 'little')
+        super().seed(value, version)
+        self.dice.generator = None
+
+    def integers(self, n, sides):
+        return self.dice.roll(n, sides)
+
+    def spawn(self, n):
+        start = self.spawned
+        self.spawned += n
+        return [type(self)(self.origin, self.path + (i,)) for i in range(start, start + n)]
+
+    def getstate(self):
+        return (self.name, self.origin, self.path, self.spawned, super().getstate())
+
+    def setstate(self, state):
+        name, self.origin, self.path, self.spawned, inner = state
+        super().setstate(inner)
+        self.dice.generator = None
+
+class CounterGenerator(Random):
+    '''
+    Counter based generator: block i of the stream is SHAKE-128 of the key
+    and i, so bulk draws cost one C call per BLOCK bytes, and jumping ahead
+    is just moving the counter. Single draws (random, getrandbits up to 64
+    bits) come from a chunk of WORDS 64-bit words unpacked in one go, which
+    keeps them to a next() and a shift, though still well behind the C
+    Mersenne Twister.
+    '''
+    name = 'counter'
+    BLOCK = 1 << 16
+    WORDS = 1024
+    unpack = Struct('<{}Q'.format(WORDS)).unpack
+
+    def __init__(self, seed=None, path=()):
+        self.path = tuple(path)
+        self.spawned = 0
+        self.dice = DiceEngine(self)
+        super().__init__(seed)
+
+    def seed(self, value=None, version=2):
+        if value is None:
+            value = entropy()
+        self.origin = value
+        self.key = deriveKey(value, self.path)
+        self.counter = 0
+        self.buffer = b''
+        self.offset = 0
+        self.words = iter(())
+        self.chunk = 0
+        self.dice.generator = None
+
+    def block(self, index):
+        return shake_128(self.key + index.to_bytes(8, 'little')).digest(self.BLOCK)
+
+    def randbytes(self, n):
+        parts = []
+        while n > 0:
+            if self.offset == len(self.buffer):
+                self.buffer = self.block(self.counter)
+                self.counter += 1
+                self.offset = 0
+            take = min(n, len(self.buffer) - self.offset)
+            parts.append(self.buffer[self.offset:self.offset + take])
+            self.offset += take
+            n -= take
+        return b''.join(parts)
+
+    def refill(self):
+        '''Take the next chunk of words for single draws from the stream.'''
+        self.chunk = self.position()
+        self.words = iter(self.unpack(self.randbytes(8 * self.WORDS)))
+
+    def getrandbits(self, k):
+        if k < 0:
+            raise ValueError('number of bits must be non-negative')
+        if k == 0:
+            return 0
+        if k <= 64:
+            word = next(self.words, None)
+            if word is None:
+                self.refill()
+                word = next(self.words)
+            return word >> (64 - k)
+        nbytes = (k + 7) // 8
+        return int.from_bytes(self.randbytes(nbytes), 'little') >> (nbytes * 8 - k)
+
+    def random(self):
+        word = next(self.words, None)
+        if word is None:
+            self.refill()
+            word = next(self.words)
+        return (word >> 11) * 2.0 ** -53
+
+    def integers(self, n, sides):
+        return self.dice.roll(n, sides)
+
+    def jump(self, blocks=1):
+        '''Advance the stream by blocks * BLOCK bytes without generating them.'''
+        self.moveTo(self.position() + blocks * self.BLOCK)
+
+    def spawn(self, n):
+        start = self.spawned
+        self.spawned += n
+        return [type(self)(self.origin, self.path + (i,)) for i in range(start, start + n)]
+
+    def position(self):
+        '''Number of bytes consumed from the stream so far.'''
+        if self.buffer:
+            return (self.counter - 1) * self.BLOCK + self.offset
+        return self.counter * self.BLOCK
+
+    def getstate(self):
+        return (self.name, self.origin, self.path, self.spawned, self.position(),
+                self.chunk, length_hint(self.words))
+
+    def setstate(self, state):
+        name, origin, path, self.spawned, position, chunk, pending = state
+        self.path = tuple(path)
+        self.seed(origin)
+        if pending:
+            self.moveTo(chunk)
+            self.refill()
+            self.words = iter(tuple(self.words)[-pending:])
+        self.moveTo(position)
+
+    def moveTo(self, position):
+        self.counter, self.offset = divmod(position, self.BLOCK)
+        self.buffer = b''
+        if self.offset:
+            self.buffer = self.block(self.counter)
+            self.counter += 1
+
+generators = dict((cls.name, cls) for cls in (MersenneTwister, CounterGenerator))
+
+def makeRNG(name='mt', seed=None):
+    try:
+        return generators[name](seed)
+    except KeyError:
+        raise ValueError('Unknown generator "{}", expected one of {}'.format(
+            name, ', '.join(sorted(generators))))
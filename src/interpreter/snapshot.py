@@ -0,0 +1,123 @@
+import marshal
+import struct
+import zlib
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from bytecode import Machine, dumps
+from rng import generators
+from values import List, Roll, String
+
+'''
+Saving and restoring a stopped machine.
+
+A snapshot holds the program counter, the stack, the dice slots and the
+generator state, marshalled and zlib compressed behind a small header:
+
+    magic 'D20S', u16 format version, u32 crc32 of the compiled program
+
+Dice from the engine's compact arrays are stored as raw bytes. A roll that
+has not been drawn yet is stored as its count, sides, crit check and any
+sampled total, and the NumPy generator behind bulk rolls is saved with the
+rest of the generator state, so a restored machine draws exactly what the
+original would have. Open files are not part of a snapshot.
+
+Snapshots are meant to move between processes running the same
+interpreter, and like any marshal data they should only be loaded from
+trusted sources.
+'''
+
+MAGIC = b'D20S'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<4sHI')
+
+class SnapshotException(Exception):
+    pass
+
+def fingerprint(pgm):
+    return zlib.crc32(dumps(pgm)) if pgm is not None else 0
+
+def packValue(value):
+    if type(value) is int:
+        return value
+    if type(value) is String:
+        return value.value
+    if type(value) is Roll and value.pending():
+        return (value.count, value.sides, value.crit, value.sampled)
+    dice = value.value
+    if type(dice) is array:
+        return (dice.typecode, dice.tobytes())
+    return ('', tuple(dice))
+
+def unpackValue(value, engine):
+    if type(value) is int:
+        return value
+    if type(value) is str:
+        return String(value)
+    if len(value) == 4:
+        count, sides, crit, sampled = value
+        roll = Roll(count, sides, engine, crit)
+        roll.sampled = sampled
+        return roll
+    typecode, dice = value
+    if typecode:
+        return List(array(typecode, dice))
+    return List(list(dice))
+
+def snapshot(vm, pgm=None):
+    '''
+    Serialize a machine that is between instructions. Passing the program
+    stamps the snapshot with it, so restore() can refuse a mismatch.
+    '''
+    engine = vm.rng.dice
+    state = (
+        vm.pc,
+        [packValue(v) for v in vm.stack],
+        vm.heap.getstate(),
+        vm.rng.getstate(),
+        None if engine.generator is None else engine.generator.bit_generator.state,
+    )
+    body = zlib.compress(marshal.dumps(state))
+    return HEADER.pack(MAGIC, FORMAT_VERSION, fingerprint(pgm)) + body
+
+def restore(data, pgm=None, vm=None):
+    '''
+    Rebuild the machine saved by snapshot(), into `vm` if one is given
+    (an AsyncMachine, say, with its streams already attached).
+    '''
+    try:
+        magic, version, stamp = HEADER.unpack_from(data)
+    except struct.error:
+        raise SnapshotException('Snapshot is truncated')
+    if magic != MAGIC:
+        raise SnapshotException('Not a D20 snapshot')
+    if version != FORMAT_VERSION:
+        raise SnapshotException('Snapshot format {} is not supported'.format(version))
+    if pgm is not None and stamp and stamp != fingerprint(pgm):
+        raise SnapshotException('Snapshot was taken from a different program')
+    try:
+        pc, stack, slots, rngstate, bulkstate = marshal.loads(zlib.decompress(data[HEADER.size:]))
+    except (zlib.error, ValueError, EOFError, TypeError):
+        raise SnapshotException('Snapshot is corrupt')
+
+    if vm is None:
+        vm = Machine()
+    try:
+        vm.rng = generators[rngstate[0]]()
+    except KeyError:
+        raise SnapshotException('Unknown generator "{}"'.format(rngstate[0]))
+    vm.rng.setstate(rngstate)
+    if bulkstate is not None:
+        if numpy is None:
+            raise SnapshotException('Snapshot needs NumPy to restore its bulk dice generator')
+        generator = numpy.random.default_rng()
+        generator.bit_generator.state = bulkstate
+        vm.rng.dice.generator = generator
+    vm.pc = pc
+    vm.stack[:] = [unpackValue(v, vm.rng.dice) for v in stack]
+    vm.heap.setstate(slots)
+    return vm
@@ -0,0 +1,203 @@
+from dice import total, text, critcheck
+
+class RuntimeException(Exception):
+    pass
+
+'''
+Runtime values. Numbers are plain Python ints so arithmetic never has to
+box or unbox anything; dice pools and text are wrapped in List and String.
+The helpers below accept any of the three.
+'''
+
+TRUE = 1
+FALSE = 0
+
+def toChar(code):
+    try:
+        return chr(code)
+    except (ValueError, OverflowError):
+        raise RuntimeException('Cannot print {} as a character'.format(code))
+
+def toNumber(value):
+    if type(value) is int:
+        return value
+    return value.toNumber()
+
+def toList(value):
+    if type(value) is int:
+        return [value]
+    return value.toList()
+
+def truthy(value):
+    if type(value) is int:
+        return value != 0
+    return value.truthy()
+
+def toText(value):
+    if type(value) is int:
+        return toChar(value)
+    return value.print()
+
+class List:
+    '''
+    Dice pool. Lists are always flat sequences of integers; lists built from
+    other lists are spliced together rather than nested. The sequence may be
+    a compact array straight from the dice engine.
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def toNumber(self):
+        return total(self.value)
+
+    def toList(self):
+        return self.value
+
+    def truthy(self):
+        return self.toNumber() != 0
+
+    def size(self):
+        return len(self.value)
+
+    def print(self):
+        return text(self.value, toChar)
+
+    def getValue(self, index):
+        try:
+            return self.value[index]
+        except IndexError:
+            raise RuntimeException('List index {} out of range'.format(index))
+
+    def setValue(self, index, value):
+        try:
+            self.value[index] = value
+        except IndexError:
+            raise RuntimeException('List index {} out of range'.format(index))
+        except OverflowError:
+            # value does not fit the compact array the dice came in
+            self.value = list(self.value)
+            self.value[index] = value
+
+    def __repr__(self):
+        return 'List(%r)' % (self.value,)
+
+# rolls of at least this many dice are left undrawn until something needs them
+LAZY_THRESHOLD = 128
+# a total is sampled face by face once there are this many dice per face
+TOTAL_RATIO = 16
+# the most dice a roll may actually draw; larger rolls can only be summarized
+MAX_DRAWN = 1 << 24
+
+class Roll(List):
+    '''
+    A roll whose dice have not been drawn yet, optionally with a crit check
+    applied to each die. Whatever needs the dice themselves draws them on
+    first use; SUM, kh1, kl1 and crit counts instead sample the result
+    from its exact distribution (see DiceEngine), without ever drawing.
+    Rolls of more than MAX_DRAWN dice refuse to be drawn at all.
+
+    Every handler that reduces a value to a number also pops it, so a roll
+    is either drawn or summarized, never both. The sampled total is kept
+    all the same, so asking twice gives the same answer.
+    '''
+    __slots__ = ('count', 'sides', 'engine', 'crit', 'dice', 'sampled')
+
+    def __init__(self, count, sides, engine, crit=None):
+        self.count = count
+        self.sides = sides
+        self.engine = engine
+        self.crit = crit
+        self.dice = None
+        self.sampled = None
+
+    @property
+    def value(self):
+        if self.dice is None:
+            if self.count > MAX_DRAWN:
+                raise RuntimeException('Cannot draw {}d{}: rolls of over {} dice can only be '
+                                       'summed, counted or kept as kh1/kl1'.format(
+                                           self.count, self.sides, MAX_DRAWN))
+            dice = self.engine.roll(self.count, self.sides)
+            if self.crit is not None:
+                dice = critcheck(dice, *self.crit)
+            self.dice = dice
+        return self.dice
+
+    @value.setter
+    def value(self, dice):
+        self.dice = dice
+
+    def pending(self):
+        return self.dice is None
+
+    def checked(self, op, target):
+        '''This roll with a crit check on every die, still undrawn.'''
+        return Roll(self.count, self.sides, self.engine, (op, target))
+
+    def toNumber(self):
+        if self.dice is not None:
+            return total(self.dice)
+        if self.sampled is None:
+            if self.crit is not None:
+                self.sampled = self.engine.successes(self.count, self.sides, *self.crit)
+            elif self.count >= TOTAL_RATIO * self.sides:
+                self.sampled = self.engine.total(self.count, self.sides)
+            else:
+                return total(self.value)
+        return self.sampled
+
+    def truthy(self):
+        if self.dice is None and self.crit is None:
+            return self.count > 0 and self.sides > 0
+        return self.toNumber() != 0
+
+    def size(self):
+        return self.count
+
+    def highest(self):
+        return self.engine.highest(self.count, self.sides)
+
+    def lowest(self):
+        return self.engine.lowest(self.count, self.sides)
+
+    def __repr__(self):
+        if self.dice is not None:
+            return 'Roll(%r)' % (self.dice,)
+        return 'Roll(%dd%d%s)' % (self.count, self.sides,
+                                  '' if self.crit is None else ' %s %d' % self.crit)
+
+class String:
+    '''
+    Text from the prompt or a file. As dice it is its length followed by
+    its character codes, which is how it is laid out in dice slots.
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def toNumber(self):
+        return sum(self.toList())
+
+    def toList(self):
+        return [len(self.value)] + [ord(c) for c in self.value]
+
+    def truthy(self):
+        return len(self.value) != 0
+
+    def size(self):
+        return len(self.value)
+
+    def print(self):
+        return self.value
+
+    def getValue(self, index):
+        try:
+            return ord(self.value[index])
+        except IndexError:
+            raise RuntimeException('String index {} out of range'.format(index))
+
+    def __repr__(self):
+        return 'String(%r)' % self.value
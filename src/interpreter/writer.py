@@ -0,0 +1,32 @@
+import sys
+
+'''
+Buffered program output. PRINT appends to the machine's Writer instead of
+calling print(), and the text reaches the stream in large writes: when
+the buffer fills, before INPUT prompts the user and when execute() stops.
+'''
+
+BUFFER_SIZE = 1 << 16
+
+class Writer:
+    def __init__(self, stream=None, size=BUFFER_SIZE):
+        # None means whatever sys.stdout is when the buffer is flushed
+        self.stream = stream
+        self.size = size
+        self.parts = []
+        self.pending = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.pending += len(text)
+        if self.pending >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.parts:
+            return
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(''.join(self.parts))
+        stream.flush()
+        self.parts = []
+        self.pending = 0